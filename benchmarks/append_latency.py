@@ -0,0 +1,65 @@
+"""Measures State.append_entries latency as the log grows. Each round appends
+a batch at the tail, retransmits the same batch (which should be skipped), and
+replaces the last few entries as a new leader would. With in-place truncation
+the latency should stay flat regardless of log length; the `copy` column shows
+the cost of the previous approach of rebuilding the list on truncation.
+
+usage: python benchmarks/append_latency.py [--lengths 1000,100000,1000000]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from raft import State, Entry, Op  # noqa
+from store import Store  # noqa
+
+BATCH = 10
+ROUNDS = 200
+
+
+def batch(term: int):
+    return [Entry(op=Op.WRITE, key='key', value='value', term=term)
+            for _ in range(BATCH)]
+
+
+def run(length: int):
+    s = State(Store())
+    s.current_term = 1
+    s.log.extend(batch(1) * (length // BATCH))
+    copy = [None] * length
+
+    start = time.perf_counter()
+    for r in range(ROUNDS):
+        term = r + 2
+        prev = len(s.log) - 1
+        kwargs = dict(leader_id='a:1', prev_log_term=s.log.term(prev),
+                      leader_commit=-1)
+        s.append_entries(term=term, prev_log_index=prev,
+                         entries=batch(term), **kwargs)
+        s.append_entries(term=term, prev_log_index=prev,
+                         entries=batch(term), **kwargs)
+        # a new leader replaces the last half of the batch
+        s.current_term = term + 1
+        s.append_entries(term=term + 1, prev_log_index=prev + BATCH // 2,
+                         prev_log_term=term, leader_id='b:1',
+                         entries=batch(term + 1)[:BATCH // 2],
+                         leader_commit=-1)
+    per_round = (time.perf_counter() - start) / ROUNDS
+
+    start = time.perf_counter()
+    for _ in range(ROUNDS):
+        copy = copy[:length]
+    copy_cost = (time.perf_counter() - start) / ROUNDS
+    print(f"log length {length:>10,}  {per_round * 1e6:>8.1f} us/round  "
+          f"copy {copy_cost * 1e6:>10.1f} us")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--lengths', default='1000,100000,1000000')
+    args = parser.parse_args()
+    for n in args.lengths.split(','):
+        run(int(n))
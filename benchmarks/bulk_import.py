@@ -0,0 +1,62 @@
+"""Measures write throughput, in pairs per second, of `POST /import` against
+one `POST /` per pair, on a single-node leader. The import streams the same
+pairs as NDJSON and in the binary format, and commits them in batch entries,
+so it should be orders of magnitude faster than a round trip per pair.
+
+usage: python benchmarks/bulk_import.py [--pairs 200000] [--value-bytes 50]
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+import codec  # noqa
+from fastapi.testclient import TestClient  # noqa
+from raft import State  # noqa
+from server import build_app  # noqa
+from store import Store  # noqa
+
+SINGLE = 2000
+
+
+def client() -> TestClient:
+    state = State(Store())
+    state.become_leader()
+    return TestClient(build_app(state))
+
+
+def report(name: str, pairs: int, elapsed: float):
+    print(f"{name:<8} {pairs / elapsed:>12,.0f} pairs/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=200000)
+    parser.add_argument('--value-bytes', type=int, default=50)
+    args = parser.parse_args()
+    os.environ.setdefault('RSB_SNAPSHOT_ENTRIES', str(1 << 30))
+    value = 'v' * args.value_bytes
+    pairs = [(f'k{i}', value) for i in range(args.pairs)]
+
+    c = client()
+    start = time.perf_counter()
+    for key, value in pairs[:SINGLE]:
+        c.post('/', params=dict(key=key, value=value))
+    report('single', SINGLE, time.perf_counter() - start)
+
+    body = b''.join(json.dumps(dict(key=k, value=v)).encode() + b'\n'
+                    for k, v in pairs)
+    c = client()
+    start = time.perf_counter()
+    c.post('/import', content=body)
+    report('ndjson', len(pairs), time.perf_counter() - start)
+
+    body = codec.encode_import(pairs)
+    c = client()
+    start = time.perf_counter()
+    c.post('/import', content=body,
+           headers={'content-type': codec.IMPORT_CONTENT_TYPE})
+    report('binary', len(pairs), time.perf_counter() - start)
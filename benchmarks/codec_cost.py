@@ -0,0 +1,51 @@
+"""Compares the cost of encoding and decoding an AppendEntries request of
+1,000 entries with JSON plus pydantic validation (the server's JSON path)
+against the binary framing in `codec`.
+
+usage: python benchmarks/codec_cost.py [--entries N] [--value-bytes N]
+"""
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+import codec  # noqa
+from raft import Entry, Op  # noqa
+from replication import _entry_json  # noqa
+from server import AppendEntries  # noqa
+
+
+def report(name: str, encode, decode, size: int, number: int = 50):
+    enc = timeit.timeit(encode, number=number) / number
+    dec = timeit.timeit(decode, number=number) / number
+    print(f"{name:<7} encode {enc * 1e3:>7.2f} ms  decode {dec * 1e3:>7.2f} ms"
+          f"  {size:>9,} bytes")
+    return enc + dec
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1000)
+    parser.add_argument('--value-bytes', type=int, default=100)
+    args = parser.parse_args()
+
+    entries = [Entry(op=Op.WRITE, key=f'user/{i}', value='v' * args.value_bytes,
+                     term=1) for i in range(args.entries)]
+    req = dict(term=1, leader_id='localhost:5000', prev_log_index=100,
+               prev_log_term=1, entries=entries, leader_commit=99)
+
+    def encode_json():
+        return json.dumps(
+            dict(req, entries=[_entry_json(e) for e in entries])).encode()
+    body = encode_json()
+    packed = codec.encode_append(**req)
+
+    print(f"AppendEntries with {args.entries:,} entries")
+    slow = report('json', encode_json,
+                  lambda: AppendEntries.model_validate_json(body), len(body))
+    fast = report('binary', lambda: codec.encode_append(**req),
+                  lambda: codec.decode_append(packed), len(packed))
+    print(f"binary is {slow / fast:.1f}x cheaper")
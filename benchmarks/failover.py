@@ -0,0 +1,117 @@
+"""Measures failover time: how long a local cluster takes to elect a new
+leader after its leader is killed. The nodes run in one process and talk over
+in-process transports, and a killed node's requests, in both directions, fail
+as if it were unreachable. Each round kills the current leader, waits for the
+others to elect a new one, then brings the old leader back as a follower.
+Time-to-new-leader should fall between one and two election timeouts, plus a
+vote round trip, in most rounds; split votes show up in the tail.
+
+usage: python benchmarks/failover.py [--nodes 3] [--rounds 50]
+    [--election-timeout-ms 150] [--heartbeat-ms 50]
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from election import Elector  # noqa
+from raft import State, ForeignNode, Role  # noqa
+from replication import Replicator  # noqa
+from server import build_app  # noqa
+from store import Store  # noqa
+
+
+class Network(httpx.AsyncBaseTransport):
+    def __init__(self, source: str, apps: dict, down: set):
+        self.source = source
+        self.apps = apps
+        self.down = down
+
+    async def handle_async_request(self, request):
+        target = f'{request.url.host}:{request.url.port}'
+        if self.source in self.down or target in self.down:
+            raise httpx.ConnectError('node is down', request=request)
+        transport = httpx.ASGITransport(app=self.apps[target])
+        return await transport.handle_async_request(request)
+
+
+def cluster(nodes: int, election_timeout: float, heartbeat: float):
+    addresses = [f'n{i}:1' for i in range(nodes)]
+    apps: dict = dict()
+    down: set = set()
+    electors = dict()
+    for address in addresses:
+        state = State(Store())
+        state.address = address
+        state.foreign_nodes = {
+            a: ForeignNode() for a in addresses if a != address}
+
+        def client(target, source=address):
+            return httpx.AsyncClient(
+                transport=Network(source, apps, down),
+                base_url=f'http://{target}')
+        replicator = Replicator(
+            state, heartbeat_interval=heartbeat, client_factory=client)
+        electors[address] = Elector(
+            state, replicator, election_timeout=election_timeout,
+            client_factory=client)
+        apps[address] = build_app(state, replicator, electors[address])
+    return electors, down
+
+
+async def wait_for_leader(electors, down) -> str:
+    while True:
+        leaders = [a for a, e in electors.items()
+                   if e.state.role == Role.LEADER and a not in down]
+        if len(leaders) == 1:
+            return leaders[0]
+        await asyncio.sleep(0.001)
+
+
+async def run(args) -> list:
+    electors, down = cluster(
+        args.nodes, args.election_timeout_ms / 1000, args.heartbeat_ms / 1000)
+    for e in electors.values():
+        e.start()
+    leader = await wait_for_leader(electors, down)
+    times = list()
+    for _ in range(args.rounds):
+        killed = time.perf_counter()
+        down.add(leader)
+        new_leader = await wait_for_leader(electors, down)
+        times.append(time.perf_counter() - killed)
+        # let the old leader rejoin, and the cluster settle
+        down.clear()
+        await asyncio.sleep(4 * args.election_timeout_ms / 1000)
+        leader = await wait_for_leader(electors, down)
+        assert leader == new_leader
+    for e in electors.values():
+        await e.stop()
+        await e.replicator.stop()
+    return times
+
+
+def percentile(times: list, p: float) -> float:
+    return sorted(times)[min(len(times) - 1, int(p * len(times)))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--election-timeout-ms', type=int, default=150)
+    parser.add_argument('--heartbeat-ms', type=int, default=50)
+    args = parser.parse_args()
+    times = asyncio.run(run(args))
+    print(f"{args.nodes} nodes, {args.rounds} leader kills, election timeout "
+          f"{args.election_timeout_ms} ms")
+    print(f"time to new leader  mean {statistics.mean(times) * 1000:>7.1f} ms")
+    for p in (0.5, 0.9, 0.99):
+        print(f"{'':20}p{int(p * 100):<3} {percentile(times, p) * 1000:>7.1f} ms")
+    print(f"{'':20}max  {max(times) * 1000:>7.1f} ms")
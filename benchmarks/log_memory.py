@@ -0,0 +1,63 @@
+"""Compares the memory used to hold a log of entries as a list of Entry
+objects against the columnar logstore.MemoryLog, and the cost of random
+access and term lookups in each.
+
+usage: python benchmarks/log_memory.py [--entries N]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from logstore import MemoryLog  # noqa
+from raft import Entry, Op, encode_entry, decode_entry, entry_term  # noqa
+
+
+def entries(n: int):
+    for i in range(n):
+        yield Entry(op=Op.WRITE, key=f'user/{i}', value=f'value-{i}', term=1)
+
+
+def measure(name: str, build, n: int):
+    tracemalloc.start()
+    log = build(n)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    picks = [random.randrange(n) for _ in range(100_000)]
+    start = time.perf_counter()
+    for i in picks:
+        log[i]
+    get = (time.perf_counter() - start) / len(picks)
+    # the columnar log answers term lookups without decoding the entry
+    term_at = getattr(log, 'term', lambda i: log[i].term)
+    start = time.perf_counter()
+    for i in picks:
+        term_at(i)
+    term = (time.perf_counter() - start) / len(picks)
+    print(f"{name:<10} {size / n:>8.1f} bytes/entry  "
+          f"{get * 1e9:>8.0f} ns/get  {term * 1e9:>8.0f} ns/term")
+    return size
+
+
+def build_list(n: int):
+    return list(entries(n))
+
+
+def build_columnar(n: int):
+    log = MemoryLog(encode_entry, decode_entry, entry_term)
+    log.extend(entries(n))
+    return log
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=1_000_000)
+    args = parser.parse_args()
+    before = measure('list', build_list, args.entries)
+    after = measure('columnar', build_columnar, args.entries)
+    print(f"memory reduced {before / after:.1f}x")
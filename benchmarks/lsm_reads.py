@@ -0,0 +1,56 @@
+"""Measures point read latency on the on-disk LSM store, for keys that are
+read repeatedly (served from the block cache) and for keys spread over the
+whole dataset, against the in-memory store. Pass a --keys count whose data
+outgrows the block cache to see cold reads hit the page cache and disk.
+
+usage: python benchmarks/lsm_reads.py [--keys N] [--reads N] [--value-bytes N]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from lsm import LSMStore  # noqa
+from store import Store  # noqa
+
+
+def measure(name: str, store, keys, reads: int):
+    start = time.perf_counter()
+    for i in range(reads):
+        store.read(keys[i % len(keys)])
+    elapsed = time.perf_counter() - start
+    print(f"{name:<24} {elapsed / reads * 1e6:>8.2f} us/read")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=200000)
+    parser.add_argument('--reads', type=int, default=100000)
+    parser.add_argument('--value-bytes', type=int, default=100)
+    args = parser.parse_args()
+    value = 'v' * args.value_bytes
+    keys = [f'key{i:010d}' for i in random.Random(0).sample(
+        range(args.keys), args.keys)]
+    hot = keys[:100]
+    spread = random.Random(1).choices(keys, k=args.reads)
+
+    memory = Store()
+    with tempfile.TemporaryDirectory() as d:
+        disk = LSMStore(d)
+        start = time.perf_counter()
+        for key in keys:
+            memory.upsert(key, value)
+            disk.upsert(key, value)
+        disk.flush()
+        print(f"loaded {args.keys:,} keys in "
+              f"{time.perf_counter() - start:.1f}s, "
+              f"levels: {[len(level) for level in disk._version.levels]}")
+        measure('memory, hot keys', memory, hot, args.reads)
+        measure('lsm, hot keys', disk, hot, args.reads)
+        measure('memory, spread keys', memory, spread, args.reads)
+        measure('lsm, spread keys', disk, spread, args.reads)
+        disk.close()
@@ -0,0 +1,54 @@
+"""Measures store throughput, in operations per second, against the number of
+shards. Each worker thread runs a mix of reads and writes over its own keys,
+as appliers and readers in a thread pool would. With the GIL the gain comes
+from lower lock contention; on a free-threaded build it should also scale
+with cores.
+
+usage: python benchmarks/store_shards.py [--ops N] [--workers 8]
+    [--shards 1,4,16,64] [--read-ratio 0.8]
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from store import Store  # noqa
+
+
+def run(shards: int, workers: int, ops: int, read_ratio: float):
+    s = Store(shards)
+    per_worker = ops // workers
+
+    def work(w: int):
+        rng = random.Random(w)
+        keys = [f'{w}-{i}' for i in range(1000)]
+        for _ in range(per_worker):
+            key = rng.choice(keys)
+            if rng.random() < read_ratio:
+                s.read(key)
+            else:
+                s.upsert(key, 'v' * 100)
+
+    threads = [threading.Thread(target=work, args=(w,))
+               for w in range(workers)]
+    start = time.perf_counter()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = time.perf_counter() - start
+    print(f"shards={shards:<4} workers={workers:<3} "
+          f"{per_worker * workers / elapsed:>12,.0f} ops/s")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ops', type=int, default=400000)
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--shards', default='1,4,16,64')
+    parser.add_argument('--read-ratio', type=float, default=0.8)
+    args = parser.parse_args()
+    for n in [int(x) for x in args.shards.split(',')]:
+        run(n, args.workers, args.ops, args.read_ratio)
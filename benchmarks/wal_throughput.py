@@ -0,0 +1,51 @@
+"""Measures write-ahead log throughput, in entries per second, with and
+without fsync. Each writer thread appends one entry at a time and waits for it
+to become durable, as an RPC handler would, so the fsync-on numbers show how
+much group commit recovers as concurrency increases.
+
+usage: python benchmarks/wal_throughput.py [--entries N] [--writers 1,4,16]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from raft import Entry, Op, encode_entry  # noqa
+from wal import WriteAheadLog  # noqa
+
+
+def run(directory: str, fsync: bool, writers: int, entries: int):
+    w = WriteAheadLog(os.path.join(directory, f'wal-{fsync}-{writers}'), fsync)
+    record = encode_entry(
+        Entry(op=Op.WRITE, key='key', value='v' * 100, term=1))
+    per_writer = entries // writers
+
+    def write():
+        for _ in range(per_writer):
+            w.sync(w.append(record))
+
+    threads = [threading.Thread(target=write) for _ in range(writers)]
+    start = time.perf_counter()
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    elapsed = time.perf_counter() - start
+    w.close()
+    total = per_writer * writers
+    print(f"fsync={'on ' if fsync else 'off'} writers={writers:<3} "
+          f"{total / elapsed:>12,.0f} entries/s  "
+          f"{total / max(w.syncs, 1):>8.1f} entries/flush")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--entries', type=int, default=5000)
+    parser.add_argument('--writers', default='1,4,16')
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as d:
+        for fsync in (True, False):
+            for n in [int(x) for x in args.writers.split(',')]:
+                run(d, fsync, n, args.entries)
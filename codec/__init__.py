@@ -0,0 +1,236 @@
+import json
+import struct
+from typing import Iterator, List, Tuple
+
+from raft import AppendResult, Entry, VoteResult, decode_entry, encode_entry
+
+# Compact binary framing for the raft RPCs, used in place of JSON when a
+# request is sent with this content type. Every message is a fixed-size
+# header, then length-prefixed strings, then (for AppendEntries) each entry
+# as a length-prefixed `raft.encode_entry` record, back to back.
+CONTENT_TYPE = 'application/x-rsb-raft'
+
+# term, prev log index, prev log term, leader commit, entry count
+_APPEND = struct.Struct('<qqqqI')
+# term, last log index, last log term
+_VOTE = struct.Struct('<qqq')
+# term, success / vote granted
+_RESULT = struct.Struct('<q?')
+# an AppendEntries result carries the conflict hints after the term and
+# success flag
+_CONFLICT = struct.Struct('<qq')
+_STR = struct.Struct('<H')
+_LEN = struct.Struct('<I')
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def _pack_str(s: str) -> bytes:
+    b = s.encode()
+    return _STR.pack(len(b)) + b
+
+
+def _unpack_str(buf: bytes, offset: int) -> tuple[str, int]:
+    (length,) = _STR.unpack_from(buf, offset)
+    offset += _STR.size
+    return buf[offset:offset + length].decode(), offset + length
+
+
+def encode_append(
+        term: int,
+        leader_id: str,
+        prev_log_index: int,
+        prev_log_term: int,
+        entries: List[Entry],
+        leader_commit: int
+) -> bytes:
+    parts = [
+        _APPEND.pack(term, prev_log_index, prev_log_term, leader_commit,
+                     len(entries)),
+        _pack_str(leader_id)]
+    for entry in entries:
+        record = encode_entry(entry)
+        parts.append(_LEN.pack(len(record)))
+        parts.append(record)
+    return b''.join(parts)
+
+
+def decode_append(buf: bytes) -> dict:
+    """Returns the arguments of `raft.State.append_entries`"""
+    try:
+        term, prev_log_index, prev_log_term, leader_commit, count = (
+            _APPEND.unpack_from(buf))
+        leader_id, offset = _unpack_str(buf, _APPEND.size)
+        entries = list()
+        for _ in range(count):
+            (length,) = _LEN.unpack_from(buf, offset)
+            offset += _LEN.size
+            if offset + length > len(buf):
+                raise DecodeError('truncated entry')
+            entries.append(decode_entry(buf, offset))
+            offset += length
+    except (struct.error, UnicodeDecodeError, IndexError) as e:
+        raise DecodeError(f'malformed AppendEntries: {e}') from e
+    return dict(
+        term=term,
+        leader_id=leader_id,
+        prev_log_index=prev_log_index,
+        prev_log_term=prev_log_term,
+        entries=entries,
+        leader_commit=leader_commit)
+
+
+def encode_append_result(result: AppendResult) -> bytes:
+    return (_RESULT.pack(result.term, result.success)
+            + _CONFLICT.pack(result.conflict_term, result.conflict_index))
+
+
+def decode_append_result(buf: bytes) -> AppendResult:
+    try:
+        term, success = _RESULT.unpack_from(buf)
+        # results from nodes that send no hints end after the flag
+        if len(buf) > _RESULT.size:
+            conflict_term, conflict_index = _CONFLICT.unpack_from(
+                buf, _RESULT.size)
+        else:
+            conflict_term, conflict_index = 0, -1
+    except struct.error as e:
+        raise DecodeError(f'malformed AppendEntries result: {e}') from e
+    return AppendResult(term, success, conflict_term, conflict_index)
+
+
+def encode_vote(
+        term: int,
+        candidate_id: str,
+        last_log_index: int,
+        last_log_term: int
+) -> bytes:
+    return (_VOTE.pack(term, last_log_index, last_log_term)
+            + _pack_str(candidate_id))
+
+
+def decode_vote(buf: bytes) -> dict:
+    """Returns the arguments of `raft.State.request_vote`"""
+    try:
+        term, last_log_index, last_log_term = _VOTE.unpack_from(buf)
+        candidate_id, _ = _unpack_str(buf, _VOTE.size)
+    except (struct.error, UnicodeDecodeError) as e:
+        raise DecodeError(f'malformed RequestVote: {e}') from e
+    return dict(
+        term=term,
+        candidate_id=candidate_id,
+        last_log_index=last_log_index,
+        last_log_term=last_log_term)
+
+
+def encode_vote_result(result: VoteResult) -> bytes:
+    return _RESULT.pack(result.term, result.vote_granted)
+
+
+def decode_vote_result(buf: bytes) -> VoteResult:
+    try:
+        term, granted = _RESULT.unpack_from(buf)
+    except struct.error as e:
+        raise DecodeError(f'malformed RequestVote result: {e}') from e
+    return VoteResult(term=term, vote_granted=granted)
+
+
+# Bulk imports (`POST /import`) are a stream of key-value pairs, either as
+# NDJSON, one `{"key": ..., "value": ...}` object per line, or with this
+# content type, as records of a key length and a value length, then the
+# UTF-8 key and value, back to back.
+IMPORT_CONTENT_TYPE = 'application/x-rsb-import'
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+# key length, value length
+_PAIR = struct.Struct('<II')
+# no partial record may grow larger than this, so that a malformed stream
+# cannot use up memory
+MAX_IMPORT_RECORD = 1 << 24
+
+
+def encode_import(pairs: List[Tuple[str, str]]) -> bytes:
+    parts = list()
+    for key, value in pairs:
+        k, v = key.encode(), value.encode()
+        parts.append(_PAIR.pack(len(k), len(v)))
+        parts.append(k)
+        parts.append(v)
+    return b''.join(parts)
+
+
+def encode_ndjson(pairs: List[Tuple[str, str]]) -> bytes:
+    return b''.join(
+        json.dumps(dict(key=key, value=value)).encode() + b'\n'
+        for key, value in pairs)
+
+
+class ImportDecoder:
+    """
+    Decodes a bulk import incrementally, as its chunks arrive
+
+    `feed` yields the pairs completed by a chunk, and keeps any partial
+    record for the next. Every pair before a malformed record is yielded
+    before the `DecodeError`. `finish` checks that nothing is left over at
+    the end of the stream. Values must not be empty.
+    """
+    def __init__(self, binary: bool):
+        self.binary = binary
+        self._buf = bytearray()
+
+    def feed(self, chunk: bytes) -> Iterator[Tuple[str, str]]:
+        self._buf += chunk
+        yield from self._binary() if self.binary else self._lines()
+        if len(self._buf) > MAX_IMPORT_RECORD:
+            raise DecodeError(
+                f'import record over {MAX_IMPORT_RECORD} bytes')
+
+    def finish(self) -> Iterator[Tuple[str, str]]:
+        if not self.binary and self._buf.strip():
+            # the last line need not end with a newline
+            self._buf += b'\n'
+            yield from self._lines()
+        if self._buf:
+            raise DecodeError('truncated import record')
+
+    def _binary(self) -> Iterator[Tuple[str, str]]:
+        offset = 0
+        buf = self._buf
+        try:
+            while len(buf) - offset >= _PAIR.size:
+                k, v = _PAIR.unpack_from(buf, offset)
+                end = offset + _PAIR.size + k + v
+                if end > len(buf):
+                    break
+                start = offset + _PAIR.size
+                try:
+                    pair = _pair(
+                        buf[start:start + k].decode(),
+                        buf[start + k:end].decode())
+                except UnicodeDecodeError as e:
+                    raise DecodeError(f'malformed import record: {e}') from e
+                offset = end
+                yield pair
+        finally:
+            del buf[:offset]
+
+    def _lines(self) -> Iterator[Tuple[str, str]]:
+        end = self._buf.rfind(b'\n') + 1
+        lines = bytes(self._buf[:end]).splitlines()
+        del self._buf[:end]
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                pair = _pair(record['key'], record['value'])
+            except (ValueError, TypeError, KeyError) as e:
+                raise DecodeError(f'malformed import line: {e}') from e
+            yield pair
+
+
+def _pair(key, value) -> Tuple[str, str]:
+    if not isinstance(key, str) or not isinstance(value, str) or not value:
+        raise DecodeError(f'import values must be non-empty strings: {key!r}')
+    return key, value
@@ -0,0 +1,81 @@
+import lzma
+import os
+import time
+import zlib
+from typing import Callable, Dict, Tuple
+
+from metrics import Metrics
+
+# A compressed value is bytes: a tag naming the algorithm, then the
+# compressed UTF-8 text. Values are only ever compressed or decompressed by
+# these functions, and everywhere else (the log, the wire, the store and
+# snapshots) a `bytes` value is carried as it is.
+_ALGORITHMS: Dict[str, Tuple[int, Callable[[bytes], bytes]]] = {
+    'zlib': (1, zlib.compress),
+    'lzma': (2, lzma.compress),
+}
+_DECOMPRESS: Dict[int, Callable[[bytes], bytes]] = {
+    1: zlib.decompress,
+    2: lzma.decompress,
+}
+
+
+class Compressor:
+    """
+    Compresses values of `min_bytes` or more with `algorithm`: `zlib`,
+    `lzma`, or `none`
+
+    A value that does not shrink is left as it is, as text. Values compressed
+    by any algorithm can be decompressed whatever this node's setting, so that
+    the nodes of a cluster need not agree on it. The bytes in and out of
+    compression, and the time spent either way, are recorded in `metrics`.
+    """
+    def __init__(
+            self,
+            algorithm: str | None = None,
+            min_bytes: int | None = None,
+            metrics: Metrics | None = None
+    ):
+        if algorithm is None:
+            algorithm = os.environ.get('RSB_COMPRESSION', 'none')
+        if min_bytes is None:
+            min_bytes = int(os.environ.get('RSB_COMPRESSION_MIN_BYTES', 1024))
+        if algorithm != 'none' and algorithm not in _ALGORITHMS:
+            raise ValueError(f"unknown compression algorithm: {algorithm}")
+        self.algorithm = algorithm
+        self.min_bytes = min_bytes
+        self.metrics = metrics or Metrics()
+        self._input_bytes = 0
+        self._output_bytes = 0
+
+    def compress(self, value: str) -> str | bytes:
+        if self.algorithm == 'none' or len(value) < self.min_bytes:
+            return value
+        tag, compress = _ALGORITHMS[self.algorithm]
+        started = time.perf_counter()
+        raw = value.encode()
+        packed = bytes((tag,)) + compress(raw)
+        self.metrics.observe(
+            'compression_seconds', time.perf_counter() - started)
+        if len(packed) >= len(raw):
+            self.metrics.inc('compression_skipped')
+            return value
+        self._input_bytes += len(raw)
+        self._output_bytes += len(packed)
+        self.metrics.inc('compression_input_bytes', len(raw))
+        self.metrics.inc('compression_output_bytes', len(packed))
+        self.metrics.set(
+            'compression_ratio', self._output_bytes / self._input_bytes)
+        return packed
+
+    def decompress(self, value: str | bytes) -> str:
+        if isinstance(value, str):
+            return value
+        started = time.perf_counter()
+        try:
+            raw = _DECOMPRESS[value[0]](value[1:])
+        except (KeyError, IndexError, zlib.error, lzma.LZMAError) as e:
+            raise ValueError(f"malformed compressed value: {e}") from e
+        self.metrics.observe(
+            'decompression_seconds', time.perf_counter() - started)
+        return raw.decode()
@@ -0,0 +1,269 @@
+import asyncio
+import os
+import random
+import time
+from typing import Callable, Dict
+
+import httpx
+
+import codec
+from raft import NotLeaderException, Role, State, VoteResult, batch_entry
+from replication import Replicator, _client
+
+
+class Elector:
+    """
+    Leader election
+
+    A node that has heard from neither a leader nor a candidate it voted for
+    within its election timeout stands for election in the next term. The
+    timeout is drawn afresh each time from [`election_timeout`,
+    2 * `election_timeout`) seconds, so that nodes seldom time out together
+    and split the vote. The candidate asks every other node for its vote at
+    once, each request with a deadline of `vote_timeout` seconds, and takes
+    over as soon as a majority has granted it, without waiting on the rest.
+    As leader, the `Replicator` sends the heartbeats that keep the other
+    nodes from starting elections of their own. See the 'Leader election'
+    section of the raft paper.
+
+    Before it bumps its term, a node first asks, in a pre-vote round, whether
+    a majority would vote for it. Nodes that still hear from a leader say no,
+    so a node that is cut off on its own, or rejoins after a partition,
+    cannot force a working leader to step down. And a leader that has not
+    heard from a majority for an election timeout steps down by itself
+    (check-quorum), rather than keep accepting writes it cannot commit.
+
+    Where nodes share the leadership of many groups, each group names a
+    `preferred` node. The others wait an extra election timeout before
+    standing, and a leader hands over to the preferred node, once it has
+    caught up, by telling it to stand at once (TimeoutNow, see the
+    'Leadership transfer extension' section of the raft dissertation).
+    """
+    def __init__(
+            self,
+            state: State,
+            replicator: Replicator,
+            election_timeout: float | None = None,
+            vote_timeout: float | None = None,
+            binary: bool | None = None,
+            client_factory: Callable[[str], httpx.AsyncClient] | None = None,
+            preferred: str | None = None
+    ):
+        self.state = state
+        # the address of the node that should lead, when it can
+        self.preferred = preferred
+        self.replicator = replicator
+        if election_timeout is None:
+            election_timeout = int(
+                os.environ.get('RSB_ELECTION_TIMEOUT_MS', 150)) / 1000
+        self.election_timeout = election_timeout
+        # a vote that takes longer than this would come too late to matter
+        self.vote_timeout = vote_timeout or election_timeout / 2
+        self.binary = replicator.binary if binary is None else binary
+        # dependency injection primarily for test setup
+        self.client_factory = client_factory or (
+            lambda address: _client(address, 1, self.vote_timeout))
+
+        self._clients: Dict[str, httpx.AsyncClient] = dict()
+        self._task: asyncio.Task | None = None
+        self._noop: asyncio.Task | None = None
+        # the election timer also restarts when this node starts or stands
+        self._timer_reset = 0.0
+        self._wake = asyncio.Event()
+        # stand at the next chance, without a pre-vote
+        self._forced = False
+        self._handed_over = 0.0
+        # when check-quorum last looked (see `_check_quorum`)
+        self._quorum_checked = 0.0
+        self._rng = random.Random()
+
+    # ----- lifecycle -----
+    def start(self):
+        if self._task is None or self._task.done():
+            self._timer_reset = time.monotonic()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        tasks = [t for t in (self._task, self._noop) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._noop = None
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = dict()
+
+    def timeout_now(self, term: int, leader_id: str):
+        """Stands for election at once, without a pre-vote, as the leader of
+        `term` hands over leadership to this node. The request is ignored
+        unless it comes from the leader this node follows."""
+        state = self.state
+        if (term == state.current_term and state.role == Role.FOLLOWER
+                and leader_id == state.leader_id):
+            self._forced = True
+            self._wake.set()
+
+    def _client(self, address: str) -> httpx.AsyncClient:
+        if address not in self._clients:
+            self._clients[address] = self.client_factory(address)
+        return self._clients[address]
+
+    # ----- election timer -----
+    def _last_contact(self) -> float:
+        return max(
+            self.state.last_heartbeat, self.state.voted_at, self._timer_reset)
+
+    async def _run(self):
+        state = self.state
+        while True:
+            if state.role == Role.LEADER:
+                while state.role == Role.LEADER:
+                    # restarts replication if it stopped, say after a step
+                    # down and re-election
+                    self.replicator.start()
+                    await asyncio.sleep(self.replicator.heartbeat_interval)
+                    self._check_quorum()
+                    await self._hand_over()
+                # a deposed leader gives the new one a full timeout to make
+                # contact
+                self._timer_reset = time.monotonic()
+                continue
+            timeout = self._rng.uniform(
+                self.election_timeout, 2 * self.election_timeout)
+            if self.preferred and self.preferred != state.address:
+                # give the preferred node a head start
+                timeout += self.election_timeout
+            while not self._forced and (wait := self._last_contact()
+                                        + timeout - time.monotonic()) > 0:
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                if state.role == Role.LEADER:
+                    break
+            else:
+                await self._campaign()
+
+    def _check_quorum(self):
+        """Steps down if no majority has answered a request sent in the last
+        election timeout. The check is made once per timeout, so that a stall
+        of the event loop leaves replication time to catch up first."""
+        state = self.state
+        now = time.monotonic()
+        if now - self._quorum_checked < self.election_timeout:
+            return
+        since, self._quorum_checked = self._quorum_checked, now
+        if (state.role == Role.LEADER
+                and self.replicator.quorum_ack_time() < since):
+            state.abdicate()
+            state.metrics.inc('check_quorum_step_downs')
+
+    async def _hand_over(self):
+        """Tells the preferred node to stand for election, once it has every
+        entry, at most once per election timeout. Proposals are refused from
+        then until the timeout has passed, so that the node stays caught up,
+        unless the request fails (see `Replicator.begin_transfer`)."""
+        state = self.state
+        node = state.foreign_nodes.get(self.preferred or '')
+        now = time.monotonic()
+        if (node is None or state.role != Role.LEADER
+                or node.match_index < len(state.log) - 1
+                or now - self._handed_over < self.election_timeout):
+            return
+        self._handed_over = now
+        self.replicator.begin_transfer(self.election_timeout)
+        try:
+            res = await asyncio.wait_for(
+                self._client(self.preferred).post('/rpc/timeout', json=dict(
+                    term=state.current_term, leader_id=state.address)),
+                self.vote_timeout)
+            res.raise_for_status()
+        except (httpx.HTTPError, asyncio.TimeoutError):
+            self.replicator.end_transfer()
+            return
+        state.metrics.inc('leadership_transfers')
+
+    # ----- candidate -----
+    async def _campaign(self):
+        state = self.state
+        started = self._timer_reset = time.monotonic()
+        quorum = (len(state.foreign_nodes) + 1) // 2 + 1
+        forced, self._forced = self._forced, False
+        if not forced:
+            votes = await self._poll(
+                '/rpc/prevote', state.vote_request(state.current_term + 1),
+                quorum)
+            # or a leader or candidate was heard from while it was taken
+            if votes < quorum or self._last_contact() > started:
+                state.metrics.inc('prevotes_lost')
+                return
+        args = state.become_candidate()
+        await asyncio.to_thread(state.persist)
+        state.metrics.inc('elections_started')
+        votes = await self._poll('/rpc/vote', args, quorum)
+        # a leader for this term may have been heard from in the meantime
+        if (votes < quorum or state.role != Role.CANDIDATE
+                or state.current_term != args['term']):
+            return
+        state.become_leader()
+        self._quorum_checked = time.monotonic()
+        state.metrics.inc('elections_won')
+        state.metrics.observe('election_seconds', time.monotonic() - started)
+        self.replicator.start()
+        self._noop = asyncio.create_task(self._commit_noop(args['term']))
+
+    async def _poll(self, path: str, args: dict, quorum: int) -> int:
+        """Asks every other node for its vote (or pre-vote) at once, and
+        returns the number granted, this node's included, once there are
+        enough or every request has been answered or timed out"""
+        state = self.state
+        votes = 1
+        pending = {asyncio.create_task(self._request_vote(path, address, args))
+                   for address in state.foreign_nodes}
+        try:
+            while pending and votes < quorum:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for request in done:
+                    try:
+                        res = request.result()
+                    except (httpx.HTTPError, ValueError,
+                            asyncio.TimeoutError):
+                        continue
+                    # a pre-vote from a newer term is left for that term's
+                    # leader to bring this node up to date
+                    if path == '/rpc/vote' and res.term > state.current_term:
+                        state.step_down(res.term)
+                        return 0
+                    if res.vote_granted and res.term <= args['term']:
+                        votes += 1
+        finally:
+            for request in pending:
+                request.cancel()
+        return votes
+
+    async def _request_vote(
+            self, path: str, address: str, args: dict) -> VoteResult:
+        client = self._client(address)
+        if self.binary:
+            send = client.post(
+                path,
+                content=codec.encode_vote(**args),
+                headers={'content-type': codec.CONTENT_TYPE})
+        else:
+            send = client.post(path, json=args)
+        res = await asyncio.wait_for(send, self.vote_timeout)
+        res.raise_for_status()
+        if self.binary:
+            return codec.decode_vote_result(res.content)
+        data = res.json()
+        return VoteResult(term=data['term'], vote_granted=data['vote_granted'])
+
+    async def _commit_noop(self, term: int):
+        """Commits an empty entry from the new term, which commits every
+        entry from earlier terms along with it"""
+        try:
+            await self.replicator.propose([batch_entry([], term)])
+        except NotLeaderException:
+            pass
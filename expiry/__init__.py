@@ -0,0 +1,121 @@
+import itertools
+from typing import Dict, List, Tuple
+
+
+class TimingWheel:
+    """
+    Deadlines for a set of keys, kept in a hierarchical timing wheel
+
+    Time is counted in ticks of `tick` milliseconds. Each of the `levels`
+    wheels has `slots` buckets, and a bucket on level n holds the keys due in
+    one span of `slots ** n` ticks. Scheduling or cancelling a key touches one
+    bucket, whatever its deadline. As time advances, the level 0 bucket for
+    each tick expires its keys, and whenever a level wraps around, the next
+    bucket of the level above is cascaded down into the levels below. See
+    Varghese and Lauck, 'Hashed and Hierarchical Timing Wheels'.
+
+    A key whose deadline has passed is "due", and stays due until it is
+    cancelled or rescheduled, so that a caller can retry acting on it.
+    """
+    def __init__(
+            self,
+            tick: int = 100,
+            slots: int = 64,
+            levels: int = 4,
+            now: int = 0
+    ):
+        if slots & (slots - 1):
+            raise ValueError(f"slots must be a power of 2, not {slots}")
+        self.tick = tick
+        self._bits = slots.bit_length() - 1
+        self._mask = slots - 1
+        self._levels = levels
+        self._wheels: List[List[Dict[str, int]]] = [
+            [dict() for _ in range(slots)] for _ in range(levels)]
+        # the bucket each scheduled key is in, as (level, slot)
+        self._where: Dict[str, Tuple[int, int]] = dict()
+        self._deadlines: Dict[str, int] = dict()
+        self._due: Dict[str, int] = dict()
+        # every tick up to and including this one has been processed
+        self._current = now // tick
+
+    def __len__(self) -> int:
+        return len(self._deadlines)
+
+    def deadline(self, key: str) -> int | None:
+        """Returns the deadline of `key`, in milliseconds, if it has one"""
+        return self._deadlines.get(key)
+
+    def items(self) -> Dict[str, int]:
+        """Returns every key with a deadline, due or not"""
+        return dict(self._deadlines)
+
+    def schedule(self, key: str, deadline: int):
+        """Sets (or replaces) the deadline of `key`, in milliseconds"""
+        self.cancel(key)
+        self._deadlines[key] = deadline
+        self._place(key, deadline)
+
+    def cancel(self, key: str):
+        """Removes the deadline of `key`, if it has one"""
+        if self._deadlines.pop(key, None) is None:
+            return
+        self._due.pop(key, None)
+        where = self._where.pop(key, None)
+        if where:
+            level, slot = where
+            del self._wheels[level][slot][key]
+
+    def clear(self):
+        for key in list(self._deadlines):
+            self.cancel(key)
+
+    def _place(self, key: str, deadline: int):
+        # round up, so that no key is due before its deadline
+        t = -(-deadline // self.tick)
+        delta = t - self._current
+        if delta <= 0:
+            self._due[key] = deadline
+            return
+        span = 1 << (self._bits * self._levels)
+        if delta >= span:
+            # beyond the top level -- park the key in the furthest bucket,
+            # and place it again when that bucket is cascaded
+            t = self._current + span - 1
+            delta = span - 1
+        level = 0
+        while delta >= 1 << (self._bits * (level + 1)):
+            level += 1
+        slot = (t >> (self._bits * level)) & self._mask
+        self._wheels[level][slot][key] = deadline
+        self._where[key] = (level, slot)
+
+    def due(self, limit: int | None = None) -> List[Tuple[str, int]]:
+        """Returns up to `limit` due keys, with their deadlines"""
+        return list(itertools.islice(self._due.items(), limit))
+
+    def advance(self, now: int):
+        """Moves the wheel on to `now`, in milliseconds"""
+        target = now // self.tick
+        while self._current < target:
+            if not self._where:
+                # nothing left in the wheel to cascade or expire
+                self._current = target
+                break
+            self._current += 1
+            t = self._current
+            for level in range(1, self._levels):
+                if t & ((1 << (self._bits * level)) - 1):
+                    break
+                slot = (t >> (self._bits * level)) & self._mask
+                bucket = self._wheels[level][slot]
+                self._wheels[level][slot] = dict()
+                for key, deadline in bucket.items():
+                    del self._where[key]
+                    self._place(key, deadline)
+            slot = t & self._mask
+            bucket = self._wheels[0][slot]
+            self._wheels[0][slot] = dict()
+            for key, deadline in bucket.items():
+                del self._where[key]
+                self._due[key] = deadline
@@ -0,0 +1,421 @@
+import mmap
+import os
+import struct
+import threading
+from array import array
+from typing import Callable, Generic, Iterator, List, TypeVar
+from wal import WriteAheadLog, read_record
+
+T = TypeVar('T')
+
+# each entry of a segment's index file is the offset of a record in the
+# segment, and the term of its entry
+_INDEX = struct.Struct('<Qq')
+
+
+def _fsync_dir(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Segment(Generic[T]):
+    """
+    A run of consecutive log entries, starting at log index `base`
+
+    The segment that is currently being appended to (the "active" segment)
+    keeps its decoded entries in memory, along with the file offset and term
+    of each one. Once full, a segment is sealed: the offsets and terms are
+    written to an index file, and both files are memory-mapped so that reads
+    cost a lookup in the page cache rather than heap space for decoded
+    entries. The term of an entry is read from the index, without decoding
+    the entry.
+    """
+    def __init__(self, directory: str, base: int):
+        self.base = base
+        self.path = os.path.join(directory, f'{base:020d}.log')
+        self.index_path = os.path.join(directory, f'{base:020d}.index')
+        # -- active segment --
+        self.wal: WriteAheadLog | None = None
+        self.offsets: array = array('Q')
+        self.terms: array = array('q')
+        self.entries: List[T] = list()
+        # -- sealed segment --
+        self.data: mmap.mmap | None = None
+        self.index: mmap.mmap | None = None
+        self.count = 0
+
+    def open(
+            self,
+            decode: Callable[[bytes], T],
+            term: Callable[[T], int],
+            fsync: bool
+    ):
+        """Opens the segment for appending, recovering any entries it holds"""
+        self.wal = WriteAheadLog(self.path, fsync)
+        for offset, payload in self.wal.records():
+            entry = decode(payload)
+            self.offsets.append(offset)
+            self.terms.append(term(entry))
+            self.entries.append(entry)
+        self.count = len(self.offsets)
+
+    def seal(self):
+        """Makes the segment durable and read-only, and drops its entries from
+        the heap. The entries stay readable throughout, so this may run in
+        another thread."""
+        assert self.wal is not None
+        self.wal.close()
+        with open(self.index_path, 'wb') as f:
+            f.write(b''.join(
+                _INDEX.pack(offset, term)
+                for offset, term in zip(self.offsets, self.terms)))
+            f.flush()
+            os.fsync(f.fileno())
+        self.map()
+        # readers switch to the maps before the entries go
+        self.wal = None
+        self.offsets = array('Q')
+        self.terms = array('q')
+        self.entries = list()
+
+    def map(self):
+        self.count = os.path.getsize(self.index_path) // _INDEX.size
+        with open(self.index_path, 'rb') as f:
+            self.index = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with open(self.path, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def unseal(
+            self,
+            decode: Callable[[bytes], T],
+            term: Callable[[T], int],
+            fsync: bool
+    ):
+        """Reopens a sealed segment for appending, e.g.: to truncate it"""
+        self.close()
+        os.remove(self.index_path)
+        self.open(decode, term, fsync)
+
+    def offset(self, i: int) -> int:
+        if self.index is not None:
+            return int(_INDEX.unpack_from(self.index, i * _INDEX.size)[0])
+        return int(self.offsets[i])
+
+    def term(self, i: int) -> int:
+        if self.index is not None:
+            return int(_INDEX.unpack_from(self.index, i * _INDEX.size)[1])
+        return int(self.terms[i])
+
+    def close(self):
+        if self.wal:
+            self.wal.close()
+            self.wal = None
+        if self.data:
+            self.data.close()
+            self.data = None
+        if self.index:
+            self.index.close()
+            self.index = None
+
+    def remove(self):
+        self.close()
+        for path in (self.path, self.index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class MemoryLog(Generic[T]):
+    """
+    An in-memory log of entries, indexed by log index
+
+    This behaves like a `list` whose first `first_index` items have been
+    compacted away: `len` is one past the last log index, and indexing below
+    `first_index` raises `IndexError`. Only suffix truncation, with
+    `del log[index:]`, is supported.
+
+    Entries are not kept as Python objects. The log is stored in columns: an
+    array of terms, so that term lookups never decode an entry, and the
+    encoded entries packed back to back in a single buffer, with an array of
+    their offsets. Each entry costs 16 bytes plus its encoding, rather than an
+    object, its attributes and their strings. Entries are decoded on access,
+    in place: `decode` is given the buffer and the offset of the entry, so
+    the encoding must tell where the entry ends.
+    """
+    def __init__(
+            self,
+            encode: Callable[[T], bytes],
+            decode: Callable[[bytearray, int], T],
+            term: Callable[[T], int]
+    ):
+        self.encode = encode
+        self.decode = decode
+        self.term_of = term
+        self.first_index = 0
+        self._terms = array('q')
+        self._offsets = array('Q')
+        self._buf = bytearray()
+        # offsets are never rewritten -- compaction drops the front of the
+        # buffer and advances this instead
+        self._shift = 0
+
+    def __len__(self) -> int:
+        return self.first_index + len(self._terms)
+
+    def _pos(self, i: int) -> int:
+        pos = i - self.first_index if i >= 0 else i + len(self._terms)
+        if not 0 <= pos < len(self._terms):
+            raise IndexError('log index out of range')
+        return pos
+
+    def _get(self, pos: int) -> T:
+        return self.decode(self._buf, self._offsets[pos] - self._shift)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            start = max(start, self.first_index)
+            return [self._get(j - self.first_index)
+                    for j in range(start, stop, step)]
+        return self._get(self._pos(i))
+
+    def term(self, i: int) -> int:
+        """Returns the term of the entry at `i`, without decoding it"""
+        pos = i - self.first_index
+        if pos < 0:
+            raise IndexError('log index out of range')
+        return self._terms[pos]
+
+    def __iter__(self) -> Iterator[T]:
+        for pos in range(len(self._terms)):
+            yield self._get(pos)
+
+    def append(self, entry: T):
+        self._terms.append(self.term_of(entry))
+        self._offsets.append(len(self._buf) + self._shift)
+        self._buf += self.encode(entry)
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def __delitem__(self, i):
+        if not isinstance(i, slice) or i.stop is not None or i.step:
+            raise TypeError('only `del log[index:]` is supported')
+        index = i.start or 0
+        if index < self.first_index:
+            raise IndexError('cannot truncate entries that were compacted')
+        pos = index - self.first_index
+        if pos < len(self._terms):
+            del self._buf[self._offsets[pos] - self._shift:]
+            del self._offsets[pos:]
+            del self._terms[pos:]
+
+    def compact(self, index: int):
+        """Discards the entries up to and including `index`, which must
+        already be covered by a snapshot"""
+        count = min(index + 1 - self.first_index, len(self._terms))
+        if count <= 0:
+            return
+        if count < len(self._terms):
+            end = self._offsets[count]
+        else:
+            end = len(self._buf) + self._shift
+        del self._buf[:end - self._shift]
+        self._shift = end
+        del self._offsets[:count]
+        del self._terms[:count]
+        self.first_index += count
+
+    def reset(self, first_index: int):
+        """Discards every entry, so that the next entry appended is at
+        `first_index`"""
+        self._terms = array('q')
+        self._offsets = array('Q')
+        self._buf = bytearray()
+        self._shift = 0
+        self.first_index = first_index
+
+
+class SegmentedLog(Generic[T]):
+    """
+    An on-disk log of entries, split into segment files of a fixed number of
+    entries
+
+    This is a drop-in replacement for `MemoryLog`: it supports `len`, indexing
+    and slicing by log index, `append`, `extend`, truncation with
+    `del log[index:]` and compaction. Because every segment holds the same
+    number of entries, finding the segment for an index is a division, and
+    finding the entry within the segment is a lookup in its offset index, so
+    random access is O(1). Only the active (last) segment is held in memory.
+
+    Entries are stored as opaque records -- `encode` and `decode` convert
+    between entries and bytes. Appends are buffered; call `sync` to make them
+    durable. A segment that fills up is sealed by the next `sync`, rather
+    than by the `append` that filled it, so that a caller that syncs in
+    another thread keeps the fsyncs that sealing takes off its own. Changes
+    to sealed segments (truncation, compaction) wait for any seal in
+    progress.
+    """
+    def __init__(
+            self,
+            directory: str,
+            encode: Callable[[T], bytes],
+            decode: Callable[[bytes], T],
+            term: Callable[[T], int],
+            entries_per_segment: int = 1 << 16,
+            fsync: bool = True
+    ):
+        self.directory = directory
+        self.encode = encode
+        self.decode = decode
+        self.term_of = term
+        self.entries_per_segment = entries_per_segment
+        self.fsync = fsync
+        os.makedirs(directory, exist_ok=True)
+
+        # held while segments are sealed, and while sealed segments change
+        self._lock = threading.Lock()
+        self._segments: List[_Segment[T]] = list()
+        bases = sorted(
+            int(name.split('.')[0]) for name in os.listdir(directory)
+            if name.endswith('.log'))
+        for base in bases:
+            segment: _Segment[T] = _Segment(directory, base)
+            if base != bases[-1] and os.path.exists(segment.index_path):
+                segment.map()
+            else:
+                # either the active segment, or a segment that crashed before
+                # its index was written
+                segment.open(decode, term, fsync)
+                if base != bases[-1]:
+                    segment.seal()
+            self._segments.append(segment)
+        if not self._segments:
+            self._add_segment(0)
+
+    def _add_segment(self, base: int):
+        segment: _Segment[T] = _Segment(self.directory, base)
+        segment.open(self.decode, self.term_of, self.fsync)
+        self._segments.append(segment)
+        if self.fsync:
+            _fsync_dir(self.directory)
+
+    @property
+    def first_index(self) -> int:
+        """The index of the oldest entry still held by the log"""
+        return self._segments[0].base
+
+    def __len__(self) -> int:
+        last = self._segments[-1]
+        return last.base + last.count
+
+    def _locate(self, i: int) -> tuple[_Segment[T], int]:
+        if i < 0:
+            i += len(self)
+        if not self.first_index <= i < len(self):
+            raise IndexError('log index out of range')
+        pos = (i - self.first_index) // self.entries_per_segment
+        segment = self._segments[pos]
+        return segment, i - segment.base
+
+    def _get(self, i: int) -> T:
+        segment, pos = self._locate(i)
+        data = segment.data
+        if data is None:
+            return segment.entries[pos]
+        return self.decode(read_record(data, segment.offset(pos)))
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            start, stop, step = i.indices(len(self))
+            start = max(start, self.first_index)
+            return [self._get(j) for j in range(start, stop, step)]
+        return self._get(i)
+
+    def term(self, i: int) -> int:
+        """Returns the term of the entry at `i`, without decoding it"""
+        segment, pos = self._locate(i)
+        return segment.term(pos)
+
+    def __iter__(self) -> Iterator[T]:
+        for i in range(self.first_index, len(self)):
+            yield self._get(i)
+
+    def append(self, entry: T):
+        active = self._segments[-1]
+        if active.count == self.entries_per_segment:
+            # left for `sync` to seal
+            self._add_segment(active.base + active.count)
+            active = self._segments[-1]
+        assert active.wal is not None
+        active.offsets.append(active.wal.size)
+        active.terms.append(self.term_of(entry))
+        active.wal.append(self.encode(entry))
+        active.entries.append(entry)
+        active.count += 1
+
+    def extend(self, entries):
+        for entry in entries:
+            self.append(entry)
+
+    def __delitem__(self, i):
+        """Only suffix truncation, `del log[index:]`, is supported"""
+        if not isinstance(i, slice) or i.stop is not None or i.step:
+            raise TypeError('only `del log[index:]` is supported')
+        index = i.start or 0
+        if index >= len(self):
+            return
+        if index < self.first_index:
+            raise IndexError('cannot truncate entries that were compacted')
+        with self._lock:
+            while self._segments[-1].base > index:
+                self._segments.pop().remove()
+            active = self._segments[-1]
+            if active.data is not None:
+                active.unseal(self.decode, self.term_of, self.fsync)
+            assert active.wal is not None
+            pos = index - active.base
+            active.wal.truncate(int(active.offsets[pos]))
+            del active.offsets[pos:]
+            del active.terms[pos:]
+            del active.entries[pos:]
+            active.count = pos
+
+    def compact(self, index: int):
+        """Discards the entries up to and including `index`, which must
+        already be covered by a snapshot. Only whole sealed segments are
+        removed, so entries just before `index` may still be readable."""
+        with self._lock:
+            while len(self._segments) > 1:
+                segment = self._segments[0]
+                if segment.base + segment.count - 1 > index:
+                    break
+                self._segments.pop(0).remove()
+
+    def reset(self, first_index: int):
+        """Discards every entry, so that the next entry appended is at
+        `first_index`"""
+        with self._lock:
+            for segment in self._segments:
+                segment.remove()
+            self._segments = list()
+            self._add_segment(first_index)
+
+    def sync(self):
+        """Blocks until every appended entry is durable, sealing the segments
+        that have filled up since the last call"""
+        with self._lock:
+            for segment in self._segments[:-1]:
+                if segment.data is None and segment.wal is not None:
+                    segment.seal()
+            wal = self._segments[-1].wal
+        if wal:
+            wal.sync()
+
+    def close(self):
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
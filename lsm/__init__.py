@@ -0,0 +1,831 @@
+import hashlib
+import heapq
+import itertools
+import json
+import mmap
+import os
+import struct
+import threading
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+from store import SortedKeys, Value as StoredValue
+from wal import WriteAheadLog
+
+# a value of `None` marks a deletion (a "tombstone"), which hides any older
+# value of the key until compaction drops both
+Value = Union[str, bytes, None]
+Record = Tuple[str, Value]
+
+# -- table file format --
+# sorted records, grouped into blocks of about `block_bytes`; then an index
+# entry per block, with its offset, length and last key; then a bloom filter
+# of every key; then the footer. A record is <key length, value length>
+# followed by the key and value, and a value length of -1 is a tombstone. If
+# the key length has the `_BYTES` bit set, the value is bytes (compressed)
+# rather than text.
+# Memtable write-ahead log records are one or more of the same records.
+_RECORD = struct.Struct('<Ii')
+_BYTES = 0x80000000
+_INDEX = struct.Struct('<QII')
+# index offset, bloom filter offset, bloom hash count, record count, magic
+_FOOTER = struct.Struct('<QQIQQ')
+_MAGIC = 0x4d534c425352
+_BLOOM_BITS_PER_KEY = 10
+_BLOOM_HASHES = 7
+_MANIFEST = 'MANIFEST'
+# frozen memtables waiting to be flushed, beyond which writes stall
+_MAX_FROZEN = 2
+
+
+def _pack(key: str, value: Value) -> bytes:
+    k = key.encode()
+    if value is None:
+        return _RECORD.pack(len(k), -1) + k
+    if isinstance(value, bytes):
+        return _RECORD.pack(len(k) | _BYTES, len(value)) + k + value
+    v = value.encode()
+    return _RECORD.pack(len(k), len(v)) + k + v
+
+
+def _unpack(buf, offset: int) -> Tuple[str, Value, int]:
+    """Returns the key, value and end offset of the record at `offset`"""
+    key_len, value_len = _RECORD.unpack_from(buf, offset)
+    offset += _RECORD.size
+    is_bytes = key_len & _BYTES
+    key_len &= ~_BYTES
+    key = buf[offset:offset + key_len].decode()
+    offset += key_len
+    if value_len < 0:
+        return key, None, offset
+    value = buf[offset:offset + value_len]
+    if is_bytes:
+        return key, bytes(value), offset + value_len
+    return key, value.decode(), offset + value_len
+
+
+def _bloom_hash(key: bytes) -> Tuple[int, int]:
+    digest = hashlib.blake2b(key, digest_size=8).digest()
+    return (int.from_bytes(digest[:4], 'little'),
+            int.from_bytes(digest[4:], 'little') | 1)
+
+
+def _bloom_positions(
+        h: Tuple[int, int], bits: int, hashes: int) -> Iterator[int]:
+    # double hashing, see Kirsch and Mitzenmacher, 'Less Hashing, Same
+    # Performance'
+    h1, h2 = h
+    for i in range(hashes):
+        yield (h1 + i * h2) % bits
+
+
+def _fsync_dir(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _Table:
+    """
+    An immutable, sorted file of records, memory-mapped for reading
+
+    A point read checks the key range and bloom filter, which rule out most
+    tables that do not hold the key without touching their data, then binary
+    searches the block index and decodes a single block.
+    """
+    def __init__(self, path: str, number: int):
+        self.path = path
+        self.number = number
+        self.size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        footer = self.size - _FOOTER.size
+        index_offset, bloom_offset, self._hashes, self.count, magic = (
+            _FOOTER.unpack_from(self._map, footer))
+        if magic != _MAGIC:
+            raise ValueError(f"{path} is not a table file")
+        self._bloom = self._map[bloom_offset:footer]
+        self._blocks: List[Tuple[int, int]] = list()
+        # the last key of each block
+        self._last_keys: List[str] = list()
+        offset = index_offset
+        while offset < bloom_offset:
+            block_offset, block_len, key_len = _INDEX.unpack_from(
+                self._map, offset)
+            offset += _INDEX.size
+            self._last_keys.append(
+                self._map[offset:offset + key_len].decode())
+            offset += key_len
+            self._blocks.append((block_offset, block_len))
+        self.first_key = _unpack(self._map, 0)[0]
+        self.last_key = self._last_keys[-1]
+
+    def may_contain(self, key: str, h: Tuple[int, int]) -> bool:
+        """Whether the table may hold `key`, whose `_bloom_hash` is `h`"""
+        if not self.first_key <= key <= self.last_key:
+            return False
+        bits = len(self._bloom) * 8
+        return all(
+            self._bloom[p >> 3] & (1 << (p & 7))
+            for p in _bloom_positions(h, bits, self._hashes))
+
+    def find_block(self, key: str) -> int:
+        """Returns the number of the only block that can hold `key`"""
+        return bisect_left(self._last_keys, key)
+
+    def block(self, n: int) -> Tuple[List[str], List[Value]]:
+        """Decodes block `n` into its keys and values"""
+        offset, length = self._blocks[n]
+        end = offset + length
+        keys: List[str] = list()
+        values: List[Value] = list()
+        while offset < end:
+            key, value, offset = _unpack(self._map, offset)
+            keys.append(key)
+            values.append(value)
+        return keys, values
+
+    def records(self, start: str | None = None) -> Iterator[Record]:
+        """Yields every record with a key of at least `start`, in order"""
+        n = 0 if start is None else self.find_block(start)
+        for offset, length in self._blocks[n:]:
+            end = offset + length
+            while offset < end:
+                key, value, offset = _unpack(self._map, offset)
+                if start is None or key >= start:
+                    yield key, value
+
+
+class _TableWriter:
+    def __init__(self, path: str, number: int, block_bytes: int):
+        self.path = path
+        self.number = number
+        self.block_bytes = block_bytes
+        # bytes written to the file so far
+        self.size = 0
+        self._file = open(path, 'wb')
+        self._block = bytearray()
+        self._last_key = ''
+        self._index = bytearray()
+        self._keys: List[bytes] = list()
+
+    def add(self, key: str, value: Value):
+        """Adds a record, whose key must sort after every key added so far"""
+        self._block += _pack(key, value)
+        self._last_key = key
+        self._keys.append(key.encode())
+        if len(self._block) >= self.block_bytes:
+            self._flush_block()
+
+    def _flush_block(self):
+        if not self._block:
+            return
+        self._file.write(self._block)
+        key = self._last_key.encode()
+        self._index += _INDEX.pack(self.size, len(self._block), len(key))
+        self._index += key
+        self.size += len(self._block)
+        self._block = bytearray()
+
+    def finish(self, fsync: bool) -> _Table:
+        self._flush_block()
+        bloom = bytearray(
+            max(8, len(self._keys) * _BLOOM_BITS_PER_KEY // 8 + 1))
+        for key in self._keys:
+            for p in _bloom_positions(
+                    _bloom_hash(key), len(bloom) * 8, _BLOOM_HASHES):
+                bloom[p >> 3] |= 1 << (p & 7)
+        index_offset = self.size
+        bloom_offset = index_offset + len(self._index)
+        self._file.write(self._index)
+        self._file.write(bloom)
+        self._file.write(_FOOTER.pack(
+            index_offset, bloom_offset, _BLOOM_HASHES, len(self._keys),
+            _MAGIC))
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        return _Table(self.path, self.number)
+
+
+class _Version:
+    """The tables in each level, as of some point in time. Versions are
+    replaced rather than changed, so that readers can use one without a
+    lock."""
+    def __init__(self, levels: List[List[_Table]]):
+        # level 0 is newest first, and deeper levels are in key order
+        self.levels = levels
+        self.last_keys = [[t.last_key for t in level] for level in levels]
+
+    def numbers(self) -> List[List[int]]:
+        return [[t.number for t in level] for level in self.levels]
+
+
+def _tag(source: Iterable[Record], n: int) -> Iterator[Tuple[str, int, Value]]:
+    for key, value in source:
+        yield key, n, value
+
+
+def _merge(sources: List[Iterator[Record]]) -> Iterator[Record]:
+    """Merges sorted sources, given newest first, into one sorted stream that
+    holds the newest record for each key"""
+    last = None
+    for key, _, value in heapq.merge(
+            *[_tag(source, n) for n, source in enumerate(sources)]):
+        if key != last:
+            yield key, value
+            last = key
+
+
+def _frozen_records(
+        memtable: Dict[str, Value], keys: SortedKeys, start: str | None
+) -> Iterator[Record]:
+    for key in keys.range(start, None, len(memtable)):
+        yield key, memtable[key]
+
+
+class LSMStore:
+    """
+    A k-v datastore with the same operations as `store.Store`, kept on disk as
+    a log-structured merge tree
+
+    Writes go to an in-memory table (the memtable) and its write-ahead log.
+    Once the memtable grows past `memtable_bytes` it is frozen, and a
+    background thread writes it out as a sorted table file in level 0. Level
+    0 tables may overlap, so once there are `level0_tables` of them they are
+    merged into level 1. Each deeper level holds tables with disjoint key
+    ranges, and up to `level_ratio` times the bytes of the level above; when a
+    level outgrows that, one of its tables is merged into the next level down.
+
+    A read checks the memtables, then level 0 newest first, then at most one
+    table in each deeper level, most of which it can rule out with a bloom
+    filter. The values of the last `cache_rows` keys read from tables are
+    cached, so that hot keys cost about as much as an in-memory read, and so
+    are the last `cache_blocks` blocks, decoded.
+
+    With `background=False`, flushes and compactions run in the writing
+    thread instead, e.g.: for tests.
+
+    Unlike `store.Store`, only the latest value of each key is kept, and
+    scans see writes made while they run. The `index` that writes are tagged
+    with only serves to record, in the manifest, the last index written to a
+    table file (`durable_index`), so that a node can tell after a restart
+    that the store is already up to date with its snapshot.
+    """
+    def __init__(
+            self,
+            directory: str,
+            memtable_bytes: int = 4 << 20,
+            block_bytes: int = 4096,
+            table_bytes: int = 2 << 20,
+            level0_tables: int = 4,
+            level_ratio: int = 10,
+            cache_rows: int = 10000,
+            cache_blocks: int = 1024,
+            fsync: bool = False,
+            background: bool = True
+    ):
+        self.directory = directory
+        self.memtable_bytes = memtable_bytes
+        self.block_bytes = block_bytes
+        self.table_bytes = table_bytes
+        self.level0_tables = level0_tables
+        self.level_ratio = level_ratio
+        self.cache_rows = cache_rows
+        self.cache_blocks = cache_blocks
+        # fsync the memtable log on every write, and new files before they are
+        # used. Without it, writes survive a crash of the process but not of
+        # the machine (the raft log holds the durable copy)
+        self.fsync = fsync
+        self.background = background
+        os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._cache: OrderedDict[
+            Tuple[int, int], Tuple[List[str], List[Value]]] = OrderedDict()
+        self._cache_lock = threading.Lock()
+        # values read from tables (or `None` if not found), guarded by `_lock`
+        self._rows: OrderedDict[str, Value] = OrderedDict()
+        # counts writes, so that a read can tell whether the value it found
+        # may have been overwritten before it could be cached
+        self._writes = 0
+        self._worker: threading.Thread | None = None
+        # the last key merged down from each level
+        self._compact_pointer: Dict[int, str] = dict()
+        self._open()
+
+    # ----- files -----
+    def _path(self, number: int, ext: str) -> str:
+        return os.path.join(self.directory, f'{number:06d}.{ext}')
+
+    def _take_number(self) -> int:
+        number = self._next_number
+        self._next_number += 1
+        return number
+
+    def _open(self) -> None:
+        """Loads the tables listed in the manifest, removes files that it no
+        longer needs, and recovers the memtable from its write-ahead logs"""
+        manifest = os.path.join(self.directory, _MANIFEST)
+        levels: List[List[int]] = [[]]
+        self._next_number = 1
+        self.durable_index = -1
+        # the oldest write-ahead log that has not been flushed to a table
+        self._log_number = 0
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                m = json.load(f)
+            levels = m['levels']
+            self._next_number = int(m['next_number'])
+            self._log_number = int(m['log_number'])
+            self.durable_index = int(m.get('index', -1))
+        live = {n for level in levels for n in level}
+        logs = list()
+        for name in os.listdir(self.directory):
+            stem, _, ext = name.partition('.')
+            if not stem.isdigit():
+                continue
+            number = int(stem)
+            self._next_number = max(self._next_number, number + 1)
+            if (ext == 'sst' and number not in live) or (
+                    ext == 'wal' and number < self._log_number):
+                os.remove(os.path.join(self.directory, name))
+            elif ext == 'wal':
+                logs.append(number)
+        self._version = _Version(
+            [[_Table(self._path(n, 'sst'), n) for n in level]
+             for level in levels])
+
+        self._error: Exception | None = None
+        self._closing = False
+        # (memtable, its keys, its log number, its last index)
+        self._frozen: List[
+            Tuple[Dict[str, Value], SortedKeys, int, int]] = list()
+        self._new_memtable()
+        for number in sorted(logs):
+            wal = WriteAheadLog(self._path(number, 'wal'), self.fsync)
+            for _, payload in wal.records():
+                offset = 0
+                while offset < len(payload):
+                    key, value, offset = _unpack(payload, offset)
+                    self._put(key, value)
+                self._memtable_size += len(payload)
+            wal.close()
+        # the recovered logs are removed once this memtable has been flushed
+        if self._memtable:
+            with self._lock:
+                self._freeze()
+        if self.background:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+        else:
+            self._do_work()
+
+    def _new_memtable(self) -> None:
+        self._memtable: Dict[str, Value] = dict()
+        self._memtable_keys = SortedKeys()
+        self._memtable_size = 0
+        self._memtable_number = self._take_number()
+        # the last index written to the memtable, if known
+        self._memtable_index = -1
+        self._wal = WriteAheadLog(
+            self._path(self._memtable_number, 'wal'), self.fsync)
+
+    def _save_manifest(self):
+        manifest = os.path.join(self.directory, _MANIFEST)
+        with open(manifest + '.tmp', 'w') as f:
+            json.dump(dict(
+                levels=self._version.numbers(),
+                next_number=self._next_number,
+                log_number=self._log_number,
+                index=self.durable_index), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(manifest + '.tmp', manifest)
+        _fsync_dir(self.directory)
+
+    def close(self):
+        """Stops background work and closes the memtable's log. The memtables
+        are recovered from their logs when the store is next opened."""
+        with self._lock:
+            self._closing = True
+            self._changed.notify_all()
+        if self._worker:
+            self._worker.join()
+            self._worker = None
+        self._wal.close()
+
+    # ----- writes -----
+    def _put(self, key: str, value: Value):
+        if key not in self._memtable:
+            self._memtable_keys.add(key)
+        self._memtable[key] = value
+
+    def _write(self, writes: List[Record], index: int | None = None):
+        record = b''.join(_pack(key, value) for key, value in writes)
+        with self._lock:
+            while len(self._frozen) >= _MAX_FROZEN and not self._error:
+                # writes are outrunning flushes
+                self._changed.wait()
+            if self._error:
+                raise self._error
+            wal = self._wal
+            seq = wal.append(record)
+            self._writes += 1
+            for key, value in writes:
+                self._put(key, value)
+                self._rows.pop(key, None)
+            self._memtable_size += len(record)
+            if index is not None:
+                self._memtable_index = max(self._memtable_index, index)
+            if self._memtable_size >= self.memtable_bytes:
+                self._freeze()
+        wal.sync(seq)
+        if not self.background:
+            self._do_work()
+
+    def _freeze(self):
+        """Queues the memtable to be flushed, and starts a new one. The lock
+        must be held."""
+        self._wal.close()
+        self._frozen.append((
+            self._memtable, self._memtable_keys, self._memtable_number,
+            self._memtable_index))
+        self._new_memtable()
+        self._changed.notify_all()
+
+    def upsert(self, key: str, value: StoredValue, index: int | None = None):
+        """Writes a value to the store, without checking for previously
+        existing values."""
+        self._write([(key, value)], index)
+
+    def delete(self, key: str, index: int | None = None):
+        """Deletes the entry at the specified key, without checking whether
+        it exists."""
+        self._write([(key, None)], index)
+
+    def apply(self, writes: Iterable[Record], index: int | None = None):
+        """Applies many upserts and deletes (a value of `None`), in order, so
+        that no reader sees some of them without the rest"""
+        self._write(list(writes), index)
+
+    def delete_range(
+            self,
+            start: str | None,
+            end: str | None,
+            index: int | None = None
+    ) -> List[str]:
+        """Deletes every key from `start` (inclusive) to `end` (exclusive),
+        as one write, and returns the deleted keys"""
+        keys = [key for key, _ in self._records(start, end)]
+        if keys:
+            self._write([(key, None) for key in keys], index)
+        return keys
+
+    def restore(
+            self,
+            items: Iterable[Tuple[str, StoredValue]],
+            index: int | None = None
+    ):
+        """Replaces the entire contents of the store, e.g.: from a snapshot
+        as of `index`. The new contents are flushed to table files, so that
+        the manifest records that the store is at `index`."""
+        self.close()
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+        with self._cache_lock:
+            self._cache.clear()
+        self._rows.clear()
+        self._open()
+        batch: List[Record] = list()
+        for item in items:
+            batch.append(item)
+            if len(batch) >= 1024:
+                self._write(batch, index)
+                batch = list()
+        if batch:
+            self._write(batch, index)
+        self.flush()
+        if index is not None:
+            with self._lock:
+                self.durable_index = index
+                self._save_manifest()
+
+    def flush(self):
+        """Blocks until every write so far is in a table file, and any
+        compaction that it called for has finished"""
+        with self._lock:
+            if self._memtable:
+                self._freeze()
+            while self._worker and self._pending() and not self._error:
+                self._changed.wait()
+            if self._error:
+                raise self._error
+        if not self.background:
+            self._do_work()
+
+    # ----- reads -----
+    def read(self, key: str) -> Value:
+        """Reads the value stored at the specified key. Returns `None` if there
+        is no value for the key."""
+        with self._lock:
+            if key in self._memtable:
+                return self._memtable[key]
+            for memtable, _, _, _ in reversed(self._frozen):
+                if key in memtable:
+                    return memtable[key]
+            if key in self._rows:
+                self._rows.move_to_end(key)
+                return self._rows[key]
+            version = self._version
+            writes = self._writes
+        value = self._read_tables(version, key)
+        with self._lock:
+            if self._writes == writes:
+                self._rows[key] = value
+                if len(self._rows) > self.cache_rows:
+                    self._rows.popitem(last=False)
+        return value
+
+    def read_many(self, keys: List[str]) -> List[Value]:
+        """Reads many keys. Writes made during the call may or may not be
+        seen."""
+        return [self.read(key) for key in keys]
+
+    def _read_tables(self, version: _Version, key: str) -> Value:
+        h = _bloom_hash(key.encode())
+        for table in version.levels[0]:
+            found, value = self._get(table, key, h)
+            if found:
+                return value
+        for level, last_keys in zip(
+                version.levels[1:], version.last_keys[1:]):
+            n = bisect_left(last_keys, key)
+            if n < len(level):
+                found, value = self._get(level[n], key, h)
+                if found:
+                    return value
+        return None
+
+    def _get(
+            self, table: _Table, key: str, h: Tuple[int, int]
+    ) -> Tuple[bool, Value]:
+        if not table.may_contain(key, h):
+            return False, None
+        keys, values = self._block(table, table.find_block(key))
+        i = bisect_left(keys, key)
+        if i < len(keys) and keys[i] == key:
+            return True, values[i]
+        return False, None
+
+    def _block(self, table: _Table, n: int) -> Tuple[List[str], List[Value]]:
+        with self._cache_lock:
+            block = self._cache.get((table.number, n))
+            if block is not None:
+                self._cache.move_to_end((table.number, n))
+                return block
+        block = table.block(n)
+        with self._cache_lock:
+            self._cache[(table.number, n)] = block
+            if len(self._cache) > self.cache_blocks:
+                self._cache.popitem(last=False)
+        return block
+
+    def _memtable_records(
+            self,
+            memtable: Dict[str, Value],
+            keys: SortedKeys,
+            start: str | None,
+            batch: int = 256
+    ) -> Iterator[Record]:
+        """Yields the records in a memtable that may still be written to, a
+        batch at a time under the lock"""
+        first = True
+        while True:
+            with self._lock:
+                page = keys.range(start, None, batch + 1)
+                records = [(k, memtable[k]) for k in page]
+            if not first:
+                # the last record of the previous page
+                records = records[1:]
+            first = False
+            yield from records
+            if len(page) <= batch:
+                return
+            start = page[-1]
+
+    def _records(
+            self, start: str | None, end: str | None, snapshot: bool = False
+    ) -> Iterator[Tuple[str, StoredValue]]:
+        """Yields the live pairs in a range, in key order. With `snapshot`,
+        the memtable's records in the range are copied first, and the other
+        sources never change, so that writes made during iteration are not
+        seen."""
+        sources: List[Iterator[Record]] = list()
+        with self._lock:
+            memtable, keys = self._memtable, self._memtable_keys
+            if snapshot:
+                sources.append(iter([
+                    (k, memtable[k])
+                    for k in keys.range(start, end, len(memtable))]))
+            frozen = list(self._frozen)
+            version = self._version
+        if not snapshot:
+            sources.append(self._memtable_records(memtable, keys, start))
+        sources += [
+            _frozen_records(m, k, start) for m, k, _, _ in reversed(frozen)]
+        sources += [t.records(start) for t in version.levels[0]]
+        for level in version.levels[1:]:
+            # the tables in a level are disjoint and in order, so they can
+            # be read one after the other
+            sources.append(itertools.chain.from_iterable(
+                t.records(start) for t in level
+                if start is None or t.last_key >= start))
+        for key, value in _merge(sources):
+            if end is not None and key >= end:
+                return
+            if value is not None:
+                yield key, value
+
+    def scan(
+            self,
+            start: str | None = None,
+            end: str | None = None,
+            limit: int = 100
+    ) -> List[Tuple[str, StoredValue]]:
+        """Returns up to `limit` key-value pairs with keys from `start`
+        (inclusive) to `end` (exclusive), in key order. Either bound may be
+        `None` for an open range. Writes made during the call may or may not
+        be seen."""
+        return list(itertools.islice(self._records(start, end), limit))
+
+    def items(
+            self,
+            start: str | None = None,
+            end: str | None = None
+    ) -> Iterator[Tuple[str, StoredValue]]:
+        """Iterates over the key-value pairs with keys from `start`
+        (inclusive) to `end` (exclusive), or every pair, in key order, as of
+        the call. The memtable's records in the range are copied, rather
+        than the memtable frozen, so that each export or snapshot does not
+        leave a small table behind."""
+        return self._records(start, end, snapshot=True)
+
+    # ----- flushes and compaction -----
+    def _level_limit(self, level: int) -> int:
+        return self.table_bytes * int(self.level_ratio ** level)
+
+    def _compaction_level(self) -> int | None:
+        """Returns the level that most needs to be merged into the next, if
+        any"""
+        levels = self._version.levels
+        if len(levels[0]) >= self.level0_tables:
+            return 0
+        for level in range(1, len(levels)):
+            if sum(t.size for t in levels[level]) > self._level_limit(level):
+                return level
+        return None
+
+    def _pending(self) -> bool:
+        return bool(self._frozen) or self._compaction_level() is not None
+
+    def _run(self):
+        with self._lock:
+            while not self._closing:
+                if not self._pending():
+                    self._changed.wait()
+                    continue
+                self._lock.release()
+                try:
+                    self._work()
+                except Exception as e:
+                    self._error = e
+                    return
+                finally:
+                    self._lock.acquire()
+                    self._changed.notify_all()
+
+    def _do_work(self):
+        while True:
+            with self._lock:
+                if not self._pending():
+                    return
+            self._work()
+
+    def _work(self):
+        """Flushes the oldest frozen memtable, or else runs one compaction"""
+        with self._lock:
+            frozen = self._frozen[0] if self._frozen else None
+            level = self._compaction_level()
+        if frozen:
+            self._flush_memtable(*frozen)
+        elif level is not None:
+            self._compact(level)
+
+    def _write_tables(self, records: Iterator[Record]) -> List[_Table]:
+        """Writes records out to new tables of about `table_bytes` each"""
+        tables: List[_Table] = list()
+        writer: _TableWriter | None = None
+        for key, value in records:
+            if writer is None:
+                with self._lock:
+                    number = self._take_number()
+                writer = _TableWriter(
+                    self._path(number, 'sst'), number, self.block_bytes)
+            writer.add(key, value)
+            if writer.size >= self.table_bytes:
+                tables.append(writer.finish(self.fsync))
+                writer = None
+        if writer:
+            tables.append(writer.finish(self.fsync))
+        return tables
+
+    def _flush_memtable(
+            self,
+            memtable: Dict[str, Value],
+            keys: SortedKeys,
+            _: int,
+            index: int
+    ):
+        with self._lock:
+            table_number = self._take_number()
+        writer = _TableWriter(
+            self._path(table_number, 'sst'), table_number, self.block_bytes)
+        for key in keys:
+            writer.add(key, memtable[key])
+        table = writer.finish(self.fsync)
+        with self._lock:
+            levels = list(self._version.levels)
+            levels[0] = [table] + levels[0]
+            # the table is visible before the memtable is dropped, so that
+            # readers always find its records in one or the other
+            self._version = _Version(levels)
+            self.durable_index = max(self.durable_index, index)
+            self._frozen.pop(0)
+            self._log_number = (
+                self._frozen[0][2] if self._frozen else self._memtable_number)
+            self._save_manifest()
+        self._remove_logs()
+
+    def _remove_logs(self):
+        """Removes the write-ahead logs of memtables that have been flushed"""
+        for name in os.listdir(self.directory):
+            stem, _, ext = name.partition('.')
+            if ext == 'wal' and stem.isdigit() and int(stem) < self._log_number:
+                os.remove(os.path.join(self.directory, name))
+
+    def _compact(self, level: int):
+        """Merges tables from `level` into the overlapping tables of the next
+        level down. Only the background worker (or, without one, the writing
+        thread) compacts, so the levels involved cannot change meanwhile,
+        other than by new level 0 tables."""
+        with self._lock:
+            levels = self._version.levels
+            if level == 0:
+                inputs = list(levels[0])
+            else:
+                # take turns through the key range, so that every table is
+                # eventually merged down
+                pointer = self._compact_pointer.get(level, '')
+                inputs = [next(
+                    (t for t in levels[level] if t.first_key > pointer),
+                    levels[level][0])]
+                self._compact_pointer[level] = inputs[0].last_key
+            low = min(t.first_key for t in inputs)
+            high = max(t.last_key for t in inputs)
+            below = levels[level + 1] if level + 1 < len(levels) else []
+            overlap = [
+                t for t in below if t.first_key <= high and t.last_key >= low]
+            # tombstones can only be dropped if there is nothing older for
+            # them to hide
+            bottom = all(not tables for tables in levels[level + 2:])
+
+        sources = [t.records() for t in inputs]
+        sources.append(itertools.chain.from_iterable(
+            t.records() for t in overlap))
+        records: Iterator[Record] = _merge(sources)
+        if bottom:
+            records = ((k, v) for k, v in records if v is not None)
+        outputs = self._write_tables(records)
+
+        with self._lock:
+            removed = {t.number for t in inputs + overlap}
+            levels = [list(tables) for tables in self._version.levels]
+            if level + 1 == len(levels):
+                levels.append(list())
+            levels[level] = [t for t in levels[level] if t.number not in removed]
+            levels[level + 1] = sorted(
+                [t for t in levels[level + 1] if t.number not in removed]
+                + outputs,
+                key=lambda t: t.first_key)
+            self._version = _Version(levels)
+            self._save_manifest()
+        # readers may still hold the old version -- the memory maps stay
+        # valid after the files are removed, until they are garbage collected
+        for number in removed:
+            os.remove(self._path(number, 'sst'))
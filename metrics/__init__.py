@@ -0,0 +1,58 @@
+import threading
+from typing import Dict
+
+
+class Summary:
+    """Count, sum and maximum of a series of observations"""
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+
+class Metrics:
+    """
+    A minimal registry of counters, gauges and summaries
+
+    Metrics are created on first use, and rendered in the Prometheus text
+    exposition format by `render`. Every name is prefixed with `prefix`.
+    """
+    def __init__(self, prefix: str = 'rsb'):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self.counters: Dict[str, float] = dict()
+        self.gauges: Dict[str, float] = dict()
+        self.summaries: Dict[str, Summary] = dict()
+
+    def inc(self, name: str, amount: float = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name: str, value: float):
+        with self._lock:
+            self.summaries.setdefault(name, Summary()).observe(value)
+
+    def render(self) -> str:
+        lines = list()
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                lines.append(f'# TYPE {self.prefix}_{name} counter')
+                lines.append(f'{self.prefix}_{name} {value}')
+            for name, value in sorted(self.gauges.items()):
+                lines.append(f'# TYPE {self.prefix}_{name} gauge')
+                lines.append(f'{self.prefix}_{name} {value}')
+            for name, s in sorted(self.summaries.items()):
+                lines.append(f'# TYPE {self.prefix}_{name} summary')
+                lines.append(f'{self.prefix}_{name}_count {s.count}')
+                lines.append(f'{self.prefix}_{name}_sum {s.total}')
+                lines.append(f'{self.prefix}_{name}_max {s.max}')
+        return '\n'.join(lines) + '\n'
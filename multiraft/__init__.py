@@ -0,0 +1,46 @@
+import os
+import zlib
+from typing import List
+
+from raft import ForeignNode, State
+
+# each group's API, including its RPCs, is served under this path
+GROUPS_PATH = '/groups'
+
+
+def group_count() -> int:
+    """Returns the number of raft groups each node hosts, from RSB_GROUPS"""
+    return int(os.environ.get('RSB_GROUPS', 1))
+
+
+def group_of(key: str, groups: int) -> int:
+    """Returns the group that owns `key`. Keys are hash partitioned, so that
+    writes spread evenly over the groups whatever the key distribution."""
+    return zlib.crc32(key.encode()) % groups
+
+
+def group_address(address: str, group: int) -> str:
+    """Returns the address of a group on the node at `address`, which is
+    also the base of the group's API"""
+    return f'{address}{GROUPS_PATH}/{group}'
+
+
+def node_addresses(state: State) -> List[str]:
+    """Returns the address of every node in the cluster, in a fixed order"""
+    return sorted([state.address, *state.foreign_nodes])
+
+
+def preferred_leader(group: int, addresses: List[str]) -> str:
+    """Returns the address of the group on the node that should lead it.
+    Groups are dealt out to the nodes in turn, so that each node leads an
+    equal share of them while it is up."""
+    return group_address(addresses[group % len(addresses)], group)
+
+
+def scope_to_group(state: State, group: int):
+    """Turns a node's `State` into that of one of its groups, whose peers are
+    the same group on the other nodes"""
+    state.address = group_address(state.address, group)
+    state.foreign_nodes = {
+        group_address(address, group): ForeignNode()
+        for address in state.foreign_nodes}
@@ -1,7 +1,19 @@
+import base64
 from enum import StrEnum
+import io
+import itertools
+import json
 import os
-from store import Store
-from typing import Dict, List
+import struct
+import threading
+import time
+from expiry import TimingWheel
+from logstore import MemoryLog, SegmentedLog
+from lsm import LSMStore
+from metrics import Metrics
+from store import Store, Value, prefix_end
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, Tuple
+from wal import WriteAheadLog
 
 
 class Role(StrEnum):
@@ -14,12 +26,31 @@ class Op(StrEnum):
     READ = "read"
     WRITE = "write"
     DELETE = "delete"
+    BATCH = "batch"
+    # deletes a key if its deadline is still `expires`, i.e. it has not been
+    # rewritten since the leader found it had expired
+    EXPIRE = "expire"
+    # deletes every key that starts with the entry's key
+    DELETE_PREFIX = "delete_prefix"
 
 
 class AppendResult:
-    def __init__(self, term: int, success: bool):
+    """The result of AppendEntries. A rejection because the logs disagree
+    says where the leader should try next: `conflict_term` is the follower's
+    term at `prev_log_index` and `conflict_index` the first index it has of
+    that term or, when the follower has no entry there (`conflict_term` 0),
+    the length of its log."""
+    def __init__(
+            self,
+            term: int,
+            success: bool,
+            conflict_term: int = 0,
+            conflict_index: int = -1
+    ):
         self.term = term
         self.success = success
+        self.conflict_term = conflict_term
+        self.conflict_index = conflict_index
 
 
 class VoteResult:
@@ -28,30 +59,258 @@ class VoteResult:
         self.vote_granted = vote_granted
 
 
+class InstallSnapshotResult:
+    def __init__(self, term: int, success: bool):
+        self.term = term
+        self.success = success
+
+
+class ReceivedSnapshot:
+    """A snapshot whose last chunk has arrived from the leader, but which
+    has yet to be made durable and installed (see `State.install_snapshot`)"""
+    def __init__(
+            self,
+            index: int,
+            term: int,
+            incoming: BinaryIO,
+            size: int,
+            started: float
+    ):
+        self.index = index
+        self.term = term
+        # the file the chunks were written to, or else a `BytesIO`
+        self.incoming = incoming
+        self.size = size
+        self.started = started
+
+
 class Entry:
-    """This class must match the server.LogEntry class"""
-    def __init__(self, op: Op, key: str, value: str | None, term: int):
+    """This class must match the server.LogEntry class. `expires` is the
+    time, in milliseconds since the epoch, at which a write expires, or 0 if
+    it does not. A `bytes` value is compressed (see `compression`), and is
+    stored as it is."""
+    __slots__ = ('op', 'key', 'value', 'term', 'expires')
+
+    def __init__(
+            self,
+            op: Op,
+            key: str,
+            value: Value | None,
+            term: int,
+            expires: int = 0
+    ):
         self.op = op
         self.key = key
         self.value = value
         self.term = term
+        self.expires = expires
 
 
 class InvalidOperationException(Exception):
     pass
 
 
+class NotLeaderException(Exception):
+    pass
+
+
 class ForeignNode:
-    # todo: add client connection
+    # the client connection is held by `replication.Replicator`
     next_index: int = 0
     match_index: int = -1
 
 
 SINGLE_NODE_DEPLOYMENT = 'single-node deployment'
 
+# -- write-ahead log record schemas --
+# every record starts with a kind byte. A term record carries the term
+# followed by the utf-8 `voted_for` address. Log entries are persisted
+# separately, one record per entry, in a `logstore.SegmentedLog`.
+_TERM_RECORD = 0
+_RECORD = struct.Struct('<Bq')
+# term, op code, key length, value length (-1 for a missing value). If the
+# op code has the `_EXPIRES` bit set, the expiry time follows, and if it has
+# the `_BYTES` bit set, the value is bytes (compressed) rather than text
+_ENTRY = struct.Struct('<qBIi')
+_EXPIRES = 0x80
+_BYTES = 0x40
+_TIME = struct.Struct('<q')
+_OPS = list(Op)
+_OP_CODES = {op: code for code, op in enumerate(_OPS)}
+
+
+def encode_entry(entry: Entry) -> bytes:
+    key = entry.key.encode()
+    op = _OP_CODES[entry.op]
+    if isinstance(entry.value, bytes):
+        value = entry.value
+        op |= _BYTES
+    else:
+        value = b'' if entry.value is None else entry.value.encode()
+    value_len = -1 if entry.value is None else len(value)
+    if entry.expires:
+        return _ENTRY.pack(
+            entry.term, op | _EXPIRES, len(key), value_len
+        ) + _TIME.pack(entry.expires) + key + value
+    return _ENTRY.pack(entry.term, op, len(key), value_len) + key + value
+
+
+def decode_entry(buf: bytes | bytearray, offset: int = 0) -> Entry:
+    term, op, key_len, value_len = _ENTRY.unpack_from(buf, offset)
+    offset += _ENTRY.size
+    expires = 0
+    if op & _EXPIRES:
+        (expires,) = _TIME.unpack_from(buf, offset)
+        offset += _TIME.size
+        op &= ~_EXPIRES
+    key = buf[offset:offset + key_len].decode()
+    offset += key_len
+    value: Value | None = None
+    if value_len >= 0:
+        if op & _BYTES:
+            op &= ~_BYTES
+            value = bytes(buf[offset:offset + value_len])
+        else:
+            value = buf[offset:offset + value_len].decode()
+    return Entry(_OPS[op], key, value, term, expires)
+
+
+def now_ms() -> int:
+    """The wall-clock time in milliseconds, as used for `Entry.expires`"""
+    return int(time.time() * 1000)
+
+
+def entry_term(entry: Entry) -> int:
+    return entry.term
+
+
+def batch_entry(entries: List[Entry], term: int) -> Entry:
+    """Packs writes, deletes and expiries into a single log entry, so that
+    they are committed together and applied atomically. The operations are
+    carried, in order, as a JSON list in the entry's value, each as [op, key,
+    value], then the expiry time if there is one or the value is bytes, then
+    `true` if the value is bytes, in base64."""
+    ops: List[list] = list()
+    for e in entries:
+        if e.op not in (Op.WRITE, Op.DELETE, Op.EXPIRE):
+            raise InvalidOperationException(
+                f"Invalid Operation: {e.op} in batch")
+        if e.op == Op.WRITE and not e.value:
+            raise InvalidOperationException(
+                f"Invalid Entry: write missing value for key {e.key}")
+        if isinstance(e.value, bytes):
+            ops.append([e.op, e.key, base64.b64encode(e.value).decode(),
+                        e.expires, True])
+        elif e.expires:
+            ops.append([e.op, e.key, e.value, e.expires])
+        else:
+            ops.append([e.op, e.key, e.value])
+    return Entry(op=Op.BATCH, key='', value=json.dumps(ops), term=term)
+
+
+def _unpack_batch(entry: Entry) -> List[Entry]:
+    entries = list()
+    for op in json.loads(entry.value or '[]'):
+        value = op[2]
+        if len(op) > 4 and op[4]:
+            value = base64.b64decode(value)
+        entries.append(Entry(
+            Op(op[0]), op[1], value, entry.term, op[3] if len(op) > 3 else 0))
+    return entries
+
+
+# -- snapshot format --
+# the last included index and term, followed by a key length, value length,
+# key and value for each pair in the store. If the key length has the
+# `_PAIR_EXPIRES` bit set, the pair's expiry time follows the lengths, and if
+# the value length has the `_PAIR_BYTES` bit set, the value is bytes
+_SNAPSHOT = struct.Struct('<qq')
+_PAIR = struct.Struct('<II')
+_PAIR_EXPIRES = 0x80000000
+_PAIR_BYTES = 0x80000000
+SNAPSHOT_CHUNK_BYTES = 1 << 20
+
+
+def _encode_snapshot(
+        index: int,
+        term: int,
+        items: Iterable[Tuple[str, Value]],
+        expires: Dict[str, int] | None = None
+) -> Iterator[bytes]:
+    """Yields the snapshot in pieces of about `SNAPSHOT_CHUNK_BYTES`, encoding
+    the pairs as they are iterated over"""
+    expires = expires or dict()
+    parts = [_SNAPSHOT.pack(index, term)]
+    size = 0
+    for key, value in items:
+        k = key.encode()
+        if isinstance(value, bytes):
+            v, v_len = value, len(value) | _PAIR_BYTES
+        else:
+            v = value.encode()
+            v_len = len(v)
+        if key in expires:
+            parts.extend((
+                _PAIR.pack(len(k) | _PAIR_EXPIRES, v_len),
+                _TIME.pack(expires[key]), k, v))
+        else:
+            parts.extend((_PAIR.pack(len(k), v_len), k, v))
+        size += len(k) + len(v)
+        if size >= SNAPSHOT_CHUNK_BYTES:
+            yield b''.join(parts)
+            parts = list()
+            size = 0
+    yield b''.join(parts)
+
+
+def _decode_snapshot(
+        f: BinaryIO) -> Tuple[int, int, Iterator[Tuple[str, Value, int]]]:
+    """Returns the index, term and (key, value, expiry time) of each pair of
+    the snapshot in `f`. The pairs are read as they are iterated over."""
+    index, term = _SNAPSHOT.unpack(f.read(_SNAPSHOT.size))
+
+    def items():
+        while header := f.read(_PAIR.size):
+            key_len, value_len = _PAIR.unpack(header)
+            expires = 0
+            if key_len & _PAIR_EXPIRES:
+                (expires,) = _TIME.unpack(f.read(_TIME.size))
+                key_len &= ~_PAIR_EXPIRES
+            key = f.read(key_len).decode()
+            if value_len & _PAIR_BYTES:
+                yield key, f.read(value_len & ~_PAIR_BYTES), expires
+            else:
+                yield key, f.read(value_len).decode(), expires
+    return index, term, items()
+
+
+class PendingSnapshot:
+    """A snapshot of the store as of `index`, whose view of the store has
+    been taken but which has yet to be written out (see
+    `State.begin_snapshot`)"""
+    def __init__(
+            self,
+            index: int,
+            term: int,
+            items: Iterator[Tuple[str, Value]],
+            expires: Dict[str, int],
+            restores: int
+    ):
+        self.index = index
+        self.term = term
+        self.items = items
+        self.expires = expires
+        # `State._restores` as of the view
+        self.restores = restores
+        self.started = time.perf_counter()
+        # the encoded snapshot, for nodes without a data directory
+        self.data = b''
+        self.size = 0
+
 
 class State:
-    def __init__(self, store: Store):
+    def __init__(
+            self, store: Store | LSMStore, data_dir: str | None = None):
         self.store = store
         self.address = os.environ.get('RSB_ADDRESS', SINGLE_NODE_DEPLOYMENT)
         if self.address == SINGLE_NODE_DEPLOYMENT:
@@ -60,22 +319,348 @@ class State:
         self.foreign_nodes: Dict[str, ForeignNode] = dict()
         nodes_raw = os.environ.get('RSB_NODES', '')
         for n in nodes_raw.split(','):
-            if n != self.address:
+            if n and n != self.address:
                 self.foreign_nodes[n] = ForeignNode()
 
         # -- volatile state --
         self.role: Role = Role.FOLLOWER
+        # address of the current leader, as far as this node knows
+        self.leader_id: str = ''
+        # the leader's commit index, and the (monotonic) time, as of the last
+        # AppendEntries it sent
+        self.leader_commit = -1
+        self.last_heartbeat = 0.0
+        # the (monotonic) time this node last granted a vote, which, like a
+        # heartbeat, puts off its own election
+        self.voted_at = 0.0
+        # index of the last log entry known to be on disk. `persist` runs in
+        # another thread, so this, and the count of truncations that tells it
+        # whether the entries it synced are still in the log, go under a lock
+        self.persisted_index = -1
+        self._persist_lock = threading.Lock()
+        self._truncations = 0
         self.commit_index = -1
         self.last_applied = -1
+        # set by a background applier (see `replication.Applier`), which is
+        # then told when `commit_index` advances. Otherwise entries are
+        # applied as soon as they are committed
+        self.on_commit: Callable[[], None] | None = None
+        # set by the replicator, which is told when this node stops being
+        # leader (its term or role changes), so that it can fail the
+        # proposals and reads waiting on it
+        self.on_deposed: Callable[[], None] | None = None
         self.next_index: Dict[str, int] = dict()
         self.match_index: Dict[str, int] = dict()
 
         # -- non-volatile state (write to disk before confirming update) --
-        self.log: List[Entry] = list()
+        self.log: MemoryLog[Entry] | SegmentedLog[Entry] = MemoryLog(
+            encode_entry, decode_entry, entry_term)
         self.current_term: int = 0
         self.voted_for: str = ''
+        # the store as of `snapshot_index`. Log entries up to and including
+        # that index may have been discarded. The snapshot is kept in a file
+        # in the data directory, and read from it as it is needed, or else
+        # in memory (see `open_snapshot`)
+        self.snapshot_index = -1
+        self.snapshot_term = 0
+        self.snapshot_size = 0
+        self._snapshot_data = b''
+
+        # take a snapshot once this many entries have been applied since the
+        # last one
+        self.snapshot_entries = int(
+            os.environ.get('RSB_SNAPSHOT_ENTRIES', 10000))
+        self.metrics = Metrics()
+        # the expiry time of every key written with a TTL. Only the leader
+        # acts on it, by committing EXPIRE entries for the keys that are due
+        self.expiry = TimingWheel(
+            int(os.environ.get('RSB_EXPIRY_TICK_MS', 100)), now=now_ms())
+        # counts the times the store was replaced by a snapshot, which
+        # spoils any snapshot being taken of it at the time
+        self._restores = 0
+        # while the store is being restored in another thread (see
+        # `install_received`), nothing is applied to it or read from it
+        self._restoring = False
+        # the chunks so far of a snapshot being sent by the leader, written
+        # to a file next to the snapshot, or else kept in memory
+        self._incoming: BinaryIO | None = None
+        self._incoming_size = 0
+        self._incoming_started = 0.0
+        self._received: ReceivedSnapshot | None = None
+
+        # without a data directory, the non-volatile state is only kept in
+        # memory (e.g.: for tests and throwaway single-node deployments)
+        data_dir = data_dir or os.environ.get('RSB_DATA_DIR')
+        self.wal: WriteAheadLog | None = None
+        self._wal_seq = 0
+        self._snapshot_path: str | None = None
+        if data_dir:
+            self.wal = WriteAheadLog(os.path.join(data_dir, 'wal'))
+            self.log = SegmentedLog(
+                os.path.join(data_dir, 'log'),
+                encode_entry, decode_entry, entry_term)
+            self._snapshot_path = os.path.join(data_dir, 'snapshot')
+            self._recover()
+
+    def _recover(self):
+        """Rebuilds the term and vote by replaying the write-ahead log, and
+        the store from the latest snapshot (the log entries recover
+        themselves). The rest of the volatile state (commit index, applied
+        entries) is re-learned from the leader, as described in the raft
+        paper."""
+        assert self.wal is not None and self._snapshot_path is not None
+        for _, record in self.wal.records():
+            kind, value = _RECORD.unpack_from(record)
+            if kind == _TERM_RECORD:
+                self.current_term = value
+                self.voted_for = record[_RECORD.size:].decode()
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path, 'rb') as f:
+                index, term, _ = _decode_snapshot(f)
+            self._set_snapshot(
+                index, term, os.path.getsize(self._snapshot_path))
+            if (isinstance(self.store, LSMStore)
+                    and self.store.durable_index >= index):
+                # the store outlived the restart, and already holds the
+                # snapshot. The entries after it are applied again as they
+                # are committed, which leaves each key as it was
+                self._begin_restore()
+                self.finish_restore(self.restore_store(replace=False))
+            else:
+                self._restore_snapshot()
+            # a crash while installing a snapshot can leave the log that it
+            # replaced behind
+            index = self.snapshot_index
+            if len(self.log) <= index or (
+                    index >= self.log.first_index
+                    and self.log.term(index) != self.snapshot_term):
+                self._reset_log(index + 1)
+
+    def _log_record(self, kind: int, value: int, body: bytes = b''):
+        if self.wal:
+            self._wal_seq = self.wal.append(_RECORD.pack(kind, value) + body)
+
+    def persist(self):
+        """Blocks until every change to the non-volatile state is on disk.
+        This must be called before responding to any RPC that changed it. It
+        may be called from another thread, while the event loop goes on
+        changing the state."""
+        with self._persist_lock:
+            last_index = len(self.log) - 1
+            truncations = self._truncations
+        if self.wal:
+            self.wal.sync(self._wal_seq)
+        if isinstance(self.log, SegmentedLog):
+            self.log.sync()
+        with self._persist_lock:
+            # entries truncated in the meantime may have been replaced by
+            # ones that were appended after the sync
+            if self._truncations == truncations:
+                self.persisted_index = max(self.persisted_index, last_index)
 
-    def _apply_entry(self, entry: Entry):
+    def _deposed(self):
+        if self.role == Role.LEADER and self.on_deposed:
+            self.on_deposed()
+
+    def _set_term(self, term: int, voted_for: str):
+        self._deposed()
+        self.current_term = term
+        self.voted_for = voted_for
+        self._log_record(_TERM_RECORD, term, voted_for.encode())
+
+    def _truncate_log(self, index: int):
+        """Drops the entry at `index` and every entry after it"""
+        with self._persist_lock:
+            self._truncations += 1
+            self.persisted_index = min(self.persisted_index, index - 1)
+        del self.log[index:]
+
+    def _reset_log(self, first_index: int):
+        """Drops every entry, so that the next one appended is at
+        `first_index`"""
+        with self._persist_lock:
+            self._truncations += 1
+            self.persisted_index = min(self.persisted_index, first_index - 1)
+        self.log.reset(first_index)
+
+    def _extend_log(self, entries: List[Entry]):
+        self.log.extend(entries)
+
+    def term_at(self, index: int) -> int:
+        """Returns the term of the entry at `index`, which may be the last
+        entry covered by the snapshot. Raises `IndexError` if there is no such
+        entry."""
+        if index == self.snapshot_index:
+            return self.snapshot_term
+        return self.log.term(index)
+
+    def _first_index_of(self, term: int, index: int) -> int:
+        """Returns the first index of the run of entries in `term` that ends
+        at `index`, at or after the snapshot. Terms never decrease along the
+        log, so this is a binary search."""
+        low, high = self.snapshot_index + 1, index
+        while low < high:
+            mid = (low + high) // 2
+            if self.log.term(mid) < term:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def conflict_next_index(self, conflict_term: int, conflict_index: int) -> int:
+        """Returns the index to send a follower from next, after it rejected
+        AppendEntries with the given hints: just past this node's last entry
+        in `conflict_term` if it has any, or else `conflict_index`, skipping
+        the follower's entries in that term"""
+        last = len(self.log) - 1
+        if conflict_term and last > self.snapshot_index:
+            # the last index with a term no greater than conflict_term
+            low, high = self.snapshot_index, last
+            while low < high:
+                mid = (low + high + 1) // 2
+                if self.log.term(mid) <= conflict_term:
+                    low = mid
+                else:
+                    high = mid - 1
+            if low > self.snapshot_index and self.log.term(low) == conflict_term:
+                return low + 1
+        return conflict_index
+
+    def open_snapshot(self) -> BinaryIO:
+        """Opens the current snapshot for reading"""
+        if self._snapshot_path and self.snapshot_index >= 0:
+            return open(self._snapshot_path, 'rb')
+        return io.BytesIO(self._snapshot_data)
+
+    def _set_snapshot(self, index: int, term: int, size: int):
+        """Records that the snapshot in place is now the current one"""
+        self.snapshot_index = index
+        self.snapshot_term = term
+        self.snapshot_size = size
+        self.metrics.set('snapshot_bytes', size)
+        self.metrics.set('snapshot_index', index)
+
+    def _restore_snapshot(self):
+        """Replaces the store with the contents of the current snapshot"""
+        self._begin_restore()
+        self.finish_restore(self.restore_store())
+
+    def _begin_restore(self):
+        self._restores += 1
+        self._restoring = True
+
+    def restore_store(
+            self, replace: bool = True) -> Tuple[int, Dict[str, int]]:
+        """Replaces the contents of the store with those of the current
+        snapshot, which are read from it as they are restored, and returns
+        the snapshot's index and the expiry time of each key that has one.
+        With `replace` false, only the expiry times are read. This touches
+        nothing but the store, so it may run in another thread, once
+        `install_received` has left the restore to the caller."""
+        deadlines: Dict[str, int] = dict()
+        with self.open_snapshot() as f:
+            index, _, pairs = _decode_snapshot(f)
+
+            def items():
+                for key, value, expires in pairs:
+                    if expires:
+                        deadlines[key] = expires
+                    yield key, value
+            if replace:
+                self.store.restore(items(), index)
+            else:
+                for _ in items():
+                    pass
+        return index, deadlines
+
+    def finish_restore(self, restored: Tuple[int, Dict[str, int]]):
+        """Brings the rest of the state up to the store restored by
+        `restore_store`, and applies any entries committed meanwhile"""
+        index, deadlines = restored
+        self.expiry.clear()
+        for key, expires in deadlines.items():
+            self.expiry.schedule(key, expires)
+        self._restoring = False
+        self.commit_index = max(self.commit_index, index)
+        self.last_applied = index
+        self._apply_committed()
+
+    def snapshot_due(self) -> bool:
+        return self.last_applied - self.snapshot_index >= self.snapshot_entries
+
+    def take_snapshot(self):
+        """Snapshots the store as of `last_applied`, and discards the log
+        entries that the snapshot covers"""
+        pending = self.begin_snapshot()
+        if pending:
+            self.write_snapshot(pending)
+            self.finish_snapshot(pending)
+
+    def begin_snapshot(self) -> PendingSnapshot | None:
+        """Takes a view of the store as of `last_applied`, for a snapshot.
+        Entries applied after this are not seen by the view (see
+        `store.Store.pin`), so `write_snapshot` can run in another thread
+        while they are."""
+        if self._restoring or self.last_applied <= self.snapshot_index:
+            return None
+        index = self.last_applied
+        items = self.store.items()
+        # take the view now, rather than once the pairs start to be read
+        first = next(items, None)
+        return PendingSnapshot(
+            index, self.term_at(index),
+            itertools.chain([first] if first else [], items),
+            self.expiry.items(), self._restores)
+
+    def write_snapshot(self, pending: PendingSnapshot):
+        """Encodes a snapshot, streaming it to disk if this node has a data
+        directory. This reads nothing but the snapshot's view of the store,
+        so it may run in another thread."""
+        pieces = _encode_snapshot(
+            pending.index, pending.term, pending.items, pending.expires)
+        if not self._snapshot_path:
+            pending.data = b''.join(pieces)
+            pending.size = len(pending.data)
+            return
+        with open(self._snapshot_path + '.taking', 'wb') as f:
+            for piece in pieces:
+                pending.size += f.write(piece)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish_snapshot(self, pending: PendingSnapshot):
+        """Makes a snapshot written by `write_snapshot` the current one, and
+        discards the log entries that it covers. A snapshot that has been
+        overtaken by one installed from the leader in the meantime is
+        dropped."""
+        path = self._snapshot_path
+        if (pending.index <= self.snapshot_index
+                or pending.restores != self._restores):
+            if path and os.path.exists(path + '.taking'):
+                os.remove(path + '.taking')
+            return
+        if path:
+            os.replace(path + '.taking', path)
+        else:
+            self._snapshot_data = pending.data
+        self._set_snapshot(pending.index, pending.term, pending.size)
+        self.log.compact(pending.index)
+        self.metrics.observe(
+            'snapshot_duration_seconds',
+            time.perf_counter() - pending.started)
+
+    def snapshot_chunk(
+            self, offset: int, size: int = SNAPSHOT_CHUNK_BYTES
+    ) -> Tuple[bytes, bool]:
+        """Returns the part of the current snapshot starting at `offset`, for
+        sending to a follower whose `next_index` is at or before
+        `snapshot_index`, and whether it is the last chunk"""
+        with self.open_snapshot() as f:
+            f.seek(offset)
+            chunk = f.read(size)
+        return chunk, offset + len(chunk) >= self.snapshot_size
+
+    def _apply_entry(self, entry: Entry, index: int | None = None):
         """This method takes an entry that should be committed to the state
         of the data store, and performs the specified transformation of that
         state. It should not be called directly, but only under the call chain
@@ -90,26 +675,103 @@ class State:
         never happen as the AppendEntry handler should reject malformed writes
         before they make it to the log. An alternative for the near term would
         be to remove the exception paths and let this method silently no-op,
-        since the malformed entry would not be applied anyway."""
+        since the malformed entry would not be applied anyway.
+
+        `index` is the entry's position in the log, which tags the store
+        version it writes."""
         if entry.op == Op.WRITE:
             if entry.value:
-                self.store.upsert(entry.key, entry.value)
+                self.store.upsert(entry.key, entry.value, index)
+                self._set_expiry(entry.key, entry.expires)
             else:
                 raise InvalidOperationException(
                     f"Invalid Entry: write missing value for key {entry.key}")
         elif entry.op == Op.DELETE:
-            self.store.delete(entry.key)
+            self.store.delete(entry.key, index)
+            self._set_expiry(entry.key, 0)
+        elif entry.op == Op.EXPIRE:
+            if self.expiry.deadline(entry.key) == entry.expires:
+                self.store.delete(entry.key, index)
+                self._set_expiry(entry.key, 0)
+        elif entry.op == Op.DELETE_PREFIX:
+            deleted = self.store.delete_range(
+                entry.key or None, prefix_end(entry.key), index)
+            for key in deleted:
+                self._set_expiry(key, 0)
+        elif entry.op == Op.BATCH:
+            writes: List[Tuple[str, Value | None]] = list()
+            # the expiry time of each key written by the batch so far
+            expires: Dict[str, int] = dict()
+            for e in _unpack_batch(entry):
+                if e.op == Op.WRITE and e.value:
+                    writes.append((e.key, e.value))
+                    expires[e.key] = e.expires
+                elif e.op == Op.DELETE:
+                    writes.append((e.key, None))
+                    expires[e.key] = 0
+                elif e.op == Op.EXPIRE:
+                    current = expires.get(e.key)
+                    if current is None:
+                        current = self.expiry.deadline(e.key)
+                    if current == e.expires:
+                        writes.append((e.key, None))
+                        expires[e.key] = 0
+                elif e.op == Op.BATCH:
+                    raise InvalidOperationException(
+                        "Invalid Operation: nested batch")
+                else:
+                    raise InvalidOperationException(
+                        f"Invalid Entry: {e.op} for key {e.key}")
+            self.store.apply(writes, index)
+            for key, deadline in expires.items():
+                self._set_expiry(key, deadline)
         else:
             raise InvalidOperationException(f"Invalid Operation: {entry.op}")
 
+    def _set_expiry(self, key: str, expires: int):
+        if expires:
+            self.expiry.schedule(key, expires)
+        else:
+            self.expiry.cancel(key)
+
     def _apply_entries(self, entries: List[Entry]):
         """This method takes a list of entries that should be committed to the
         state of the data store, and performs the specified transformation of
         that state. It should not be called directly, but only under the call
         chain of the handler that is responsible for accepting commit ops from
         the leader node, or the task that decides entries are ready to commit,
-        if this node is the leader."""
-        [self._apply_entry(en) for en in entries]
+        if this node is the leader. The entries follow `last_applied`."""
+        first = self.last_applied + 1
+        for i, en in enumerate(entries):
+            self._apply_entry(en, first + i)
+
+    def _apply_committed(self):
+        """Applies every entry up to `commit_index` that has not yet been
+        applied, or leaves them to the background applier if there is one"""
+        if self.on_commit:
+            self.on_commit()
+        else:
+            self.apply_committed()
+
+    def apply_committed(self, limit: int | None = None) -> int:
+        """Applies up to `limit` of the entries up to `commit_index` that
+        have not yet been applied, takes a snapshot if enough entries have
+        built up (unless there is a background applier), and returns how
+        many were applied"""
+        if self._restoring:
+            return 0
+        end = self.commit_index
+        if limit is not None:
+            end = min(end, self.last_applied + limit)
+        if end <= self.last_applied:
+            return 0
+        count = end - self.last_applied
+        self._apply_entries(self.log[self.last_applied + 1:end + 1])
+        self.last_applied = end
+        # a background applier takes its snapshots off the event loop
+        if self.on_commit is None and self.snapshot_due():
+            self.take_snapshot()
+        return count
 
     def append_entries(
             self,
@@ -118,63 +780,374 @@ class State:
             prev_log_index: int,
             prev_log_term: int,
             entries: List[Entry],
-            leader_commit: int
+            leader_commit: int,
+            sync: bool = True
     ) -> AppendResult:
         """Performs various tasks needed to ensure consistent state of both the
         data store and also of the node leader election process and log
         shipping behavior. This endpoint is complex by necessity. See the
         'AppendEntriesRPC' and 'Rules for Servers' sections of the raft paper.
+        With `sync` false, the changes are not made durable here, and the
+        caller must `persist` them before responding, e.g.: from another
+        thread.
         """
         if term < self.current_term:
             # ae from expired leader
             return AppendResult(self.current_term, False)
         if term > self.current_term:
             # election happened, become follower, vote for messenger
-            self.current_term = term
-            self.voted_for = leader_id
+            self._set_term(term, leader_id)
+            self.role = Role.FOLLOWER
+        elif self.role == Role.CANDIDATE:
+            # another node won the election for this term
             self.role = Role.FOLLOWER
         # not currently explicitly checking leader_id against voted_for, as
         # this would be a byzantine general failure which is beyond the scope
         # of this implementation to prevent
-        if prev_log_index == -1:
-            # only before any logs have been shipped
-            self.log.extend(entries)
-            return AppendResult(self.current_term, True)
+        self.leader_id = leader_id
+        self.leader_commit = leader_commit
+        self.last_heartbeat = time.monotonic()
+        # keep the expiry wheel current, ready for if this node is elected
+        self.expiry.advance(now_ms())
+        if prev_log_index < self.snapshot_index:
+            # entries covered by the snapshot are committed, so they must
+            # already match the leader's
+            entries = entries[self.snapshot_index - prev_log_index:]
+            prev_log_index = self.snapshot_index
+            prev_log_term = self.snapshot_term
         try:
-            prev_log = self.log[prev_log_index]
+            prev_term = self.term_at(prev_log_index)
         except IndexError:
             # previous entry missing
-            return AppendResult(self.current_term, False)
+            if sync:
+                self.persist()
+            return AppendResult(
+                self.current_term, False, conflict_index=len(self.log))
         else:
             # entry found, check term
-            if prev_log.term != prev_log_term:
+            if prev_term != prev_log_term:
+                # the leader can skip the rest of this term in one go
+                first = self._first_index_of(prev_term, prev_log_index)
                 # drop mismatched log
-                self.log = self.log[:prev_log_index]
-                return AppendResult(self.current_term, False)
-        if len(self.log) > prev_log_index:
-            # drop logs past previous known index
-            self.log = self.log[:prev_log_index+1]
-            self.log.extend(entries)
+                self._truncate_log(prev_log_index)
+                if sync:
+                    self.persist()
+                return AppendResult(
+                    self.current_term, False, prev_term, first)
+        # entries that are already in the log (same index and term) are
+        # skipped rather than rewritten, and the log is only truncated at the
+        # first conflicting entry. Otherwise a delayed or duplicated request
+        # could drop entries that a later request already appended
+        index = prev_log_index + 1
+        for n, entry in enumerate(entries):
+            if index + n >= len(self.log):
+                self._extend_log(entries[n:])
+                break
+            if self.log.term(index + n) != entry.term:
+                self._truncate_log(index + n)
+                self._extend_log(entries[n:])
+                break
+        if sync:
+            self.persist()
         if leader_commit > self.commit_index:
-            self.commit_index = min(leader_commit, len(self.log))
-        if self.commit_index > self.last_applied:
-            self._apply_entries(
-                self.log[self.last_applied + 1:self.commit_index + 1])
+            self.commit_index = min(leader_commit, index + len(entries) - 1)
+        self._apply_committed()
         return AppendResult(self.current_term, True)
 
-    def request_vote(self, term: int, candidate_id: str, last_log_index: int, last_log_term: int):
-        local_last_log_index = len(self.log)-1
-        index_match = last_log_index == local_last_log_index
-        if local_last_log_index > -1:
-            local_last_log_term = self.log[local_last_log_index].term
+    def install_snapshot(
+            self,
+            term: int,
+            leader_id: str,
+            last_included_index: int,
+            last_included_term: int,
+            offset: int,
+            data: bytes,
+            done: bool,
+            sync: bool = True
+    ) -> InstallSnapshotResult:
+        """Receives one chunk of a snapshot from the leader, and installs the
+        snapshot once the last chunk arrives. See the 'InstallSnapshot RPC'
+        section of the raft paper. Unlike the paper, the result also reports
+        whether the chunk was accepted, so that the leader can restart the
+        transfer if a chunk went missing. With `sync` false, nothing is made
+        durable here, and a complete snapshot is only received: the caller
+        must `sync_received`, `install_received` and then `persist`, e.g.:
+        with the syncs in another thread."""
+        if term < self.current_term:
+            return InstallSnapshotResult(self.current_term, False)
+        if term > self.current_term:
+            self._set_term(term, leader_id)
+            self.role = Role.FOLLOWER
+            if sync:
+                self.persist()
+        elif self.role == Role.CANDIDATE:
+            self.role = Role.FOLLOWER
+        # each chunk counts as contact from the leader, so that a long
+        # transfer does not start an election
+        self.leader_id = leader_id
+        self.last_heartbeat = time.monotonic()
+        path = self._snapshot_path
+        if offset == 0:
+            if self._incoming:
+                self._incoming.close()
+            self._incoming = (open(path + '.incoming', 'wb') if path
+                              else io.BytesIO())
+            self._incoming_size = 0
+            self._incoming_started = time.perf_counter()
+        if self._incoming is None or offset != self._incoming_size:
+            return InstallSnapshotResult(self.current_term, False)
+        self._incoming_size += self._incoming.write(data)
+        if not done:
+            return InstallSnapshotResult(self.current_term, True)
+
+        incoming, self._incoming = self._incoming, None
+        if last_included_index <= self.snapshot_index:
+            # already have a more recent snapshot
+            incoming.close()
+            return InstallSnapshotResult(self.current_term, True)
+        self._received = ReceivedSnapshot(
+            last_included_index, last_included_term, incoming,
+            self._incoming_size, self._incoming_started)
+        if sync:
+            self.sync_received()
+            self.install_received()
+            self.persist()
+        return InstallSnapshotResult(self.current_term, True)
+
+    def sync_received(self):
+        """Blocks until the snapshot received by `install_snapshot`, if any,
+        is on disk. This touches nothing else, so it may run in another
+        thread."""
+        received = self._received
+        if received and not isinstance(received.incoming, io.BytesIO):
+            received.incoming.flush()
+            os.fsync(received.incoming.fileno())
+
+    def install_received(self, restore: bool = True) -> bool:
+        """Makes the snapshot received by `install_snapshot`, once it is on
+        disk, the current one: the log entries it covers are discarded, and
+        the store restored from it, unless the store is already past it.
+        Returns whether the store is to be restored, which, with `restore`
+        false, is left to the caller: it must pass the result of
+        `restore_store` to `finish_restore`."""
+        received, self._received = self._received, None
+        if received is None:
+            return False
+        index = received.index
+        if index <= self.snapshot_index:
+            received.incoming.close()
+            return False
+        try:
+            retain = self.term_at(index) == received.term
+        except IndexError:
+            retain = False
+        if isinstance(received.incoming, io.BytesIO):
+            self._snapshot_data = received.incoming.getvalue()
+        elif self._snapshot_path:
+            received.incoming.close()
+            os.replace(self._snapshot_path + '.incoming', self._snapshot_path)
+        self._set_snapshot(index, received.term, received.size)
+        if retain:
+            # keep the entries that follow the snapshot
+            self.log.compact(index)
+        else:
+            self._reset_log(index + 1)
+        self.metrics.inc('snapshots_installed')
+        self.metrics.observe(
+            'snapshot_catch_up_seconds',
+            time.perf_counter() - received.started)
+        # a store that is already past the snapshot must not be taken back
+        # to it (see rule 6 of figure 13 of the raft paper)
+        if retain and self.last_applied >= index:
+            return False
+        if restore:
+            self._restore_snapshot()
         else:
-            local_last_log_term = 0
-        term_match = last_log_term == local_last_log_term
-        if term > self.current_term and index_match and term_match:
+            self._begin_restore()
+        return True
+
+    def _up_to_date(self, last_log_index: int, last_log_term: int) -> bool:
+        """Whether a candidate's log is at least as up to date as this
+        node's, so that a leader always has every committed entry"""
+        local_last_log_index = len(self.log)-1
+        local_last_log_term = self.term_at(local_last_log_index)
+        return (last_log_term, last_log_index) >= (
+            local_last_log_term, local_last_log_index)
+
+    def pre_vote(
+            self,
+            term: int,
+            candidate_id: str,
+            last_log_index: int,
+            last_log_term: int,
+            leader_timeout: float
+    ) -> VoteResult:
+        """Says whether this node would vote for the candidate in `term`,
+        without changing any state. A node that has heard from a leader, or
+        voted for a candidate, within `leader_timeout` seconds would not, so
+        that a node that lost touch with the leader on its own cannot force an
+        election. See the 'Preventing disruptions when a server rejoins the
+        cluster' section of the raft dissertation."""
+        contact = max(
+            self.last_heartbeat if self.leader_id else 0.0, self.voted_at)
+        leader_alive = (self.role == Role.LEADER
+                        or time.monotonic() - contact < leader_timeout)
+        grant = (term > self.current_term and not leader_alive
+                 and self._up_to_date(last_log_index, last_log_term))
+        return VoteResult(term=self.current_term, vote_granted=grant)
+
+    def request_vote(
+            self,
+            term: int,
+            candidate_id: str,
+            last_log_index: int,
+            last_log_term: int,
+            sync: bool = True
+    ) -> VoteResult:
+        """Grants the candidate this node's vote in `term`, if it has no
+        other and the candidate's log is up to date. With `sync` false, the
+        vote is not made durable here, and the caller must `persist` it before
+        responding."""
+        up_to_date = self._up_to_date(last_log_index, last_log_term)
+        # one vote per term
+        can_vote = term > self.current_term or (
+            term == self.current_term and self.role == Role.FOLLOWER
+            and self.voted_for in ('', candidate_id))
+        if can_vote and up_to_date:
             grant = True
-            self.current_term = term
-            self.voted_for = candidate_id
+            self._set_term(term, candidate_id)
             self.role = Role.FOLLOWER
+            self.voted_at = time.monotonic()
+            if sync:
+                self.persist()
         else:
             grant = False
         return VoteResult(term=self.current_term, vote_granted=grant)
+
+    def is_fresh(
+            self,
+            max_lag: int | None = None,
+            max_staleness: float | None = None
+    ) -> bool:
+        """Whether the store is recent enough to serve a read that tolerates
+        being `max_lag` entries behind the leader's commit index, or
+        `max_staleness` seconds out of date. A follower only knows the
+        leader's commit index as of the last heartbeat, so its store is as
+        recent as that heartbeat at best."""
+        if self._restoring:
+            return False
+        if self.role == Role.LEADER:
+            return True
+        if not self.leader_id:
+            return False
+        lag = self.leader_commit - self.last_applied
+        if max_lag is not None and lag > max_lag:
+            return False
+        if max_staleness is not None and (
+                lag > 0
+                or time.monotonic() - self.last_heartbeat > max_staleness):
+            return False
+        return True
+
+    def is_expired(self, key: str) -> bool:
+        """Whether `key` has expired, though it may not have been deleted
+        yet"""
+        expires = self.expiry.deadline(key)
+        return expires is not None and expires <= now_ms()
+
+    def due_expiries(self, limit: int) -> List[Entry]:
+        """Returns EXPIRE entries for up to `limit` keys that have expired,
+        for the leader to commit"""
+        self.expiry.advance(now_ms())
+        return [Entry(op=Op.EXPIRE, key=key, value=None,
+                      term=self.current_term, expires=expires)
+                for key, expires in self.expiry.due(limit)]
+
+    # ----- candidate -----
+    def become_candidate(self) -> dict:
+        """Stands for election in the next term, voting for this node, and
+        returns the arguments of the RequestVote RPC to send the others. The
+        new term must be persisted before it is sent."""
+        self._set_term(self.current_term + 1, self.address)
+        self.role = Role.CANDIDATE
+        self.leader_id = ''
+        return self.vote_request(self.current_term)
+
+    def vote_request(self, term: int) -> dict:
+        """Returns the arguments of a RequestVote (or pre-vote) RPC for this
+        node in `term`"""
+        last = len(self.log) - 1
+        return dict(
+            term=term,
+            candidate_id=self.address,
+            last_log_index=last,
+            last_log_term=self.term_at(last))
+
+    # ----- leader -----
+    def become_leader(self):
+        """Takes over as leader for the current term. Every follower is
+        assumed to be up to date until it says otherwise."""
+        self.role = Role.LEADER
+        self.leader_id = self.address
+        for node in self.foreign_nodes.values():
+            node.next_index = len(self.log)
+            node.match_index = -1
+
+    def abdicate(self):
+        """Reverts to follower in the current term, keeping its vote, after
+        losing touch with a majority of the cluster"""
+        self._deposed()
+        self.role = Role.FOLLOWER
+        self.leader_id = ''
+
+    def step_down(self, term: int):
+        """Reverts to follower after seeing a newer term in a response"""
+        self._set_term(term, '')
+        self.role = Role.FOLLOWER
+        self.leader_id = ''
+        self.persist()
+
+    def leader_append(self, entries: List[Entry]) -> int:
+        """Appends client entries to the leader's own log, and returns the
+        index of the last one. The entries are not durable, and so do not
+        count towards a quorum, until `persist` has returned."""
+        if self.role != Role.LEADER:
+            raise NotLeaderException(self.leader_id)
+        self._extend_log(entries)
+        return len(self.log) - 1
+
+    def append_request(self, next_index: int, max_entries: int) -> dict | None:
+        """Returns the arguments of an AppendEntries RPC for a follower whose
+        next entry is at `next_index`, carrying up to `max_entries` entries.
+        Returns `None` if the entry before `next_index` has been compacted, in
+        which case the follower must be sent a snapshot instead."""
+        if next_index <= self.snapshot_index or (
+                next_index < self.log.first_index):
+            return None
+        return dict(
+            term=self.current_term,
+            leader_id=self.address,
+            prev_log_index=next_index - 1,
+            prev_log_term=self.term_at(next_index - 1),
+            entries=self.log[next_index:next_index + max_entries],
+            leader_commit=self.commit_index)
+
+    def committed_in_current_term(self) -> bool:
+        """Whether this leader has committed an entry from its own term. Until
+        it has, it cannot know which entries from earlier terms are
+        committed."""
+        return (self.commit_index > -1
+                and self.term_at(self.commit_index) == self.current_term)
+
+    def advance_commit(self):
+        """Advances `commit_index` to the highest entry from the current term
+        that is durable on a majority of nodes, and applies everything up to
+        it. See the last of the 'Rules for Servers' for leaders."""
+        matches = sorted(
+            [n.match_index for n in self.foreign_nodes.values()]
+            + [self.persisted_index],
+            reverse=True)
+        n = matches[len(matches) // 2]
+        if n > self.commit_index and self.term_at(n) == self.current_term:
+            self.commit_index = n
+            self._apply_committed()
@@ -0,0 +1,518 @@
+import asyncio
+import base64
+import heapq
+import os
+import time
+from typing import Callable, Dict, List, Tuple
+
+import httpx
+
+import codec
+from raft import (
+    AppendResult, Entry, ForeignNode, NotLeaderException, PendingSnapshot,
+    Role, State, batch_entry)
+
+
+class ReadMode:
+    # serve reads from the local store, with no consistency guarantee
+    LOCAL = 'local'
+    # confirm leadership with a round of heartbeats before each read
+    READ_INDEX = 'read_index'
+    # skip the heartbeat round while the leader's lease is valid
+    LEASE = 'lease'
+
+
+def _client(address: str, connections: int, timeout: float) -> httpx.AsyncClient:
+    return httpx.AsyncClient(
+        base_url=f'http://{address}',
+        limits=httpx.Limits(
+            max_connections=connections,
+            max_keepalive_connections=connections),
+        timeout=timeout)
+
+
+def _entry_json(entry: Entry) -> dict:
+    if isinstance(entry.value, bytes):
+        # a compressed value goes in base64
+        return dict(op=entry.op, key=entry.key,
+                    value=base64.b64encode(entry.value).decode(),
+                    term=entry.term, expires=entry.expires, compressed=True)
+    return dict(op=entry.op, key=entry.key, value=entry.value, term=entry.term,
+                expires=entry.expires)
+
+
+class Replicator:
+    """
+    Leader-side log replication
+
+    While this node is leader, one asyncio task per follower ships new log
+    entries to it over a pool of keep-alive HTTP connections. Each task keeps
+    up to `max_in_flight` AppendEntries requests outstanding at once, rather
+    than waiting for each acknowledgement before sending the next batch, and
+    advances `commit_index` as soon as a quorum of `match_index` values allows
+    it. Idle followers are sent an empty AppendEntries as a heartbeat every
+    `heartbeat_interval` seconds.
+
+    Clients write through `propose`, which appends to the leader's log and
+    waits until the entries have been committed and applied. Linearizable
+    reads go through `read_index` (see the 'Processing read-only queries
+    more efficiently' section of the raft dissertation).
+    """
+    def __init__(
+            self,
+            state: State,
+            max_in_flight: int = 4,
+            batch_entries: int = 256,
+            heartbeat_interval: float | None = None,
+            timeout: float = 1.0,
+            binary: bool | None = None,
+            read_mode: str | None = None,
+            lease: float | None = None,
+            client_factory: Callable[[str], httpx.AsyncClient] | None = None
+    ):
+        self.state = state
+        self.read_mode = read_mode or os.environ.get(
+            'RSB_READ_MODE', ReadMode.LOCAL)
+        # how long after a quorum of followers acknowledged a heartbeat that
+        # no other leader can have been elected. This must be shorter than the
+        # minimum election timeout, less an allowance for clock drift
+        if lease is None:
+            lease = int(os.environ.get('RSB_LEASE_MS', 100)) / 1000
+        self.lease = lease
+        # send RPCs in the compact `codec` framing rather than JSON
+        if binary is None:
+            binary = os.environ.get('RSB_WIRE_CODEC', 'binary') == 'binary'
+        self.binary = binary
+        self.max_in_flight = max_in_flight
+        self.batch_entries = batch_entries
+        if heartbeat_interval is None:
+            heartbeat_interval = int(
+                os.environ.get('RSB_HEARTBEAT_MS', 50)) / 1000
+        self.heartbeat_interval = heartbeat_interval
+        # dependency injection primarily for test setup
+        self.client_factory = client_factory or (
+            lambda address: _client(address, max_in_flight, timeout))
+
+        self._tasks: List[asyncio.Task] = list()
+        # the term the tasks were started in
+        self._term = -1
+        self._wake: Dict[str, asyncio.Event] = dict()
+        # (log index, sequence number, term, future) for each pending
+        # proposal or read, where the term is that of the entry it waits on
+        self._waiters: List[
+            Tuple[int, int, int, asyncio.Future[int]]] = list()
+        self._waiter_seq = 0
+        state.on_deposed = self._fail_waiters
+        # the send time of the latest request each follower has answered
+        # without rejecting this node's term
+        self._acks: Dict[str, float] = dict()
+        self._acked = asyncio.Event()
+        self._confirm_requested = 0.0
+        # while leadership is being handed over (see `begin_transfer`)
+        self._transfer_until = 0.0
+
+    # ----- lifecycle -----
+    def start(self):
+        """Starts a replication task for each follower, and the expiry task,
+        if this node is leader and they are not already running for its
+        current term"""
+        state = self.state
+        if state.role != Role.LEADER or (
+                self._term == state.current_term
+                and not any(t.done() for t in self._tasks)):
+            return
+        # tasks from an earlier term may not have noticed the step down yet,
+        # and acknowledgements of its heartbeats say nothing about this one
+        for task in self._tasks:
+            task.cancel()
+        if self._term != state.current_term:
+            # nothing proposed in an earlier term can be vouched for now
+            self._fail_waiters()
+        self._term = state.current_term
+        self._tasks = list()
+        self._acks.clear()
+        for address, node in self.state.foreign_nodes.items():
+            self._wake[address] = asyncio.Event()
+            self._tasks.append(
+                asyncio.create_task(self._replicate(address, node)))
+        self._tasks.append(asyncio.create_task(self._expire()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = list()
+        self._fail_waiters()
+
+    def _kick(self):
+        for event in self._wake.values():
+            event.set()
+
+    # ----- leadership transfer -----
+    def begin_transfer(self, timeout: float):
+        """Stops taking proposals, and gives up the lease, for `timeout`
+        seconds while another node stands for election at this leader's
+        request. That node does not wait out an election timeout before it
+        stands, so it may win before this one hears of it, however recently
+        a majority acknowledged this leader. See the 'Leadership transfer
+        extension' section of the raft dissertation."""
+        self._acks.clear()
+        self._transfer_until = time.monotonic() + timeout
+
+    def end_transfer(self):
+        """Takes proposals again, say after the other node could not be
+        reached. The lease comes back with the next round of heartbeats."""
+        self._transfer_until = 0.0
+
+    def transferring(self) -> bool:
+        return time.monotonic() < self._transfer_until
+
+    # ----- client writes -----
+    async def propose(self, entries: List[Entry]) -> int:
+        """Appends `entries` to the log, and returns the index of the last one
+        once it has been committed and applied. Raises `NotLeaderException` if
+        this node is not (or stops being) the leader, or is handing over
+        leadership."""
+        if self.transferring():
+            raise NotLeaderException(self.state.leader_id)
+        index = self.state.leader_append(entries)
+        self.start()
+        self._kick()
+        future = self._wait_applied(index, self.state.current_term)
+        # other proposals can append while this one waits for the disk, and
+        # will share its flush (see `wal.WriteAheadLog.sync`)
+        await asyncio.to_thread(self.state.persist)
+        self._advance_commit()
+        return await future
+
+    def _wait_applied(self, index: int, term: int) -> asyncio.Future[int]:
+        """Returns a future for when the entry at `index`, which is in
+        `term`, has been applied. It fails with `NotLeaderException` if this
+        node stops being leader first."""
+        future: asyncio.Future[int] = (
+            asyncio.get_running_loop().create_future())
+        if index <= self.state.last_applied:
+            future.set_result(index)
+            return future
+        self._waiter_seq += 1
+        heapq.heappush(
+            self._waiters, (index, self._waiter_seq, term, future))
+        return future
+
+    def _advance_commit(self):
+        if self.state.role != Role.LEADER:
+            self._fail_waiters()
+            return
+        self.state.advance_commit()
+        self.notify_applied()
+
+    def notify_applied(self):
+        """Completes the proposals and reads waiting on entries that have
+        been applied. One whose entry was replaced by another leader's, in a
+        later term, fails with `NotLeaderException` instead: what was applied
+        at its index is not what it proposed."""
+        while self._waiters and self._waiters[0][0] <= self.state.last_applied:
+            index, _, term, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            try:
+                replaced = self.state.term_at(index) != term
+            except IndexError:
+                # compacted since it was applied. A replacement would have
+                # come with a new term, which fails the waiter (see
+                # `raft.State.on_deposed`)
+                replaced = False
+            if replaced:
+                future.set_exception(NotLeaderException(self.state.leader_id))
+            else:
+                future.set_result(index)
+
+    def _fail_waiters(self):
+        while self._waiters:
+            _, _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_exception(
+                    NotLeaderException(self.state.leader_id))
+
+    async def _expire(self):
+        """Commits a batch of EXPIRE entries for the keys that are due, once
+        per tick of the expiry wheel. Expiry goes through the log, so that
+        every replica deletes the same keys at the same point."""
+        state = self.state
+        while state.role == Role.LEADER:
+            await asyncio.sleep(state.expiry.tick / 1000)
+            entries = state.due_expiries(self.batch_entries)
+            if not entries:
+                continue
+            try:
+                await self.propose(
+                    [batch_entry(entries, state.current_term)])
+            except NotLeaderException:
+                return
+            state.metrics.inc('expiries_committed', len(entries))
+
+    # ----- linearizable reads -----
+    def quorum_ack_time(self) -> float:
+        """Returns the latest time at which a majority of the cluster (this
+        node included) was known to accept this node as leader"""
+        times = sorted(
+            [self._acks.get(a, 0.0) for a in self.state.foreign_nodes]
+            + [float('inf')],
+            reverse=True)
+        return times[len(times) // 2]
+
+    def lease_valid(self) -> bool:
+        return (not self.transferring()
+                and time.monotonic() < self.quorum_ack_time() + self.lease)
+
+    async def read_index(self, timeout: float = 1.0) -> int:
+        """Waits until a read from the local store would be linearizable, and
+        returns the commit index it reflects. Raises `NotLeaderException` if
+        this node is not the leader, and `asyncio.TimeoutError` if a majority
+        could not be reached to confirm that it still is.
+
+        The read index is the commit index once this leader has committed an
+        entry in its own term. Leadership is then confirmed with one round of
+        heartbeats (or, in lease mode, by a recent enough round), and the read
+        waits for the store to catch up to the read index. None of this
+        appends to the log."""
+        state = self.state
+        if state.role != Role.LEADER:
+            raise NotLeaderException(state.leader_id)
+        if not state.committed_in_current_term():
+            # commit a no-op, so that the commit index covers everything
+            # committed by previous leaders
+            await self.propose([batch_entry([], state.current_term)])
+        index = state.commit_index
+        term = state.term_at(index)
+        if not (self.read_mode == ReadMode.LEASE and self.lease_valid()):
+            await asyncio.wait_for(self._confirm_leadership(), timeout)
+        return await self._wait_applied(index, term)
+
+    async def _confirm_leadership(self):
+        started = time.monotonic()
+        self._confirm_requested = started
+        self.start()
+        self._kick()
+        while self.quorum_ack_time() < started:
+            if self.state.role != Role.LEADER:
+                raise NotLeaderException(self.state.leader_id)
+            self._acked.clear()
+            await self._acked.wait()
+
+    def _ack(self, address: str, sent_at: float):
+        self._acks[address] = max(self._acks.get(address, 0.0), sent_at)
+        self._acked.set()
+
+    # ----- replication -----
+    async def _replicate(self, address: str, node: ForeignNode):
+        wake = self._wake[address]
+        # each request is kept with the time it was sent
+        in_flight: Dict[
+            asyncio.Task[AppendResult], Tuple[dict, float]] = dict()
+        last_sent = 0.0
+        client = self.client_factory(address)
+        try:
+            while self.state.role == Role.LEADER:
+                # fill the pipeline
+                while len(in_flight) < self.max_in_flight:
+                    req = self.state.append_request(
+                        node.next_index, self.batch_entries)
+                    if req is None:
+                        if in_flight:
+                            break
+                        await self._send_snapshot(client, node)
+                        continue
+                    heartbeat_due = not in_flight and (
+                        time.monotonic() - last_sent >= self.heartbeat_interval)
+                    # a read is waiting on a request sent after it started
+                    confirm_due = last_sent < self._confirm_requested
+                    if not (req['entries'] or heartbeat_due or confirm_due):
+                        break
+                    last_sent = time.monotonic()
+                    in_flight[asyncio.create_task(
+                        self._send_append(client, req))] = (req, last_sent)
+                    # optimistically assume the batch will be accepted
+                    node.next_index += len(req['entries'])
+                    if not req['entries']:
+                        break
+
+                wake.clear()
+                waiter = asyncio.ensure_future(wake.wait())
+                timeout = max(
+                    0.0, last_sent + self.heartbeat_interval - time.monotonic())
+                await asyncio.wait(
+                    [waiter, *in_flight],
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED)
+                waiter.cancel()
+
+                failed = False
+                for task in [t for t in in_flight if t.done()]:
+                    req, sent_at = in_flight.pop(task)
+                    try:
+                        result = task.result()
+                    except (httpx.HTTPError, ValueError):
+                        # resend the batch once the follower is reachable
+                        node.next_index = min(
+                            node.next_index, req['prev_log_index'] + 1)
+                        failed = True
+                        continue
+                    if result.term > self.state.current_term:
+                        self.state.step_down(result.term)
+                        self._acked.set()
+                        break
+                    self._ack(address, sent_at)
+                    if result.success:
+                        node.match_index = max(
+                            node.match_index,
+                            req['prev_log_index'] + len(req['entries']))
+                        self._advance_commit()
+                    else:
+                        # the follower is missing entries -- back up past
+                        # the entries its hints rule out, or else by one, and
+                        # let it find the point where the logs agree
+                        retry = req['prev_log_index']
+                        if result.conflict_index >= 0:
+                            retry = min(retry, self.state.conflict_next_index(
+                                result.conflict_term, result.conflict_index))
+                        node.next_index = max(
+                            node.match_index + 1,
+                            min(node.next_index, retry))
+                        self.state.metrics.inc('append_rejections')
+                if failed and not in_flight:
+                    await asyncio.sleep(self.heartbeat_interval)
+        finally:
+            for task in in_flight:
+                task.cancel()
+            await client.aclose()
+            if self.state.role != Role.LEADER:
+                self._fail_waiters()
+
+    async def _send_append(
+            self, client: httpx.AsyncClient, req: dict) -> AppendResult:
+        if self.binary:
+            res = await client.post(
+                '/rpc/append',
+                content=codec.encode_append(**req),
+                headers={'content-type': codec.CONTENT_TYPE})
+            res.raise_for_status()
+            return codec.decode_append_result(res.content)
+        body = dict(req, entries=[_entry_json(e) for e in req['entries']])
+        res = await client.post('/rpc/append', json=body)
+        res.raise_for_status()
+        data = res.json()
+        return AppendResult(
+            data['term'], data['success'],
+            data.get('conflict_term', 0), data.get('conflict_index', -1))
+
+    async def _send_snapshot(self, client: httpx.AsyncClient, node: ForeignNode):
+        """Sends the current snapshot to a follower that is behind the
+        compaction point, one chunk at a time"""
+        state = self.state
+        index, term = state.snapshot_index, state.snapshot_term
+        offset = 0
+        done = False
+        while not done:
+            if state.snapshot_index != index:
+                # a newer snapshot has replaced this one
+                return
+            chunk, done = state.snapshot_chunk(offset)
+            try:
+                res = await client.post('/rpc/snapshot', json=dict(
+                    term=state.current_term,
+                    leader_id=state.address,
+                    last_included_index=index,
+                    last_included_term=term,
+                    offset=offset,
+                    data=base64.b64encode(chunk).decode(),
+                    done=done))
+                res.raise_for_status()
+            except httpx.HTTPError:
+                await asyncio.sleep(self.heartbeat_interval)
+                return
+            data = res.json()
+            if data['term'] > state.current_term:
+                state.step_down(data['term'])
+                return
+            if not data['success'] or state.snapshot_index != index:
+                # start over, with the latest snapshot
+                return
+            offset += len(chunk)
+        node.match_index = max(node.match_index, index)
+        node.next_index = index + 1
+
+
+class Applier:
+    """
+    Applies committed entries to the store in a background task
+
+    Once started, `raft.State` no longer applies entries inside the handler
+    or task that advanced `commit_index`, but wakes this task, which drains
+    `last_applied..commit_index` in batches of up to `batch_entries` and
+    yields to the event loop between them. A large commit advance, or an
+    expensive store, then delays heartbeats and RPC responses by one batch at
+    most. The `apply_lag` gauge is the number of committed entries still to
+    be applied. `on_applied` is called after each batch.
+
+    Snapshots are taken here too, once enough entries have been applied.
+    The store's view is taken between batches, and the snapshot encoded and
+    written out in another thread, while later entries go on being applied.
+    """
+    def __init__(
+            self,
+            state: State,
+            batch_entries: int | None = None,
+            on_applied: Callable[[], None] | None = None
+    ):
+        self.state = state
+        if batch_entries is None:
+            batch_entries = int(os.environ.get('RSB_APPLY_BATCH', 256))
+        self.batch_entries = batch_entries
+        self.on_applied = on_applied
+        self._wake = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._snapshot: asyncio.Task | None = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self.state.on_commit = self._wake.set
+            self._wake.set()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self.state.on_commit = None
+        tasks = [t for t in (self._task, self._snapshot) if t]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = self._snapshot = None
+
+    def lag(self) -> int:
+        return self.state.commit_index - self.state.last_applied
+
+    async def _run(self):
+        state = self.state
+        while True:
+            await self._wake.wait()
+            self._wake.clear()
+            while state.apply_committed(self.batch_entries):
+                state.metrics.set('apply_lag', self.lag())
+                if self.on_applied:
+                    self.on_applied()
+                self._maybe_snapshot()
+                await asyncio.sleep(0)
+            state.metrics.set('apply_lag', self.lag())
+
+    def _maybe_snapshot(self):
+        """Starts a snapshot if one is due, and none is being taken"""
+        if (self._snapshot and not self._snapshot.done()
+                or not self.state.snapshot_due()):
+            return
+        pending = self.state.begin_snapshot()
+        if pending:
+            self._snapshot = asyncio.create_task(self._take_snapshot(pending))
+
+    async def _take_snapshot(self, pending: PendingSnapshot):
+        await asyncio.to_thread(self.state.write_snapshot, pending)
+        self.state.finish_snapshot(pending)
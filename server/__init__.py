@@ -1,9 +1,31 @@
-from fastapi import FastAPI, HTTPException, status, Request, Response
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel
-from typing import List
-from store import Store
-from raft import State, Op, Role
+import asyncio
+import base64
+import codec
+import itertools
+import json
+import os
+import time
+from collections import deque
+import httpx
+from urllib.parse import parse_qs
+from fastapi import FastAPI, HTTPException, Query, status, Request, Response
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import (
+    JSONResponse, PlainTextResponse, StreamingResponse)
+from pydantic import BaseModel, Field, ValidationError
+from starlette.types import ASGIApp, Receive, Scope, Send
+from typing import Deque, Dict, Iterable, Iterator, List, Tuple
+from compression import Compressor
+from election import Elector
+from store import Store, prefix_end
+from lsm import LSMStore
+from multiraft import (
+    GROUPS_PATH, group_address, group_count, group_of, node_addresses,
+    preferred_leader, scope_to_group)
+from raft import (
+    State, Entry, Op, Role, NotLeaderException, InvalidOperationException,
+    batch_entry, now_ms)
+from replication import Applier, ReadMode, Replicator
 
 
 # all FastAPI and Pydantic code should be limited to the server module
@@ -12,12 +34,62 @@ class ReadResponse(BaseModel):
     value: str | None
 
 
+MAX_RANGE_LIMIT = 1000
+
+
+class KeyValue(BaseModel):
+    key: str
+    value: str
+
+
+MAX_MGET_KEYS = 1000
+
+
+class MultiGetRequest(BaseModel):
+    keys: List[str] = Field(max_length=MAX_MGET_KEYS)
+
+
+class MultiGetResponse(BaseModel):
+    # only the keys that were found
+    values: Dict[str, str]
+
+
+class RangeResponse(BaseModel):
+    items: List[KeyValue]
+    next: str | None
+
+
+# the number of pairs in each chunk of an export
+EXPORT_CHUNK = 1000
+# the number of import batches that may be waiting to commit at once
+IMPORT_PIPELINE = 4
+
+
+class ImportResponse(BaseModel):
+    imported: int
+
+
 class LogEntry(BaseModel):
-    """This class must match the raft.Entry class"""
+    """This class must match the raft.Entry class, except that a compressed
+    value is sent in base64, with `compressed` set"""
     op: Op
     key: str
     value: str | None
     term: int
+    expires: int = 0
+    compressed: bool = False
+
+
+class BatchOperation(BaseModel):
+    op: Op
+    key: str
+    value: str | None = None
+    # writes only: expire the key this many milliseconds after the write
+    ttl_ms: int | None = Field(default=None, gt=0)
+
+
+class BatchRequest(BaseModel):
+    operations: List[BatchOperation]
 
 
 class AppendEntries(BaseModel):
@@ -32,6 +104,10 @@ class AppendEntries(BaseModel):
 class AppendEntriesResponse(BaseModel):
     term: int
     success: bool
+    # where a follower whose log disagrees wants the leader to try next (see
+    # `raft.AppendResult`)
+    conflict_term: int = 0
+    conflict_index: int = -1
 
 
 class RequestVote(BaseModel):
@@ -46,69 +122,814 @@ class RequestVoteResponse(BaseModel):
     vote_granted: bool
 
 
-def build_app(state: State = None):
+class InstallSnapshot(BaseModel):
+    term: int
+    leader_id: str
+    last_included_index: int
+    last_included_term: int
+    offset: int
+    data: str  # base64-encoded chunk of the snapshot
+    done: bool
+
+
+class InstallSnapshotResponse(BaseModel):
+    term: int
+    success: bool
+
+
+class TimeoutNow(BaseModel):
+    term: int
+    leader_id: str
+
+
+class GroupStatus(BaseModel):
+    group: int
+    # the base of the group's API on this node
+    address: str
+    role: Role
+    term: int
+    leader: str
+
+
+def open_store(data_dir: str | None = None) -> Store | LSMStore:
+    """Opens the store engine named by RSB_STORE_ENGINE: `memory` (the
+    default) or `lsm`, which keeps the store on disk under `data_dir`, or
+    else RSB_DATA_DIR"""
+    engine = os.environ.get('RSB_STORE_ENGINE', 'memory')
+    if engine == 'memory':
+        return Store()
+    if engine == 'lsm':
+        data_dir = data_dir or os.environ.get('RSB_DATA_DIR')
+        if not data_dir:
+            raise ValueError("the lsm store engine requires RSB_DATA_DIR")
+        return LSMStore(os.path.join(data_dir, 'store'))
+    raise ValueError(f"unknown RSB_STORE_ENGINE: {engine}")
+
+
+# reads that can touch every group, and are only served per group
+CROSS_GROUP_PATHS = ('/range', '/prefix', '/export')
+
+
+class GroupRouter:
+    """
+    ASGI middleware that sends each request naming keys to the raft group
+    that owns them, by rewriting its path to the group's, under /groups/<n>.
+    Single-key requests name the key in the query, and `/batch` and `/mget`
+    in the body, which is read here and passed on. A batch whose keys belong
+    to more than one group is rejected, since the groups commit
+    independently, and the client must split it. Other requests, including
+    multi-gets that span groups, are left to the node's own routes (see
+    `build_multi_app`).
+    """
+    def __init__(self, app: ASGIApp, groups: int):
+        self.app = app
+        self.groups = groups
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        path = scope.get('path', '')
+        if scope['type'] != 'http' or path.startswith(GROUPS_PATH):
+            await self.app(scope, receive, send)
+            return
+        if path == '/':
+            keys = parse_qs(scope['query_string'].decode()).get('key', [])
+        elif path in ('/batch', '/mget'):
+            body = await _read_body(receive)
+            receive = _replay(body, receive)
+            keys = _body_keys(body)
+        else:
+            await self.app(scope, receive, send)
+            return
+        # a request without keys is left to group 0 to reject
+        groups = sorted({group_of(key, self.groups) for key in keys}) or [0]
+        if len(groups) > 1 and path == '/mget':
+            await self.app(scope, receive, send)
+            return
+        if len(groups) > 1:
+            response = JSONResponse(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                content={'detail': f'the keys span raft groups {groups}; '
+                                   f'send each group its own keys'})
+            await response(scope, receive, send)
+            return
+        path = group_address('', groups[0]) + path
+        await self.app(
+            dict(scope, path=path, raw_path=path.encode()), receive, send)
+
+
+async def _read_body(receive: Receive) -> bytes:
+    body = bytearray()
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return bytes(body)
+
+
+def _replay(body: bytes, receive: Receive) -> Receive:
+    """Returns a `receive` that sends `body` again, then carries on with
+    the original"""
+    sent = False
+
+    async def replay():
+        nonlocal sent
+        if sent:
+            return await receive()
+        sent = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+    return replay
+
+
+def _body_keys(body: bytes) -> List[str]:
+    """Returns the keys named by a `/batch` or `/mget` body, or none if it
+    is malformed"""
+    try:
+        req = json.loads(body)
+        if 'operations' in req:
+            return [str(o['key']) for o in req['operations']]
+        return [str(key) for key in req['keys']]
+    except (ValueError, TypeError, KeyError):
+        return []
+
+
+def build_multi_app(groups: int) -> FastAPI:
+    """Serves `groups` independent raft groups from this node, each with its
+    own log, store and leader, and owning the keys that hash to it (see
+    `multiraft.group_of`). Each group's API, and its RPCs, are mounted under
+    /groups/<n>, and `GroupRouter` sends requests there by their keys.
+    Leadership is spread over the nodes by giving each group a preferred
+    leader."""
+    app = FastAPI()
+    data_dir = os.environ.get('RSB_DATA_DIR')
+    states: List[State] = list()
+    group_apps: List[FastAPI] = list()
+    for group in range(groups):
+        group_dir = (os.path.join(data_dir, f'group-{group}')
+                     if data_dir else None)
+        state = State(open_store(group_dir), group_dir)
+        addresses = node_addresses(state)
+        scope_to_group(state, group)
+        replicator = Replicator(state)
+        elector = Elector(
+            state, replicator, preferred=preferred_leader(group, addresses))
+        group_app = build_app(
+            state, replicator, elector, group=group, groups=groups)
+        app.mount(group_address('', group), group_app)
+        states.append(state)
+        group_apps.append(group_app)
+
+    import_batch_bytes = int(
+        os.environ.get('RSB_IMPORT_BATCH_BYTES', 1 << 20))
+    # requests for a group go to its app here, in process, and on to its
+    # leader if that is another node
+    local = [httpx.AsyncClient(transport=httpx.ASGITransport(app=group_app),
+                               base_url='http://group')
+             for group_app in group_apps]
+    remote = httpx.AsyncClient(timeout=None)
+
+    # mounted apps are not sent lifespan events of their own
+    @app.on_event("startup")
+    async def start_groups():
+        for group_app in group_apps:
+            await group_app.router.startup()
+
+    @app.on_event("shutdown")
+    async def stop_groups():
+        for group_app in group_apps:
+            await group_app.router.shutdown()
+        for client in [*local, remote]:
+            await client.aclose()
+
+    async def forward(
+            group: int, method: str, url: str, **kwargs) -> httpx.Response:
+        """sends a request to a group, following a redirect to its leader,
+        and raises the group's error, if any"""
+        res = await local[group].request(method, url, **kwargs)
+        try:
+            if res.status_code == status.HTTP_308_PERMANENT_REDIRECT:
+                res = await remote.request(
+                    method, res.headers['location'], **kwargs)
+        except httpx.HTTPError as e:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"group {group}: could not reach its leader ({e})")
+        if res.status_code == status.HTTP_308_PERMANENT_REDIRECT:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"group {group}: its leadership is changing")
+        if res.is_error:
+            raise HTTPException(
+                status_code=res.status_code,
+                detail=f"group {group}: {res.json().get('detail')}")
+        return res
+
+    @app.post("/mget")
+    async def db_mget(
+            request: Request, req: MultiGetRequest) -> MultiGetResponse:
+        """reads keys from many groups at once. Each group reads its own
+        keys, after its own read index or staleness check, and the values
+        found are merged"""
+        shares: Dict[int, List[str]] = dict()
+        for key in req.keys:
+            shares.setdefault(group_of(key, groups), list()).append(key)
+        url = f'/mget?{request.url.query}'
+        responses = await asyncio.gather(*(
+            forward(group, 'POST', url, json=dict(keys=keys))
+            for group, keys in shares.items()))
+        values: Dict[str, str] = dict()
+        for res in responses:
+            values.update(res.json()['values'])
+        return MultiGetResponse(values=values)
+
+    @app.get("/range")
+    @app.get("/prefix")
+    @app.get("/export")
+    async def per_group(request: Request):
+        path = request.scope['path']
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f'{path} is served by each raft group, at '
+                   f'{GROUPS_PATH}/<n>{path}')
+
+    @app.delete("/prefix", status_code=status.HTTP_204_NO_CONTENT)
+    async def db_delete_prefix(
+            request: Request, p: str = Query(min_length=1)):
+        """deletes every key that starts with `p` from every group. Each
+        group deletes its own keys atomically, but the groups do so
+        independently"""
+        await asyncio.gather(*(
+            forward(group, 'DELETE', f'/prefix?{request.url.query}')
+            for group in range(groups)))
+
+    @app.post("/import", status_code=status.HTTP_201_CREATED)
+    async def db_import(request: Request) -> ImportResponse:
+        """splits the pairs streamed in the body by group, and imports each
+        group's share through the group's own `/import`, in requests of
+        about RSB_IMPORT_BATCH_BYTES. Requests to different groups are
+        pipelined, and those to the same group sent in order, so an import
+        that fails partway has still written the pairs counted in the
+        error"""
+        decoder = codec.ImportDecoder(
+            request.headers.get('content-type') == codec.IMPORT_CONTENT_TYPE)
+        shares: List[List[Tuple[str, str]]] = [list() for _ in range(groups)]
+        sizes = [0] * groups
+        # the last request sent to each group, which the next one waits on
+        last: Dict[int, asyncio.Future[int]] = dict()
+        pending: Deque[asyncio.Future[int]] = deque()
+        imported = 0
+
+        def add(pairs: Iterator[Tuple[str, str]]):
+            for key, value in pairs:
+                group = group_of(key, groups)
+                shares[group].append((key, value))
+                sizes[group] += len(key) + len(value)
+                if sizes[group] >= import_batch_bytes:
+                    submit(group)
+
+        def submit(group: int):
+            last[group] = asyncio.ensure_future(
+                send(group, shares[group], last.get(group)))
+            pending.append(last[group])
+            shares[group] = list()
+            sizes[group] = 0
+
+        async def send(
+                group: int,
+                pairs: List[Tuple[str, str]],
+                previous: asyncio.Future[int] | None
+        ) -> int:
+            if previous:
+                await previous
+            res = await forward(
+                group, 'POST', '/import',
+                content=codec.encode_import(pairs),
+                headers={'content-type': codec.IMPORT_CONTENT_TYPE})
+            return res.json()['imported']
+
+        async def settle(limit: int):
+            nonlocal imported
+            while len(pending) > limit:
+                imported += await pending.popleft()
+
+        try:
+            try:
+                async for chunk in request.stream():
+                    add(decoder.feed(chunk))
+                    await settle(IMPORT_PIPELINE)
+                add(decoder.finish())
+                for group in range(groups):
+                    if shares[group]:
+                        submit(group)
+                await settle(0)
+            finally:
+                # let the requests already sent finish either way
+                while pending:
+                    try:
+                        await settle(0)
+                    except HTTPException:
+                        pass
+        except codec.DecodeError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{e}, after importing {imported} pairs")
+        except HTTPException as e:
+            raise HTTPException(
+                status_code=e.status_code,
+                detail=f"{e.detail}, after importing {imported} pairs")
+        return ImportResponse(imported=imported)
+
+    @app.get(GROUPS_PATH)
+    async def list_groups() -> List[GroupStatus]:
+        """lists the groups, and which node leads each, as far as this node
+        knows"""
+        return [GroupStatus(group=group, address=state.address,
+                            role=state.role, term=state.current_term,
+                            leader=state.leader_id)
+                for group, state in enumerate(states)]
+
+    app.add_middleware(GroupRouter, groups=groups)
+    return app
+
+
+def build_app(
+        state: State = None,
+        replicator: Replicator = None,
+        elector: Elector = None,
+        group: int = 0,
+        groups: int = 1
+):
+    if not state and group_count() > 1:
+        return build_multi_app(group_count())
     app = FastAPI()
     if not state:
         # dependency injection primarily for test setup and observability
-        state = State(Store())
+        state = State(open_store())
+    if not replicator:
+        replicator = Replicator(state)
+    if not elector:
+        elector = Elector(state, replicator)
+    applier = Applier(state, on_applied=replicator.notify_applied)
+    import_batch_bytes = int(
+        os.environ.get('RSB_IMPORT_BATCH_BYTES', 1 << 20))
+    # values are compressed as they are written, and only decompressed here
+    # as they are read
+    compressor = Compressor(metrics=state.metrics)
+
+    @app.on_event("startup")
+    async def start_background_tasks():
+        applier.start()
+        elector.start()
+
+    @app.on_event("shutdown")
+    async def stop_replication():
+        await elector.stop()
+        await replicator.stop()
+        await applier.stop()
+
+    def redirect_to_leader(request: Request):
+        """sends the client to the same path on the leader. The path is the
+        one within this app, as the leader's address includes any mount
+        point (see `multiraft.group_address`)"""
+        if state.role == Role.LEADER:
+            # the leader refuses proposals while it hands over leadership
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Leadership is being handed over")
+        if not state.leader_id:
+            # no election has been won yet in this term
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="No known leader")
+        location = f'http://{state.leader_id}{request.scope["path"]}'
+        if request.url.query:
+            location += f'?{request.url.query}'
+        return JSONResponse(
+            status_code=status.HTTP_308_PERMANENT_REDIRECT,
+            content=None,
+            headers={'Location': location})
+
+    def not_owned(keys: Iterable[str]) -> str | None:
+        """describes the first of `keys` that this group does not own, if
+        any. A write of such a key would be committed here, but never read,
+        as `GroupRouter` looks for the key in its own group"""
+        if groups > 1:
+            for key in keys:
+                if (owner := group_of(key, groups)) != group:
+                    return (f"{key!r} belongs to raft group {owner}, "
+                            f"not {group}")
+        return None
+
+    def check_owned(keys: Iterable[str]):
+        if error := not_owned(keys):
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST, detail=error)
 
     # Note: Default fastapi behavior for unhandled exceptions is to return a
     # 404. This is incorrect as a 4xx status code indicates a malformed request
     # and should be over-ridden with a general exception middleware that
     # returns a 500. See https://fastapi.tiangolo.com/tutorial/handling-errors/
 
+    async def wait_readable(
+            request: Request,
+            max_lag: int | None,
+            max_staleness_ms: int | None
+    ) -> JSONResponse | None:
+        """waits until this node may serve a read, or returns the response to
+        send instead. Unless the node is configured for local reads, only the
+        leader serves reads, once it has confirmed that its store is up to
+        date. A read that gives a staleness bound, in entries behind the
+        leader's commit index and/or milliseconds, is served by any node that
+        is fresh enough"""
+        if max_lag is not None or max_staleness_ms is not None:
+            max_staleness = (
+                None if max_staleness_ms is None else max_staleness_ms / 1000)
+            # give the next heartbeat a chance to bring this node up to date,
+            # before sending the client to the leader
+            deadline = time.monotonic() + 2 * replicator.heartbeat_interval
+            while not state.is_fresh(max_lag, max_staleness):
+                if time.monotonic() >= deadline:
+                    state.metrics.inc('stale_read_redirects')
+                    return redirect_to_leader(request)
+                await asyncio.sleep(replicator.heartbeat_interval / 10)
+        elif replicator.read_mode != ReadMode.LOCAL:
+            try:
+                await replicator.read_index()
+            except NotLeaderException:
+                return redirect_to_leader(request)
+            except asyncio.TimeoutError:
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Could not reach a quorum")
+        return None
+
     # ----- DB Router -----
     @app.get("/")
-    async def db_get(key: str) -> ReadResponse:
-        """reads the specified value"""
+    async def db_get(
+            request: Request,
+            key: str,
+            max_lag: int | None = None,
+            max_staleness_ms: int | None = None
+    ) -> ReadResponse:
+        """reads the specified value (see `wait_readable` for the staleness
+        options)"""
+        redirect = await wait_readable(request, max_lag, max_staleness_ms)
+        if redirect:
+            return redirect
         v = state.store.read(key)
-        if not v:
+        # an expired key is hidden until the leader's delete reaches this node
+        if not v or state.is_expired(key):
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
-        return ReadResponse(value=v)
+        return ReadResponse(value=compressor.decompress(v))
+
+    @app.post("/mget")
+    async def db_mget(
+            request: Request,
+            req: MultiGetRequest,
+            max_lag: int | None = None,
+            max_staleness_ms: int | None = None
+    ) -> MultiGetResponse:
+        """reads many keys, and returns the values of those that are found.
+        The staleness or read index check (see `wait_readable`) is made once
+        for all of them"""
+        redirect = await wait_readable(request, max_lag, max_staleness_ms)
+        if redirect:
+            return redirect
+        values = state.store.read_many(req.keys)
+        return MultiGetResponse(values={
+            k: compressor.decompress(v) for k, v in zip(req.keys, values)
+            if v and not state.is_expired(k)})
+
+    @app.get("/range")
+    async def db_range(
+            request: Request,
+            start: str | None = None,
+            end: str | None = None,
+            limit: int = Query(default=100, ge=1, le=MAX_RANGE_LIMIT),
+            max_lag: int | None = None,
+            max_staleness_ms: int | None = None
+    ) -> RangeResponse:
+        """lists up to `limit` pairs with keys from `start` (inclusive) to
+        `end` (exclusive), in key order. If there are more, `next` is the
+        `start` of the next page"""
+        redirect = await wait_readable(request, max_lag, max_staleness_ms)
+        if redirect:
+            return redirect
+        return range_page(start, end, limit)
+
+    @app.get("/prefix")
+    async def db_prefix(
+            request: Request,
+            p: str,
+            start: str | None = None,
+            limit: int = Query(default=100, ge=1, le=MAX_RANGE_LIMIT),
+            max_lag: int | None = None,
+            max_staleness_ms: int | None = None
+    ) -> RangeResponse:
+        """lists up to `limit` pairs with keys that start with `p`, in key
+        order. If there are more, `next` is the `start` of the next page"""
+        redirect = await wait_readable(request, max_lag, max_staleness_ms)
+        if redirect:
+            return redirect
+        if start is None or start < p:
+            start = p
+        return range_page(start, prefix_end(p), limit)
+
+    def range_page(
+            start: str | None, end: str | None, limit: int) -> RangeResponse:
+        items = state.store.scan(start, end, limit + 1)
+        next_key = items.pop()[0] if len(items) > limit else None
+        return RangeResponse(
+            items=[KeyValue(key=k, value=compressor.decompress(v))
+                   for k, v in items if not state.is_expired(k)],
+            next=next_key)
+
+    @app.get("/export")
+    async def db_export(
+            request: Request,
+            prefix: str = '',
+            max_lag: int | None = None,
+            max_staleness_ms: int | None = None
+    ):
+        """streams every pair, or every pair with keys under `prefix`, in
+        key order, as of the start of the export. The body is in the same
+        format as `POST /import` takes: NDJSON, or the binary records when
+        `codec.IMPORT_CONTENT_TYPE` is accepted"""
+        redirect = await wait_readable(request, max_lag, max_staleness_ms)
+        if redirect:
+            return redirect
+        binary = codec.IMPORT_CONTENT_TYPE in request.headers.get('accept', '')
+        encode = codec.encode_import if binary else codec.encode_ndjson
+        pairs = state.store.items(prefix or None, prefix_end(prefix))
+        # take the view now, rather than once the body starts to be sent
+        first = next(pairs, None)
+
+        def chunks() -> Iterator[bytes]:
+            rest = itertools.chain([first] if first else [], pairs)
+            while chunk := list(itertools.islice(rest, EXPORT_CHUNK)):
+                yield encode([(k, compressor.decompress(v)) for k, v in chunk
+                              if not state.is_expired(k)])
+
+        return StreamingResponse(
+            chunks(),
+            media_type=(codec.IMPORT_CONTENT_TYPE if binary
+                        else codec.NDJSON_CONTENT_TYPE))
 
     @app.post("/", status_code=status.HTTP_201_CREATED)
-    async def db_upsert(key: str, value: str, response: Response):
-        """inserts the specified value without checking for previous existence
-        """
-        if state.role != Role.LEADER:
-            return JSONResponse(
-                status_code=status.HTTP_308_PERMANENT_REDIRECT,
-                content=None,
-                headers={'Location': state.voted_for})
-        state.store.upsert(key, value)
+    async def db_upsert(
+            request: Request,
+            key: str,
+            value: str,
+            response: Response,
+            ttl_ms: int | None = Query(default=None, gt=0)
+    ):
+        """inserts the specified value without checking for previous existence.
+        With `ttl_ms`, the key is deleted that many milliseconds later, unless
+        it has been written again in the meantime"""
+        check_owned([key])
+        try:
+            await replicator.propose([Entry(
+                op=Op.WRITE, key=key, value=compressor.compress(value),
+                term=state.current_term,
+                expires=now_ms() + ttl_ms if ttl_ms else 0)])
+        except NotLeaderException:
+            return redirect_to_leader(request)
 
     @app.delete("/", status_code=status.HTTP_204_NO_CONTENT)
-    async def db_delete(key: str):
+    async def db_delete(request: Request, key: str):
         """deletes specified key without checking for existence"""
+        check_owned([key])
+        try:
+            await replicator.propose([Entry(
+                op=Op.DELETE, key=key, value=None, term=state.current_term)])
+        except NotLeaderException:
+            return redirect_to_leader(request)
+
+    @app.delete("/prefix", status_code=status.HTTP_204_NO_CONTENT)
+    async def db_delete_prefix(
+            request: Request, p: str = Query(min_length=1)):
+        """deletes every key that starts with `p`, as a single log entry"""
+        try:
+            await replicator.propose([Entry(
+                op=Op.DELETE_PREFIX, key=p, value=None,
+                term=state.current_term)])
+        except NotLeaderException:
+            return redirect_to_leader(request)
+
+    @app.post("/batch", status_code=status.HTTP_201_CREATED)
+    async def db_batch(request: Request, req: BatchRequest):
+        """applies many upserts and deletes, in order, as a single log entry,
+        so that they are committed together and applied atomically"""
+        check_owned(o.key for o in req.operations)
+        now = now_ms()
+        try:
+            for o in req.operations:
+                if o.op not in (Op.WRITE, Op.DELETE):
+                    raise InvalidOperationException(
+                        f"Invalid Operation: {o.op} in batch")
+            entry = batch_entry(
+                [Entry(op=o.op, key=o.key,
+                       value=compressor.compress(o.value) if o.value
+                       else o.value,
+                       term=state.current_term,
+                       expires=now + o.ttl_ms if o.ttl_ms else 0)
+                 for o in req.operations],
+                state.current_term)
+        except InvalidOperationException as e:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=str(e))
+        try:
+            await replicator.propose([entry])
+        except NotLeaderException:
+            return redirect_to_leader(request)
+
+    @app.post("/import", status_code=status.HTTP_201_CREATED)
+    async def db_import(request: Request) -> ImportResponse:
+        """writes every pair streamed in the body, as NDJSON or, with the
+        `codec.IMPORT_CONTENT_TYPE`, as binary records. Pairs are proposed in
+        batch entries of about RSB_IMPORT_BATCH_BYTES as they arrive, with a
+        few batches committing at once, so an import that fails partway has
+        still written the pairs counted in the error"""
         if state.role != Role.LEADER:
-            return JSONResponse(
-                status_code=status.HTTP_308_PERMANENT_REDIRECT,
-                content=None,
-                headers={'Location': state.voted_for})
-        state.store.delete(key)
+            return redirect_to_leader(request)
+        decoder = codec.ImportDecoder(
+            request.headers.get('content-type') == codec.IMPORT_CONTENT_TYPE)
+        batch: List[Entry] = list()
+        size = 0
+        # proposed batches, oldest first, with their number of pairs
+        pending: Deque[Tuple[asyncio.Future[int], int]] = deque()
+        imported = 0
+
+        def add(pairs: Iterator[Tuple[str, str]]):
+            nonlocal size
+            for key, value in pairs:
+                if error := not_owned([key]):
+                    raise InvalidOperationException(error)
+                packed = compressor.compress(value)
+                batch.append(Entry(
+                    op=Op.WRITE, key=key, value=packed,
+                    term=state.current_term))
+                size += len(key) + len(packed)
+                if size >= import_batch_bytes:
+                    submit()
+
+        def submit():
+            nonlocal size
+            entry = batch_entry(batch, state.current_term)
+            pending.append(
+                (asyncio.ensure_future(replicator.propose([entry])),
+                 len(batch)))
+            batch.clear()
+            size = 0
+
+        async def settle(limit: int):
+            nonlocal imported
+            while len(pending) > limit:
+                future, count = pending.popleft()
+                await future
+                imported += count
+                state.metrics.inc('imported_pairs', count)
+
+        try:
+            try:
+                async for chunk in request.stream():
+                    add(decoder.feed(chunk))
+                    await settle(IMPORT_PIPELINE)
+                add(decoder.finish())
+                if batch:
+                    submit()
+                await settle(0)
+            finally:
+                # let the batches already proposed finish either way
+                while pending:
+                    try:
+                        await settle(0)
+                    except NotLeaderException:
+                        pass
+        except (codec.DecodeError, InvalidOperationException) as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{e}, after importing {imported} pairs")
+        except NotLeaderException:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail=f"lost leadership after importing {imported} pairs")
+        return ImportResponse(imported=imported)
 
     # ----- Raft Router -----
-    @app.post("/rpc/append")
-    async def rpc_append_entries(req: AppendEntries) -> AppendEntriesResponse:
-        """handles AppendEntry RPC requests for writes and heartbeats"""
-        res = state.append_entries(
-            term=req.term,
-            leader_id=req.leader_id,
-            prev_log_index=req.prev_log_index,
-            prev_log_term=req.prev_log_term,
-            entries=req.entries,  # noqa  -- duck-type match
-            leader_commit=req.leader_commit)
-        return AppendEntriesResponse(term=res.term, success=res.success)
-
-    @app.post("/rpc/vote")
-    async def rpc_append_entries(req: RequestVote) -> RequestVoteResponse:
-        """handles AppendEntry RPC requests for writes and heartbeats"""
-        res = state.request_vote(
-            term=req.term,
-            candidate_id=req.candidate_id,
-            last_log_index=req.last_log_index,
-            last_log_term=req.last_log_term)
+    # Both RPCs accept either JSON or the compact binary framing from the
+    # `codec` module, chosen by the request's content type. The response uses
+    # the same encoding as the request.
+    def is_binary(request: Request) -> bool:
+        return request.headers.get('content-type') == codec.CONTENT_TYPE
+
+    async def parse(request: Request, model, decode) -> dict:
+        body = await request.body()
+        if is_binary(request):
+            try:
+                return decode(body)
+            except codec.DecodeError as e:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+        try:
+            req = model.model_validate_json(body)
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        # entries are passed through as LogEntry -- duck-type match
+        return dict(req)
+
+    @app.post("/rpc/append", response_model=AppendEntriesResponse)
+    async def rpc_append_entries(request: Request):
+        """handles AppendEntry RPC requests for writes and heartbeats. The JSON
+        body is an `AppendEntries`"""
+        args = await parse(request, AppendEntries, codec.decode_append)
+        if not is_binary(request):
+            args['entries'] = [
+                Entry(e.op, e.key,
+                      base64.b64decode(e.value or '') if e.compressed
+                      else e.value,
+                      e.term, e.expires)
+                for e in args['entries']]
+        res = state.append_entries(**args, sync=False)
+        # the changes must be on disk before the leader hears of them, but
+        # the event loop need not wait on the disk: heartbeats, and other
+        # groups' RPCs, go on in the meantime, and their flushes are shared
+        # (see `wal.WriteAheadLog.sync`)
+        await asyncio.to_thread(state.persist)
+        if is_binary(request):
+            return Response(
+                codec.encode_append_result(res),
+                media_type=codec.CONTENT_TYPE)
+        return AppendEntriesResponse(
+            term=res.term,
+            success=res.success,
+            conflict_term=res.conflict_term,
+            conflict_index=res.conflict_index)
+
+    @app.post("/rpc/vote", response_model=RequestVoteResponse)
+    async def rpc_request_vote(request: Request):
+        """handles RequestVote RPC requests from candidates. The JSON body is a
+        `RequestVote`"""
+        args = await parse(request, RequestVote, codec.decode_vote)
+        res = state.request_vote(**args, sync=False)
+        await asyncio.to_thread(state.persist)
+        if is_binary(request):
+            return Response(
+                codec.encode_vote_result(res),
+                media_type=codec.CONTENT_TYPE)
+        return RequestVoteResponse(term=res.term, vote_granted=res.vote_granted)
+
+    @app.post("/rpc/prevote", response_model=RequestVoteResponse)
+    async def rpc_pre_vote(request: Request):
+        """handles pre-vote requests from nodes about to stand for election,
+        which change no state. The JSON body is a `RequestVote` for the term
+        the node would stand in"""
+        args = await parse(request, RequestVote, codec.decode_vote)
+        res = state.pre_vote(**args, leader_timeout=elector.election_timeout)
+        if is_binary(request):
+            return Response(
+                codec.encode_vote_result(res),
+                media_type=codec.CONTENT_TYPE)
         return RequestVoteResponse(term=res.term, vote_granted=res.vote_granted)
 
+    @app.post("/rpc/timeout")
+    async def rpc_timeout_now(req: TimeoutNow):
+        """handles TimeoutNow requests from a leader handing over leadership
+        to this node"""
+        elector.timeout_now(req.term, req.leader_id)
+
+    # the chunks of a snapshot are taken one at a time, as each waits on the
+    # disk, and the last on the restore of the store, off the event loop
+    installing = asyncio.Lock()
+
+    @app.post("/rpc/snapshot")
+    async def rpc_install_snapshot(
+            req: InstallSnapshot) -> InstallSnapshotResponse:
+        """handles InstallSnapshot RPC requests, for followers whose log is
+        behind the leader's compaction point"""
+        async with installing:
+            res = state.install_snapshot(
+                term=req.term,
+                leader_id=req.leader_id,
+                last_included_index=req.last_included_index,
+                last_included_term=req.last_included_term,
+                offset=req.offset,
+                data=base64.b64decode(req.data),
+                done=req.done,
+                sync=False)
+            if req.done:
+                await asyncio.to_thread(state.sync_received)
+                # the store is restored from the snapshot in another thread
+                if state.install_received(restore=False):
+                    state.finish_restore(
+                        await asyncio.to_thread(state.restore_store))
+            await asyncio.to_thread(state.persist)
+        return InstallSnapshotResponse(term=res.term, success=res.success)
+
+    # ----- Observability -----
+    @app.get("/metrics", response_class=PlainTextResponse)
+    async def metrics() -> str:
+        """exposes node metrics in the Prometheus text format"""
+        return state.metrics.render()
+
     return app
@@ -1,25 +1,401 @@
-from typing import Union
+import os
+import threading
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+# a stored value is text, or a compressed value as bytes (see `compression`),
+# which the store keeps as it is
+Value = Union[str, bytes]
+
+
+def prefix_end(prefix: str) -> str | None:
+    """Returns the first key after every key that starts with `prefix`"""
+    while prefix and prefix[-1] == chr(0x10ffff):
+        prefix = prefix[:-1]
+    if not prefix:
+        return None
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SortedKeys:
+    """
+    An ordered set of keys, kept as a list of sorted chunks
+
+    Finding a key is a binary search over the last key of each chunk, then
+    within the chunk, so a range of k keys is found in O(log n + k). Inserts
+    and removals only move the keys in one chunk, which is split once it
+    grows past `chunk` keys.
+    """
+    def __init__(self, chunk: int = 512):
+        self.chunk = chunk
+        self._chunks: List[List[str]] = list()
+        # the last (largest) key of each chunk
+        self._maxes: List[str] = list()
+
+    def __len__(self) -> int:
+        return sum(len(c) for c in self._chunks)
+
+    def __iter__(self) -> Iterator[str]:
+        for chunk in self._chunks:
+            yield from chunk
+
+    def add(self, key: str):
+        if not self._chunks:
+            self._chunks.append([key])
+            self._maxes.append(key)
+            return
+        n = min(bisect_left(self._maxes, key), len(self._chunks) - 1)
+        chunk = self._chunks[n]
+        i = bisect_left(chunk, key)
+        if i < len(chunk) and chunk[i] == key:
+            return
+        chunk.insert(i, key)
+        self._maxes[n] = chunk[-1]
+        if len(chunk) > 2 * self.chunk:
+            self._chunks[n:n + 1] = [chunk[:self.chunk], chunk[self.chunk:]]
+            self._maxes[n:n + 1] = [chunk[self.chunk - 1], chunk[-1]]
+
+    def discard(self, key: str):
+        n = bisect_left(self._maxes, key)
+        if n == len(self._chunks):
+            return
+        chunk = self._chunks[n]
+        i = bisect_left(chunk, key)
+        if i == len(chunk) or chunk[i] != key:
+            return
+        del chunk[i]
+        if chunk:
+            self._maxes[n] = chunk[-1]
+        else:
+            del self._chunks[n]
+            del self._maxes[n]
+
+    def range(self, start: str | None, end: str | None, limit: int) -> List[str]:
+        """Returns up to `limit` keys from `start` (inclusive) to `end`
+        (exclusive), in order"""
+        keys: List[str] = list()
+        if start is None:
+            n, i = 0, 0
+        else:
+            n = bisect_left(self._maxes, start)
+            i = bisect_left(self._chunks[n], start) if n < len(self._chunks) else 0
+        while n < len(self._chunks) and len(keys) < limit:
+            chunk = self._chunks[n]
+            j = len(chunk) if end is None else bisect_left(chunk, end, i)
+            keys.extend(chunk[i:min(j, i + limit - len(keys))])
+            if j < len(chunk):
+                break
+            n, i = n + 1, 0
+        return keys
 
 
 class Store:
     """
     A k-v datastore with basic crud operations
 
-    Currently only supports in-memory storage
+    Currently only supports in-memory storage. Keys are hash-partitioned across
+    `shards` dicts, each guarded by its own lock, so that reads and writes from
+    different threads only contend when they land on the same shard. An
+    ordered index of the keys, under a lock of its own, serves range scans.
+
+    Each write is tagged with a version, the log index that made it (or else
+    the next after the last). A reader can `pin` the current version and read
+    the store as of it, without seeing later writes. While any version is
+    pinned, writes keep the values they replace, until no pinned version can
+    read them any more; with nothing pinned, writes replace values in place.
     """
-    internal: dict = dict()
+    def __init__(self, shards: int | None = None):
+        if shards is None:
+            shards = int(os.environ.get('RSB_STORE_SHARDS', 16))
+        if shards < 1:
+            raise ValueError(f"shards must be at least 1, not {shards}")
+        self._shards: List[dict] = [dict() for _ in range(shards)]
+        self._locks = [threading.Lock() for _ in range(shards)]
+        # only updated while holding the lock of the key's shard, and always
+        # locked after it. Keys with replaced values are kept in the index
+        # until those are dropped, so that scans of old versions find them
+        self._index = SortedKeys()
+        self._index_lock = threading.Lock()
+        # the version of the last write
+        self.version = -1
+        # the number of readers of each pinned version, only updated while
+        # holding this lock (taken before any other) and, for new pins, every
+        # shard's lock, so that no write is half done when a version is pinned
+        self._pinned: Dict[int, int] = dict()
+        self._pin_lock = threading.Lock()
+        # the replaced values of each shard's keys, as lists of (version,
+        # value), oldest first, where each value (`None` for no value) was in
+        # place until the write at that version
+        self._history: List[Dict[str, List[Tuple[int, Value | None]]]] = [
+            dict() for _ in range(shards)]
+
+    def _shard(self, key: str) -> int:
+        return hash(key) % len(self._shards)
+
+    def _next(self, index: int | None) -> int:
+        return self.version + 1 if index is None else index
 
-    def upsert(self, key: str, value: str):
+    def upsert(self, key: str, value: Value, index: int | None = None):
         """Writes a value to the store, without checking for previously
         existing values."""
-        self.internal[key] = value
+        self._write(key, value, index)
 
-    def read(self, key: str) -> Union[str, None]:
-        """Reads the value stored at the specified key. Returns `None` if there
-        is no value for the key."""
-        return self.internal.get(key)
+    def read(self, key: str, as_of: int | None = None) -> Union[Value, None]:
+        """Reads the value stored at the specified key, as of a pinned
+        version, or the latest. Returns `None` if there is no value for the
+        key."""
+        self._check(as_of)
+        n = self._shard(key)
+        with self._locks[n]:
+            return self._read(n, key, as_of)
 
-    def delete(self, key: str):
+    def read_many(
+            self, keys: List[str], as_of: int | None = None
+    ) -> List[Value | None]:
+        """Reads many keys, as of a pinned version or else the current one,
+        taking each shard's lock once. Returns `None` for each missing key."""
+        if as_of is None:
+            with self.snapshot() as version:
+                return self._read_many(keys, version)
+        self._check(as_of)
+        return self._read_many(keys, as_of)
+
+    def delete(self, key: str, index: int | None = None):
         """Deletes the entry at the specified key, without checking whether
         it exists."""
-        self.internal.pop(key, None)
+        self._write(key, None, index)
+
+    def _write(self, key: str, value: Union[Value, None], index: int | None):
+        n = self._shard(key)
+        with self._locks[n]:
+            version = self._next(index)
+            self._set(n, key, value, version)
+            self.version = version
+
+    def _read(self, n: int, key: str, as_of: int | None) -> Union[Value, None]:
+        """Reads a key in shard `n`, whose lock must be held"""
+        if as_of is not None:
+            history = self._history[n].get(key)
+            if history:
+                i = bisect_right(history, as_of, key=lambda h: h[0])
+                if i < len(history):
+                    return history[i][1]
+        return self._shards[n].get(key)
+
+    def _read_many(
+            self, keys: List[str], as_of: int | None
+    ) -> List[Union[Value, None]]:
+        """Reads many keys, taking each shard's lock once"""
+        by_shard: Dict[int, List[int]] = dict()
+        for i, key in enumerate(keys):
+            by_shard.setdefault(self._shard(key), []).append(i)
+        values: List[Union[Value, None]] = [None] * len(keys)
+        for n, positions in by_shard.items():
+            with self._locks[n]:
+                if self._history[n]:
+                    for i in positions:
+                        values[i] = self._read(n, keys[i], as_of)
+                else:
+                    shard = self._shards[n]
+                    for i in positions:
+                        values[i] = shard.get(keys[i])
+        return values
+
+    def _set(self, n: int, key: str, value: Union[Value, None], version: int):
+        """Writes (or, for `None`, deletes) a key in shard `n`, whose lock
+        must be held"""
+        shard = self._shards[n]
+        old = shard.get(key)
+        if old is None and value is None:
+            return
+        if self._pinned:
+            history = self._history[n].setdefault(key, [])
+            # of several writes to a key in one version, only the value
+            # before the first can be read
+            if not history or history[-1][0] != version:
+                history.append((version, old))
+        if value is None:
+            del shard[key]
+            if key not in self._history[n]:
+                with self._index_lock:
+                    self._index.discard(key)
+        else:
+            if old is None:
+                with self._index_lock:
+                    self._index.add(key)
+            shard[key] = value
+
+    def apply(
+            self,
+            writes: Iterable[Tuple[str, Union[Value, None]]],
+            index: int | None = None
+    ):
+        """Applies many upserts and deletes (a value of `None`), in order, so
+        that no reader sees some of them without the rest"""
+        sharded = [(self._shard(key), key, value) for key, value in writes]
+        # locks are always taken in shard order, so that concurrent calls
+        # cannot deadlock
+        held = sorted({n for n, _, _ in sharded})
+        for n in held:
+            self._locks[n].acquire()
+        try:
+            version = self._next(index)
+            for n, key, value in sharded:
+                self._set(n, key, value, version)
+            self.version = version
+        finally:
+            for n in held:
+                self._locks[n].release()
+
+    def delete_range(
+            self,
+            start: str | None,
+            end: str | None,
+            index: int | None = None
+    ) -> List[str]:
+        """Deletes every key from `start` (inclusive) to `end` (exclusive),
+        as one write, and returns the deleted keys"""
+        with self._index_lock:
+            keys = self._index.range(start, end, len(self._index))
+        # the index may also hold keys kept only for pinned versions
+        keys = [k for k, v in zip(keys, self._read_many(keys, None))
+                if v is not None]
+        self.apply([(key, None) for key in keys], index)
+        return keys
+
+    def pin(self) -> int:
+        """Returns the current version, which can be read with `as_of` until
+        it is released"""
+        with self._pin_lock:
+            for lock in self._locks:
+                lock.acquire()
+            try:
+                version = self.version
+                self._pinned[version] = self._pinned.get(version, 0) + 1
+                return version
+            finally:
+                for lock in self._locks:
+                    lock.release()
+
+    def release(self, version: int):
+        """Unpins a version returned by `pin`"""
+        with self._pin_lock:
+            oldest = min(self._pinned)
+            self._pinned[version] -= 1
+            if self._pinned[version]:
+                return
+            del self._pinned[version]
+            if version == oldest:
+                self._collect()
+
+    @contextmanager
+    def snapshot(self) -> Iterator[int]:
+        """Pins the current version for the duration of a `with` block"""
+        version = self.pin()
+        try:
+            yield version
+        finally:
+            self.release(version)
+
+    def _check(self, as_of: int | None):
+        if as_of is not None and as_of < self.version \
+                and as_of not in self._pinned:
+            raise ValueError(f"version {as_of} is not pinned")
+
+    def _collect(self):
+        """Drops the replaced values that no pinned version can read any
+        more, with the pin lock held"""
+        oldest = min(self._pinned, default=None)
+        for n, histories in enumerate(self._history):
+            if not histories:
+                continue
+            with self._locks[n]:
+                for key in list(histories):
+                    history = histories[key]
+                    if oldest is None:
+                        history.clear()
+                    else:
+                        del history[:bisect_right(
+                            history, oldest, key=lambda h: h[0])]
+                    if history:
+                        continue
+                    del histories[key]
+                    if key not in self._shards[n]:
+                        with self._index_lock:
+                            self._index.discard(key)
+
+    def scan(
+            self,
+            start: str | None = None,
+            end: str | None = None,
+            limit: int = 100,
+            as_of: int | None = None
+    ) -> List[Tuple[str, Value]]:
+        """Returns up to `limit` key-value pairs with keys from `start`
+        (inclusive) to `end` (exclusive), in key order. Either bound may be
+        `None` for an open range. The pairs are read as of a pinned version,
+        or else the version current at the start of the call."""
+        if as_of is None:
+            with self.snapshot() as version:
+                return self.scan(start, end, limit, version)
+        self._check(as_of)
+        items: List[Tuple[str, Value]] = list()
+        while len(items) < limit:
+            with self._index_lock:
+                keys = self._index.range(start, end, limit - len(items))
+            if not keys:
+                break
+            values = self._read_many(keys, as_of)
+            items.extend(
+                (k, v) for k, v in zip(keys, values) if v is not None)
+            # the smallest key after the last one
+            start = keys[-1] + '\0'
+        return items
+
+    def items(
+            self,
+            start: str | None = None,
+            end: str | None = None,
+            as_of: int | None = None,
+            page: int = 1000
+    ) -> Iterator[Tuple[str, Value]]:
+        """Iterates over the key-value pairs with keys from `start`
+        (inclusive) to `end` (exclusive), or every pair, in key order. The
+        pairs are read `page` at a time as of a pinned version, or else the
+        version current when iteration starts, so writes are not blocked
+        while it runs and nothing is copied in bulk."""
+        if as_of is None:
+            with self.snapshot() as version:
+                yield from self.items(start, end, version, page)
+            return
+        while True:
+            items = self.scan(start, end, page, as_of)
+            yield from items
+            if len(items) < page:
+                return
+            start = items[-1][0] + '\0'
+
+    def restore(
+            self,
+            items: Iterable[Tuple[str, Value]],
+            index: int | None = None
+    ):
+        """Replaces the entire contents of the store, e.g.: from a snapshot,
+        as of version `index`. Pinned versions then read the new contents."""
+        shards: List[dict] = [dict() for _ in self._shards]
+        keys = SortedKeys()
+        for key, value in sorted(items):
+            shards[self._shard(key)][key] = value
+            keys.add(key)
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            self._shards = shards
+            self._history = [dict() for _ in shards]
+            with self._index_lock:
+                self._index = keys
+            self.version = self._next(index)
+        finally:
+            for lock in self._locks:
+                lock.release()
@@ -0,0 +1,126 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+import codec  # noqa
+from raft import AppendResult, Entry, Op, VoteResult  # noqa
+
+
+def test_append_round_trip():
+    entries = [
+        Entry(op=Op.WRITE, key='this', value='that', term=2),
+        Entry(op=Op.DELETE, key='ünïcode', value=None, term=3),
+        Entry(op=Op.WRITE, key='session', value='x', term=3, expires=12345),
+    ]
+    buf = codec.encode_append(
+        term=3, leader_id='localhost:5000', prev_log_index=10,
+        prev_log_term=2, entries=entries, leader_commit=9)
+    args = codec.decode_append(buf)
+    assert args['term'] == 3
+    assert args['leader_id'] == 'localhost:5000'
+    assert args['prev_log_index'] == 10
+    assert args['prev_log_term'] == 2
+    assert args['leader_commit'] == 9
+    assert len(args['entries']) == 3
+    assert args['entries'][0].value == 'that'
+    assert args['entries'][1].key == 'ünïcode'
+    assert args['entries'][1].value is None
+    assert args['entries'][1].term == 3
+    assert args['entries'][1].expires == 0
+    assert args['entries'][2].expires == 12345
+    assert args['entries'][2].op == Op.WRITE
+
+
+def test_vote_round_trip():
+    buf = codec.encode_vote(
+        term=4, candidate_id='localhost:5000', last_log_index=7,
+        last_log_term=3)
+    assert codec.decode_vote(buf) == dict(
+        term=4, candidate_id='localhost:5000', last_log_index=7,
+        last_log_term=3)
+
+
+def test_result_round_trip():
+    res = codec.decode_append_result(
+        codec.encode_append_result(AppendResult(5, True)))
+    assert res.term == 5
+    assert res.success
+    res = codec.decode_append_result(
+        codec.encode_append_result(AppendResult(5, False, 3, 120)))
+    assert (res.success, res.conflict_term, res.conflict_index) == (
+        False, 3, 120)
+    # a result without hints, as older nodes send
+    res = codec.decode_append_result(codec._RESULT.pack(5, False))
+    assert (res.success, res.conflict_term, res.conflict_index) == (
+        False, 0, -1)
+    res = codec.decode_vote_result(
+        codec.encode_vote_result(VoteResult(5, False)))
+    assert res.term == 5
+    assert not res.vote_granted
+
+
+def test_truncated_append():
+    buf = codec.encode_append(
+        term=1, leader_id='a:1', prev_log_index=-1, prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key='this', value='that', term=1)],
+        leader_commit=-1)
+    with pytest.raises(codec.DecodeError):
+        codec.decode_append(buf[:-3])
+
+
+def test_import_decoder_chunks():
+    """records split across chunks at every offset decode the same"""
+    pairs = [('this', 'that'), ('ünïcode', 'välue'), ('k', 'x' * 300)]
+    for binary in (True, False):
+        if binary:
+            buf = codec.encode_import(pairs)
+        else:
+            buf = b''.join(
+                json.dumps({'key': k, 'value': v}).encode() + b'\n'
+                for k, v in pairs)
+        for step in (1, 7, len(buf)):
+            decoder = codec.ImportDecoder(binary)
+            decoded = list()
+            for i in range(0, len(buf), step):
+                decoded += decoder.feed(buf[i:i + step])
+            decoded += decoder.finish()
+            assert decoded == pairs
+
+
+def test_import_decoder_malformed():
+    decoder = codec.ImportDecoder(binary=True)
+    assert list(decoder.feed(
+        codec.encode_import([('this', 'that')])[:-1])) == []
+    with pytest.raises(codec.DecodeError):
+        list(decoder.finish())
+    decoder = codec.ImportDecoder(binary=False)
+    with pytest.raises(codec.DecodeError):
+        list(decoder.feed(b'{"key": "this"}\n'))
+    with pytest.raises(codec.DecodeError):
+        list(decoder.feed(b'{"key": "this", "value": ""}\n'))
+    # the pairs before a malformed line are still decoded
+    pairs = decoder.feed(b'{"key": "a", "value": "b"}\nnot json\n')
+    assert next(pairs) == ('a', 'b')
+    with pytest.raises(codec.DecodeError):
+        next(pairs)
+    # a final line without a newline is still read
+    decoder = codec.ImportDecoder(binary=False)
+    assert list(decoder.feed(b'{"key": "a", "value": "b"}')) == []
+    assert list(decoder.finish()) == [('a', 'b')]
+
+
+def test_append_compressed_value():
+    packed = b'\x01\x00\xff compressed'
+    buf = codec.encode_append(
+        term=1, leader_id='a:1', prev_log_index=-1, prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key='k', value=packed, term=1,
+                       expires=5)],
+        leader_commit=-1)
+    (entry,) = codec.decode_append(buf)['entries']
+    assert entry.value == packed
+    assert entry.op == Op.WRITE
+    assert entry.expires == 5
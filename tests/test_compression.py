@@ -0,0 +1,56 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from compression import Compressor  # noqa
+from metrics import Metrics  # noqa
+
+BLOB = json.dumps([{'id': i, 'name': 'item', 'tags': ['a', 'b']}
+                   for i in range(100)])
+
+
+@pytest.mark.parametrize('algorithm', ['zlib', 'lzma'])
+def test_round_trip(algorithm):
+    c = Compressor(algorithm, min_bytes=100)
+    packed = c.compress(BLOB)
+    assert isinstance(packed, bytes)
+    assert len(packed) < len(BLOB) / 4
+    assert c.decompress(packed) == BLOB
+    # any node can read what another compressed, whatever its own setting
+    assert Compressor('none').decompress(packed) == BLOB
+
+
+def test_below_threshold():
+    c = Compressor('zlib', min_bytes=len(BLOB) + 1)
+    assert c.compress(BLOB) == BLOB
+    assert c.decompress(BLOB) == BLOB
+    assert Compressor('none', min_bytes=0).compress(BLOB) == BLOB
+
+
+def test_incompressible():
+    """a value that would grow is kept as it is"""
+    metrics = Metrics()
+    c = Compressor('zlib', min_bytes=0, metrics=metrics)
+    assert c.compress('x') == 'x'
+    assert metrics.counters['compression_skipped'] == 1
+
+
+def test_metrics():
+    metrics = Metrics()
+    c = Compressor('zlib', min_bytes=100, metrics=metrics)
+    c.decompress(c.compress(BLOB))
+    assert metrics.counters['compression_input_bytes'] == len(BLOB)
+    assert 0 < metrics.gauges['compression_ratio'] < 0.25
+    assert metrics.summaries['compression_seconds'].count == 1
+    assert metrics.summaries['decompression_seconds'].count == 1
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        Compressor('brotli')
+    with pytest.raises(ValueError):
+        Compressor().decompress(b'\x09garbage')
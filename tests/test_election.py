@@ -0,0 +1,222 @@
+import asyncio
+import os
+import sys
+import time
+
+import httpx
+import pytest
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from election import Elector  # noqa
+from raft import State, Entry, Op, ForeignNode, Role  # noqa
+from replication import Replicator  # noqa
+from server import build_app  # noqa
+from store import Store  # noqa
+
+
+class Network(httpx.AsyncBaseTransport):
+    """routes requests to in-process apps, except to and from nodes that are
+    down"""
+    def __init__(self, source: str, apps: dict, down: set):
+        self.source = source
+        self.apps = apps
+        self.down = down
+
+    async def handle_async_request(self, request):
+        target = f'{request.url.host}:{request.url.port}'
+        if self.source in self.down or target in self.down:
+            raise httpx.ConnectError('node is down', request=request)
+        transport = httpx.ASGITransport(app=self.apps[target])
+        return await transport.handle_async_request(request)
+
+
+def build_cluster(
+        addresses=('n1:1', 'n2:1', 'n3:1'), binary=True, preferred=None):
+    """builds a cluster of followers that elect a leader among themselves"""
+    apps: dict = dict()
+    down: set = set()
+    electors = dict()
+    for address in addresses:
+        state = State(Store())
+        state.address = address
+        state.foreign_nodes = {
+            a: ForeignNode() for a in addresses if a != address}
+
+        def client(target, source=address):
+            return httpx.AsyncClient(
+                transport=Network(source, apps, down),
+                base_url=f'http://{target}')
+        replicator = Replicator(
+            state, heartbeat_interval=0.01, binary=binary,
+            client_factory=client)
+        electors[address] = Elector(
+            state, replicator, election_timeout=0.05, client_factory=client,
+            preferred=preferred)
+        apps[address] = build_app(state, replicator, electors[address])
+    return electors, down
+
+
+def leaders(electors, down=()):
+    return [a for a, e in electors.items()
+            if e.state.role == Role.LEADER and a not in down]
+
+
+async def wait_for_leader(electors, down=(), timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        found = leaders(electors, down)
+        if len(found) == 1:
+            return found[0]
+        await asyncio.sleep(0.005)
+    raise AssertionError('no leader elected')
+
+
+def test_single_node_elects_itself():
+    electors, _ = build_cluster(('n1:1',))
+    elector = electors['n1:1']
+
+    async def run():
+        elector.start()
+        await wait_for_leader(electors)
+        await asyncio.sleep(0.05)
+        await elector.stop()
+        await elector.replicator.stop()
+
+    asyncio.run(run())
+    assert elector.state.current_term == 1
+    # the new leader committed an entry of its own term
+    assert elector.state.commit_index == 0
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_leader_elected_and_replaced(binary):
+    electors, down = build_cluster(binary=binary)
+
+    async def run():
+        for e in electors.values():
+            e.start()
+        first = await wait_for_leader(electors)
+        term = electors[first].state.current_term
+        await electors[first].replicator.propose(
+            [Entry(op=Op.WRITE, key='this', value='that', term=term)])
+        # heartbeats hold off other elections
+        await asyncio.sleep(0.3)
+        assert leaders(electors) == [first]
+        assert electors[first].state.current_term == term
+
+        down.add(first)
+        second = await wait_for_leader(electors, down)
+        assert second != first
+        assert electors[second].state.current_term > term
+        # the committed write survived the failover
+        assert electors[second].state.store.read('this') == 'that'
+
+        # the old leader rejoins as a follower
+        down.clear()
+        await asyncio.sleep(0.1)
+        assert leaders(electors) == [second]
+        for e in electors.values():
+            await e.stop()
+            await e.replicator.stop()
+
+    asyncio.run(run())
+
+
+def test_partitioned_node_does_not_disrupt():
+    """a follower cut off from the others fails its pre-votes, so it neither
+    bumps its term nor unseats the leader when it rejoins"""
+    electors, down = build_cluster()
+
+    async def run():
+        for e in electors.values():
+            e.start()
+        leader = await wait_for_leader(electors)
+        term = electors[leader].state.current_term
+        follower = next(a for a in electors if a != leader)
+        down.add(follower)
+        await asyncio.sleep(0.5)
+        assert electors[follower].state.current_term == term
+        assert electors[follower].state.metrics.counters['prevotes_lost'] > 0
+        down.clear()
+        await asyncio.sleep(0.2)
+        assert leaders(electors) == [leader]
+        assert electors[leader].state.current_term == term
+        for e in electors.values():
+            await e.stop()
+            await e.replicator.stop()
+
+    asyncio.run(run())
+
+
+def test_leader_without_quorum_steps_down():
+    electors, down = build_cluster()
+
+    async def run():
+        for e in electors.values():
+            e.start()
+        leader = await wait_for_leader(electors)
+        term = electors[leader].state.current_term
+        # cut the leader off from both followers
+        down.add(leader)
+        await asyncio.sleep(0.2)
+        state = electors[leader].state
+        assert state.role == Role.FOLLOWER
+        assert state.current_term == term
+        assert state.voted_for == leader
+        for e in electors.values():
+            await e.stop()
+            await e.replicator.stop()
+
+    asyncio.run(run())
+
+
+def test_leadership_returns_to_preferred():
+    electors, down = build_cluster(preferred='n2:1')
+
+    async def run():
+        for e in electors.values():
+            e.start()
+        assert await wait_for_leader(electors) == 'n2:1'
+        down.add('n2:1')
+        assert await wait_for_leader(electors, down) != 'n2:1'
+        # once back and caught up, the preferred node is handed leadership
+        down.clear()
+        deadline = time.monotonic() + 2
+        while leaders(electors) != ['n2:1']:
+            assert time.monotonic() < deadline
+            await asyncio.sleep(0.005)
+        for e in electors.values():
+            await e.stop()
+            await e.replicator.stop()
+
+    asyncio.run(run())
+    assert sum(e.state.metrics.counters.get('leadership_transfers', 0)
+               for e in electors.values()) >= 1
+
+
+def test_candidate_steps_down_for_leader():
+    """a candidate that hears from the leader of its term follows it"""
+    state = State(Store())
+    state.current_term = 1
+    state.become_candidate()
+    assert state.role == Role.CANDIDATE and state.current_term == 2
+    res = state.append_entries(
+        term=2, leader_id='a:1', prev_log_index=-1, prev_log_term=0,
+        entries=[], leader_commit=-1)
+    assert res.success
+    assert state.role == Role.FOLLOWER
+    assert state.leader_id == 'a:1'
+
+
+def test_timeout_now_only_from_leader():
+    electors, _ = build_cluster()
+    elector = electors['n1:1']
+    elector.state.current_term = 1
+    elector.state.leader_id = 'n2:1'
+    elector.timeout_now(1, 'n3:1')
+    assert not elector._forced
+    elector.timeout_now(0, 'n2:1')
+    assert not elector._forced
+    elector.timeout_now(1, 'n2:1')
+    assert elector._forced
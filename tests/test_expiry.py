@@ -0,0 +1,57 @@
+import os
+import random
+import sys
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from expiry import TimingWheel  # noqa
+
+
+def test_due_after_deadline():
+    w = TimingWheel(tick=10, now=1000)
+    w.schedule('this', 1055)
+    w.advance(1050)
+    assert w.due() == []
+    w.advance(1060)
+    assert w.due() == [('this', 1055)]
+    # due keys stay due until they are cancelled
+    w.advance(1100)
+    assert w.due() == [('this', 1055)]
+    w.cancel('this')
+    assert w.due() == []
+    assert len(w) == 0
+
+
+def test_reschedule_and_cancel():
+    w = TimingWheel(tick=10, now=0)
+    w.schedule('this', 100)
+    w.schedule('this', 500)
+    w.schedule('that', 200)
+    w.cancel('that')
+    w.advance(300)
+    assert w.due() == []
+    w.advance(500)
+    assert w.due() == [('this', 500)]
+
+
+def test_past_deadline():
+    w = TimingWheel(tick=10, now=1000)
+    w.schedule('this', 500)
+    assert w.due() == [('this', 500)]
+
+
+def test_matches_brute_force():
+    """keys spread over every level, and beyond the top one, should each
+    become due on the first advance at or after their deadline"""
+    rng = random.Random(0)
+    w = TimingWheel(tick=1, slots=4, levels=3, now=0)
+    deadlines = dict()
+    for i in range(500):
+        deadlines[f'k{i}'] = rng.randrange(1, 200)
+        w.schedule(f'k{i}', deadlines[f'k{i}'])
+    now = 0
+    while now < 210:
+        now += rng.randrange(1, 5)
+        w.advance(now)
+        assert dict(w.due()) == {
+            k: d for k, d in deadlines.items() if d <= now}
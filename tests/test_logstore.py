@@ -0,0 +1,103 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from logstore import MemoryLog, SegmentedLog  # noqa
+
+
+def build_log(path, per_segment=4):
+    return SegmentedLog(
+        str(path), encode=str.encode, decode=bytes.decode, term=len,
+        entries_per_segment=per_segment)
+
+
+def test_random_access_across_segments(tmp_path):
+    log = build_log(tmp_path)
+    log.extend(str(i) for i in range(10))
+    assert len(log) == 10
+    assert log[0] == '0'
+    assert log[5] == '5'
+    assert log[9] == '9'
+    assert log[-1] == '9'
+    assert log[3:6] == ['3', '4', '5']
+    with pytest.raises(IndexError):
+        log[10]
+    # full segments are sealed by the next sync, not by the append
+    assert not [n for n in os.listdir(tmp_path) if n.endswith('.index')]
+    log.sync()
+    # two sealed segments, and an active one with two entries
+    assert len([n for n in os.listdir(tmp_path) if n.endswith('.index')]) == 2
+    assert log[5] == '5'
+    assert log[3:6] == ['3', '4', '5']
+    # terms come from the index of a sealed segment
+    assert log.term(5) == 1
+    log.append('long')
+    assert log.term(10) == 4
+
+
+def test_truncate_into_sealed_segment(tmp_path):
+    log = build_log(tmp_path)
+    log.extend(str(i) for i in range(10))
+    log.sync()
+    del log[3:]
+    assert len(log) == 3
+    assert list(log) == ['0', '1', '2']
+    log.extend(['a', 'b'])
+    assert log[3] == 'a'
+    assert log[4] == 'b'
+
+
+def test_reopen(tmp_path):
+    log = build_log(tmp_path)
+    log.extend(str(i) for i in range(10))
+    del log[7:]
+    log.append('x')
+    log.close()
+
+    log = build_log(tmp_path)
+    assert len(log) == 8
+    assert list(log) == ['0', '1', '2', '3', '4', '5', '6', 'x']
+
+
+def build_memory_log():
+    # entries are decoded in place, so each one carries its length
+    return MemoryLog(
+        encode=lambda s: bytes([len(s)]) + s.encode(),
+        decode=lambda buf, i: buf[i + 1:i + 1 + buf[i]].decode(),
+        term=len)
+
+
+def test_memory_log_access():
+    log = build_memory_log()
+    log.extend(['a', 'bb', 'ccc'])
+    assert len(log) == 3
+    assert log[1] == 'bb'
+    assert log[-1] == 'ccc'
+    assert log[1:] == ['bb', 'ccc']
+    assert log.term(2) == 3
+    with pytest.raises(IndexError):
+        log[3]
+
+
+def test_memory_log_truncate_and_compact():
+    log = build_memory_log()
+    log.extend(['a', 'bb', 'ccc', 'dddd'])
+    del log[3:]
+    assert list(log) == ['a', 'bb', 'ccc']
+    log.compact(1)
+    assert log.first_index == 2
+    assert len(log) == 3
+    assert log[2] == 'ccc'
+    assert log[0:] == ['ccc']
+    with pytest.raises(IndexError):
+        log[1]
+    log.append('ee')
+    assert log[3] == 'ee'
+    del log[2:]
+    assert len(log) == 2
+    log.append('f')
+    assert log[2] == 'f'
+    assert log.term(2) == 1
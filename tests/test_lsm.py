@@ -0,0 +1,220 @@
+import os
+import random
+import sys
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from lsm import LSMStore  # noqa
+from raft import State, Entry, Op  # noqa
+
+
+def small_store(directory, **kwargs) -> LSMStore:
+    """a store whose memtables and tables fill up after a few dozen writes"""
+    options = dict(
+        memtable_bytes=512, block_bytes=128, table_bytes=1024,
+        level0_tables=2, level_ratio=2, background=False)
+    options.update(kwargs)
+    return LSMStore(str(directory), **options)
+
+
+def test_read_after_write(tmp_path):
+    s = small_store(tmp_path)
+    assert not s.read('empty')
+    s.upsert('this', 'that')
+    s.upsert('this', 'other')
+    assert s.read('this') == 'other'
+    s.delete('this')
+    assert not s.read('this')
+
+
+def test_matches_dict(tmp_path):
+    """reads and scans should agree with a plain dict through flushes and
+    compactions across several levels"""
+    rng = random.Random(0)
+    s = small_store(tmp_path)
+    expected = dict()
+    for i in range(3000):
+        key = f'k{rng.randrange(300):03}'
+        if rng.random() < 0.2:
+            s.delete(key)
+            expected.pop(key, None)
+        else:
+            s.upsert(key, f'v{i}')
+            expected[key] = f'v{i}'
+    assert len(s._version.levels) > 2
+    for n in range(300):
+        key = f'k{n:03}'
+        assert s.read(key) == expected.get(key)
+    assert list(s.items()) == sorted(expected.items())
+    assert s.scan('k100', 'k200', 10) == [
+        kv for kv in sorted(expected.items()) if 'k100' <= kv[0] < 'k200'][:10]
+
+
+def test_cached_reads(tmp_path):
+    s = small_store(tmp_path)
+    s.upsert('this', 'that')
+    s.flush()
+    # the second read is served from the row cache
+    assert s.read('this') == 'that'
+    assert s.read('this') == 'that'
+    s.upsert('this', 'other')
+    s.flush()
+    assert s.read('this') == 'other'
+
+
+def test_reopen(tmp_path):
+    s = small_store(tmp_path)
+    for i in range(200):
+        s.upsert(f'k{i:03}', f'v{i}')
+    s.delete('k007')
+    s.close()
+
+    # the last writes are only in the memtable's log
+    s = small_store(tmp_path)
+    assert s.read('k199') == 'v199'
+    assert s.read('k000') == 'v0'
+    assert not s.read('k007')
+    assert len(list(s.items())) == 199
+
+
+def test_tombstones_dropped(tmp_path):
+    s = small_store(tmp_path)
+    for i in range(100):
+        s.upsert(f'k{i:03}', 'x' * 20)
+    for i in range(100):
+        s.delete(f'k{i:03}')
+    s.flush()
+    # compact everything down to the bottom level
+    for level in range(len(s._version.levels) - 1):
+        while s._version.levels[level]:
+            s._compact(level)
+    assert list(s.items()) == []
+    assert sum(t.count for level in s._version.levels for t in level) == 0
+
+
+def test_apply_and_restore(tmp_path):
+    s = small_store(tmp_path)
+    s.upsert('old', 'value')
+    s.apply([('this', 'that'), ('old', None)])
+    assert s.read('this') == 'that'
+    assert not s.read('old')
+
+    s.restore((f'k{i:03}', f'v{i}') for i in range(100))
+    assert not s.read('this')
+    assert s.read('k050') == 'v50'
+    assert len(list(s.items())) == 100
+
+
+def test_background(tmp_path):
+    s = small_store(tmp_path, background=True)
+    for i in range(1000):
+        s.upsert(f'k{i:04}', f'v{i}')
+    s.flush()
+    assert not s._frozen
+    assert s.read('k0500') == 'v500'
+    assert len(list(s.items())) == 1000
+    s.close()
+
+
+def test_state_snapshot(tmp_path, monkeypatch):
+    """a node can run on the on-disk store, including snapshots"""
+    monkeypatch.setenv('RSB_SNAPSHOT_ENTRIES', '10')
+    s = State(small_store(tmp_path / 'store'))
+    entries = [Entry(op=Op.WRITE, key=f'k{i:03}', value=f'v{i}', term=1)
+               for i in range(25)]
+    s.append_entries(term=1, leader_id='a:1', prev_log_index=-1,
+                     prev_log_term=0, entries=entries, leader_commit=24)
+    assert s.snapshot_index >= 9
+
+    f = State(small_store(tmp_path / 'follower'))
+    chunk, done = s.snapshot_chunk(0)
+    assert done
+    f.install_snapshot(
+        term=1, leader_id='a:1', last_included_index=s.snapshot_index,
+        last_included_term=s.snapshot_term, offset=0, data=chunk, done=done)
+    assert f.store.read('k005') == 'v5'
+
+
+def test_durable_index(tmp_path):
+    """the manifest records the last index written to a table file"""
+    s = small_store(tmp_path)
+    for i in range(100):
+        s.upsert(f'k{i:03}', 'v', i)
+    s.flush()
+    assert s.durable_index == 99
+    s.restore([('this', 'that')], 150)
+    assert s.durable_index == 150
+    s.close()
+    assert small_store(tmp_path).durable_index == 150
+
+
+def test_restart_keeps_store(tmp_path, monkeypatch):
+    """a node whose store is up to date with its snapshot does not rewrite
+    it from the snapshot when it restarts"""
+    monkeypatch.setenv('RSB_SNAPSHOT_ENTRIES', '10')
+    s = State(small_store(tmp_path / 'store'), str(tmp_path / 'node'))
+    entries = [Entry(op=Op.WRITE, key=f'k{i:03}', value=f'v{i}', term=1)
+               for i in range(25)]
+    s.append_entries(term=1, leader_id='a:1', prev_log_index=-1,
+                     prev_log_term=0, entries=entries, leader_commit=24)
+    assert s.snapshot_index == 24
+    s.store.flush()
+    s.store.close()
+    s.wal.close()
+    s.log.close()
+
+    def restore(*args):
+        raise AssertionError('the store was restored')
+    monkeypatch.setattr(LSMStore, 'restore', restore)
+    r = State(small_store(tmp_path / 'store'), str(tmp_path / 'node'))
+    assert r.last_applied == 24
+    assert r.store.read('k005') == 'v5'
+
+
+def test_items_consistent(tmp_path):
+    """iteration sees the store as of its start, memtable included"""
+    s = small_store(tmp_path, memtable_bytes=1 << 20)
+    for i in range(100):
+        s.upsert(f'k{i:03}', 'old')
+    items = s.items('k010', 'k020')
+    assert next(items) == ('k010', 'old')
+    for i in range(100):
+        s.upsert(f'k{i:03}', 'new')
+    s.delete('k015')
+    assert [v for _, v in items] == ['old'] * 9
+    assert s.read('k011') == 'new'
+
+
+def test_items_leaves_memtable(tmp_path):
+    """iterating does not flush the memtable to a table of its own"""
+    s = small_store(tmp_path, memtable_bytes=1 << 20)
+    for i in range(10):
+        s.upsert(f'k{i:03}', 'v')
+    for _ in range(5):
+        assert len(list(s.items())) == 10
+    assert not s._frozen
+    assert not any(s._version.levels)
+
+
+def test_compressed_values(tmp_path):
+    """bytes values are kept as bytes, through the log and table files"""
+    s = small_store(tmp_path)
+    packed = b'\x01\x00\xff compressed'
+    s.upsert('blob', packed)
+    s.upsert('text', 'plain')
+    s.close()
+    s = small_store(tmp_path)
+    assert s.read('blob') == packed
+    s.flush()
+    assert s.read('blob') == packed
+    assert list(s.items()) == [('blob', packed), ('text', 'plain')]
+
+
+def test_delete_range(tmp_path):
+    s = small_store(tmp_path)
+    for i in range(100):
+        s.upsert(f'k{i:03}', 'v')
+    s.flush()
+    assert s.delete_range('k010', 'k020') == [f'k{i:03}' for i in range(10, 20)]
+    assert len(list(s.items())) == 90
+    assert not s.read('k015')
@@ -0,0 +1,136 @@
+import collections
+import os
+import sys
+import time
+
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from codec import encode_ndjson  # noqa
+from multiraft import (  # noqa
+    group_address, group_of, preferred_leader, scope_to_group)
+from raft import State, ForeignNode, Role  # noqa
+from server import build_app  # noqa
+from store import Store  # noqa
+
+
+def test_group_of():
+    counts = collections.Counter(group_of(f'k{i}', 8) for i in range(8000))
+    assert sorted(counts) == list(range(8))
+    assert min(counts.values()) > 800
+    assert group_of('this', 8) == group_of('this', 8)
+
+
+def test_preferred_leaders_spread():
+    addresses = ['a:1', 'b:1', 'c:1']
+    leaders = [preferred_leader(g, addresses) for g in range(6)]
+    assert leaders[4] == 'b:1/groups/4'
+    counts = collections.Counter(leader.split('/')[0] for leader in leaders)
+    assert counts == {'a:1': 2, 'b:1': 2, 'c:1': 2}
+
+
+def test_scope_to_group():
+    state = State(Store())
+    state.address = 'a:1'
+    state.foreign_nodes = {'b:1': ForeignNode()}
+    scope_to_group(state, 3)
+    assert state.address == 'a:1/groups/3'
+    assert list(state.foreign_nodes) == ['b:1/groups/3']
+
+
+def wait_for_leaders(client):
+    """waits for each group to elect this node, as the only one"""
+    deadline = time.monotonic() + 2
+    while any(g['role'] != Role.LEADER for g in client.get('/groups').json()):
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_routes_by_key(monkeypatch):
+    monkeypatch.setenv('RSB_GROUPS', '4')
+    with TestClient(build_app()) as client:
+        wait_for_leaders(client)
+
+        keys = [f'k{i}' for i in range(20)]
+        for key in keys:
+            res = client.post('/', params={'key': key, 'value': key.upper()})
+            assert res.status_code == 201
+        for key in keys:
+            assert client.get('/', params={'key': key}).json() == {
+                'value': key.upper()}
+            # the key is only in its own group
+            group = group_of(key, 4)
+            assert client.get(f'/groups/{group}/', params={'key': key}).json()
+            res = client.get(f'/groups/{(group + 1) % 4}/', params={'key': key})
+            assert res.status_code == 404
+
+        same = [key for key in keys if group_of(key, 4) == group_of('k0', 4)]
+        res = client.post('/mget', json={'keys': same})
+        assert res.json() == {'values': {key: key.upper() for key in same}}
+        res = client.post('/batch', json={'operations': [
+            dict(op='delete', key=key) for key in same]})
+        assert res.status_code == 201
+        assert client.get('/', params={'key': 'k0'}).status_code == 404
+
+        # a multi-get is split between the groups
+        res = client.post('/mget', json={'keys': keys})
+        assert res.json() == {'values': {
+            key: key.upper() for key in keys if key not in same}}
+        # requests that span groups are otherwise refused
+        res = client.post('/batch', json={'operations': [
+            dict(op='delete', key=key) for key in keys]})
+        assert res.status_code == 400
+        assert client.get('/range').status_code == 400
+        assert client.get(f'/groups/{group_of("k1", 4)}/range').json()[
+            'items']
+        # malformed requests are still rejected as such
+        assert client.post('/mget', content=b'junk').status_code == 422
+
+
+def test_redirect_within_group():
+    """a follower sends clients to the same group on the leader's node"""
+    state = State(Store())
+    state.leader_id = group_address('b:1', 2)
+    app = FastAPI()
+    app.mount('/groups/2', build_app(state))
+    client = TestClient(app)
+    res = client.post(
+        '/groups/2/', params={'key': 'this', 'value': 'that'},
+        follow_redirects=False)
+    assert res.status_code == 308
+    assert res.headers['location'] == (
+        'http://b:1/groups/2/?key=this&value=that')
+
+
+def test_groups_only_take_their_own_keys(monkeypatch):
+    monkeypatch.setenv('RSB_GROUPS', '4')
+    monkeypatch.setenv('RSB_IMPORT_BATCH_BYTES', '16')
+    with TestClient(build_app()) as client:
+        wait_for_leaders(client)
+        other = (group_of('k1', 4) + 1) % 4
+        res = client.post(
+            f'/groups/{other}/', params={'key': 'k1', 'value': 'v'})
+        assert res.status_code == 400
+        res = client.post(f'/groups/{other}/batch', json={'operations': [
+            dict(op='write', key='k1', value='v')]})
+        assert res.status_code == 400
+        res = client.post(
+            f'/groups/{other}/import', content=encode_ndjson([('k1', 'v')]))
+        assert res.status_code == 400
+        assert client.get('/', params={'key': 'k1'}).status_code == 404
+
+        # the node splits an import between the groups
+        keys = [f'k{i}' for i in range(50)]
+        res = client.post('/import', content=encode_ndjson(
+            [(key, key.upper()) for key in keys]))
+        assert res.json() == {'imported': 50}
+        for key in keys:
+            assert client.get('/', params={'key': key}).json() == {
+                'value': key.upper()}
+
+        # and deletes a prefix from every group
+        assert client.delete('/prefix', params={'p': 'k'}).status_code == 204
+        assert all(client.get('/', params={'key': key}).status_code == 404
+                   for key in keys)
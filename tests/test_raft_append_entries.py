@@ -5,7 +5,8 @@ import pytest
 
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 
-from raft import State, Entry, Op, Role, InvalidOperationException  # noqa
+from raft import (  # noqa
+    State, Entry, Op, Role, InvalidOperationException, batch_entry)
 from store import Store  # noqa
 
 
@@ -60,7 +61,7 @@ def test_append_entries_nonempty():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0]
+    s.log.extend([le0])
 
     le1 = Entry(op=Op.DELETE, key='this', value=None, term=term)
 
@@ -90,7 +91,7 @@ def test_append_entries_evict():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0, le1]
+    s.log.extend([le0, le1])
 
     new_term = term + 1
     le2 = Entry(op=Op.WRITE, key='this', value='other', term=new_term)
@@ -123,7 +124,7 @@ def test_append_entries_nonempty_missing():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0]
+    s.log.extend([le0])
 
     le1 = Entry(op=Op.DELETE, key='this', value=None, term=term)
 
@@ -139,6 +140,41 @@ def test_append_entries_nonempty_missing():
     assert len(s.log) == 1
     # expect follower to not commit, since log is incomplete
     assert s.commit_index == -1
+    # the leader should try again from the end of the follower's log
+    assert res.conflict_term == 0
+    assert res.conflict_index == 1
+
+
+def test_append_entries_conflict_hint():
+    """a follower whose log disagrees reports the term there, and where that
+    term starts"""
+    s = State(Store())
+    s.current_term = 3
+    s.log.extend([Entry(op=Op.WRITE, key='k', value='v', term=t)
+                  for t in [1] * 3 + [2] * 50])
+
+    res = s.append_entries(
+        term=4,
+        leader_id='a:1',
+        prev_log_index=40,
+        prev_log_term=3,
+        entries=[],
+        leader_commit=-1)
+    assert not res.success
+    assert res.conflict_term == 2
+    assert res.conflict_index == 3
+
+
+def test_conflict_next_index():
+    s = State(Store())
+    s.log.extend([Entry(op=Op.WRITE, key='k', value='v', term=t)
+                  for t in [1] * 3 + [3] * 5])
+    # the leader has entries from the follower's conflicting term
+    assert s.conflict_next_index(1, 0) == 3
+    # or none, so the whole term is skipped
+    assert s.conflict_next_index(2, 3) == 3
+    # or the follower's log is short
+    assert s.conflict_next_index(0, 2) == 2
 
 
 def test_append_entries_nonempty_discard():
@@ -150,12 +186,12 @@ def test_append_entries_nonempty_discard():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0, le1]
+    s.log.extend([le0, le1])
     s.commit_index = 0
     s.last_applied = 0
 
     # This should become the second log entry, replacing le1
-    le2 = Entry(op=Op.WRITE, key='this', value='other', term=term)
+    le2 = Entry(op=Op.WRITE, key='this', value='other', term=new_term)
 
     res = s.append_entries(
         term=new_term,
@@ -180,7 +216,7 @@ def test_append_entries_invalid_term():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0]
+    s.log.extend([le0])
 
     le1 = Entry(op=Op.DELETE, key='this', value=None, term=past_term)
 
@@ -234,7 +270,7 @@ def test_append_entries_apply_writes():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0, le1]
+    s.log.extend([le0, le1])
 
     # no new entries, commit existing
     res = s.append_entries(
@@ -260,7 +296,7 @@ def test_append_entries_apply_delete():
     # simulate a previous successful election and write
     s = State(Store())
     s.current_term = term
-    s.log = [le0, le1]
+    s.log.extend([le0, le1])
 
     # no new entries, commit existing
     res = s.append_entries(
@@ -283,7 +319,7 @@ def test_reject_invalid_entry_operation():
     # simulate a previous successful election and write of an invalid op
     s = State(Store())
     s.current_term = term
-    s.log = [le]
+    s.log.extend([le])
 
     res = s.append_entries(
         term=term,
@@ -303,7 +339,7 @@ def test_reject_invalid_entry_value():
     # simulate a previous successful election and write of a malformed op
     s = State(Store())
     s.current_term = term
-    s.log = [le]
+    s.log.extend([le])
 
     # no new entries, commit existing
     res = s.append_entries(
@@ -337,3 +373,142 @@ def test_invalid_entry_value():
     ie0 = Entry(op=Op.WRITE, key='this', value=None, term=1)
     with pytest.raises(InvalidOperationException):
         s._apply_entry(ie0)
+
+
+def test_append_entries_duplicate_kept():
+    """test that a delayed, duplicate request does not drop entries appended
+    by a later request (rules 3 and 4 of AppendEntries)"""
+    term = 1
+    le0 = Entry(op=Op.WRITE, key='this', value='that', term=term)
+    le1 = Entry(op=Op.WRITE, key='hem', value='haw', term=term)
+    le2 = Entry(op=Op.DELETE, key='this', value=None, term=term)
+    s = State(Store())
+    s.current_term = term
+    s.log.extend([le0, le1, le2])
+
+    # a retransmission of the request that originally carried le1
+    res = s.append_entries(
+        term=term,
+        leader_id='a:1',
+        prev_log_index=0,
+        prev_log_term=term,
+        entries=[le1],
+        leader_commit=1)
+    assert res.success
+    assert len(s.log) == 3
+    assert s.log[2].op == le2.op
+    # only entries known to match the leader's log may be committed
+    assert s.commit_index == 1
+
+
+def test_append_entries_first_commit():
+    """test that the first append also advances the commit index"""
+    term = 1
+    s = State(Store())
+    s.current_term = term
+
+    le = Entry(op=Op.WRITE, key='this', value='that', term=term)
+    res = s.append_entries(
+        term=term,
+        leader_id='a:1',
+        prev_log_index=-1,
+        prev_log_term=0,
+        entries=[le],
+        leader_commit=0)
+    assert res.success
+    assert s.commit_index == 0
+    assert s.store.read('this') == 'that'
+
+
+def test_append_entries_apply_batch():
+    """test committing a batch entry applies all of its operations"""
+    term = 1
+    le0 = Entry(op=Op.WRITE, key='old', value='value', term=term)
+    le1 = batch_entry([
+        Entry(op=Op.WRITE, key='this', value='that', term=term),
+        Entry(op=Op.DELETE, key='old', value=None, term=term),
+    ], term)
+    s = State(Store())
+    s.current_term = term
+    s.log.extend([le0, le1])
+
+    res = s.append_entries(
+        term=term,
+        leader_id='a:1',
+        prev_log_index=1,
+        prev_log_term=term,
+        entries=[],
+        leader_commit=1)
+    assert res.success
+    assert s.store.read('this') == 'that'
+    assert not s.store.read('old')
+
+
+def test_batch_compressed_value():
+    """a compressed (bytes) value survives a batch, and is stored as it is"""
+    packed = b'\x01\x00\xff compressed'
+    entry = batch_entry([
+        Entry(op=Op.WRITE, key='this', value=packed, term=1),
+        Entry(op=Op.WRITE, key='that', value='plain', term=1, expires=7),
+    ], 1)
+    s = State(Store())
+    s._apply_entry(entry, 0)
+    assert s.store.read('this') == packed
+    assert s.store.read('that') == 'plain'
+    assert s.expiry.deadline('that') == 7
+
+
+def test_invalid_batch():
+    with pytest.raises(InvalidOperationException):
+        batch_entry([Entry(op=Op.READ, key='this', value=None, term=1)], 1)
+
+
+def test_is_fresh():
+    """a follower's freshness is judged against the leader's commit index
+    as of the last heartbeat"""
+    term = 1
+    s = State(Store())
+    s.current_term = term
+    # no leader heard from yet
+    assert not s.is_fresh(max_lag=10)
+
+    le = Entry(op=Op.WRITE, key='this', value='that', term=term)
+    # the leader has committed two entries, this follower has only one
+    s.append_entries(term=term, leader_id='a:1', prev_log_index=-1,
+                     prev_log_term=0, entries=[le], leader_commit=1)
+    assert s.last_applied == 0
+    assert s.is_fresh(max_lag=1)
+    assert not s.is_fresh(max_lag=0)
+    assert not s.is_fresh(max_staleness=60)
+
+    s.append_entries(term=term, leader_id='a:1', prev_log_index=0,
+                     prev_log_term=term, entries=[le], leader_commit=1)
+    assert s.is_fresh(max_lag=0, max_staleness=60)
+    s.last_heartbeat -= 120
+    assert not s.is_fresh(max_staleness=60)
+
+
+def test_append_entries_apply_expire():
+    """an EXPIRE entry only deletes the key if it has not been written since
+    the leader found it had expired"""
+    term = 1
+    s = State(Store())
+    s.current_term = term
+    entries = [
+        Entry(op=Op.WRITE, key='this', value='that', term=term, expires=100),
+        Entry(op=Op.WRITE, key='other', value='that', term=term, expires=100),
+        # rewritten with a new TTL before its expiry was committed
+        Entry(op=Op.WRITE, key='other', value='new', term=term, expires=900),
+        batch_entry([
+            Entry(op=Op.EXPIRE, key='this', value=None, term=term,
+                  expires=100),
+            Entry(op=Op.EXPIRE, key='other', value=None, term=term,
+                  expires=100)], term),
+    ]
+    s.append_entries(term=term, leader_id='a:1', prev_log_index=-1,
+                     prev_log_term=0, entries=entries, leader_commit=3)
+    assert s.store.read('this') is None
+    assert s.expiry.deadline('this') is None
+    assert s.store.read('other') == 'new'
+    assert s.expiry.deadline('other') == 900
+    assert [e.key for e in s.due_expiries(10)] == ['other']
@@ -51,7 +51,7 @@ def test_request_vote_incorrect_last_log_index():
     s.role = Role.LEADER
     s.current_term = test_term
     le = Entry(op=Op.WRITE, key='this', value='that', term=test_term)
-    s.log = [le]
+    s.log.extend([le])
 
     test_addr = 'localhost:5000'
     res = s.request_vote(
@@ -73,7 +73,7 @@ def test_request_vote_incorrect_last_log_term():
     s.role = Role.LEADER
     s.current_term = test_term
     le = Entry(op=Op.WRITE, key='this', value='that', term=test_term)
-    s.log = [le]
+    s.log.extend([le])
 
     test_addr = 'localhost:5000'
     res = s.request_vote(
@@ -86,3 +86,78 @@ def test_request_vote_incorrect_last_log_term():
     assert s.voted_for == s.address
     assert s.role == Role.LEADER
 
+
+
+def test_request_vote_longer_log():
+    """a candidate whose log is longer, or ends in a later term, is up to
+    date"""
+    s = State(Store())
+    s.address = 'localhost:1010'
+    s.current_term = 1
+    s.log.extend([Entry(op=Op.WRITE, key='this', value='that', term=1)])
+
+    res = s.request_vote(
+        term=2,
+        candidate_id='localhost:5000',
+        last_log_index=3,
+        last_log_term=1)
+    assert res.vote_granted
+    res = s.request_vote(
+        term=3,
+        candidate_id='localhost:5001',
+        last_log_index=0,
+        last_log_term=2)
+    assert res.vote_granted
+    assert s.voted_for == 'localhost:5001'
+
+
+def test_request_vote_once_per_term():
+    s = State(Store())
+    s.address = 'localhost:1010'
+    s.current_term = 1
+
+    # a follower that has not voted in this term can still vote
+    res = s.request_vote(
+        term=1, candidate_id='localhost:5000', last_log_index=-1,
+        last_log_term=0)
+    assert res.vote_granted
+    # and is asked again by the same candidate
+    res = s.request_vote(
+        term=1, candidate_id='localhost:5000', last_log_index=-1,
+        last_log_term=0)
+    assert res.vote_granted
+    res = s.request_vote(
+        term=1, candidate_id='localhost:5001', last_log_index=-1,
+        last_log_term=0)
+    assert not res.vote_granted
+    assert s.voted_for == 'localhost:5000'
+
+
+def test_pre_vote_changes_nothing():
+    s = State(Store())
+    s.address = 'localhost:1010'
+    s.current_term = 3
+
+    res = s.pre_vote(
+        term=4, candidate_id='localhost:5000', last_log_index=-1,
+        last_log_term=0, leader_timeout=0.15)
+    assert res.vote_granted
+    assert res.term == 3
+    assert s.current_term == 3
+    assert s.voted_for == ''
+
+
+def test_pre_vote_rejected_while_leader_heard():
+    s = State(Store())
+    s.address = 'localhost:1010'
+    s.append_entries(term=3, leader_id='localhost:2000', prev_log_index=-1,
+                     prev_log_term=0, entries=[], leader_commit=-1)
+    args = dict(term=4, candidate_id='localhost:5000', last_log_index=-1,
+                last_log_term=0, leader_timeout=0.15)
+    assert not s.pre_vote(**args).vote_granted
+    # the leader has gone quiet
+    s.last_heartbeat -= 1
+    assert s.pre_vote(**args).vote_granted
+    # but the candidate must still be as up to date
+    s.log.extend([Entry(op=Op.WRITE, key='this', value='that', term=3)])
+    assert not s.pre_vote(**args).vote_granted
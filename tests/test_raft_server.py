@@ -1,10 +1,13 @@
+import base64
 import os
 import sys
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 
+import codec  # noqa
 from fastapi.testclient import TestClient  # noqa
 from server import build_app  # noqa
-from raft import State  # noqa
+from raft import State, Entry, Op, _encode_snapshot  # noqa
+from replication import _entry_json  # noqa
 from store import Store  # noqa
 
 
@@ -31,6 +34,49 @@ def test_rpc_append_entries():
     assert res.json()["success"]
 
 
+def test_rpc_append_entries_compressed_json():
+    """a compressed value sent as JSON arrives as the same bytes"""
+    state = State(Store())
+    app = build_app(state)
+
+    client = TestClient(app)
+    packed = b'\x01\x00\xff compressed'
+    entry = Entry(op=Op.WRITE, key='blob', value=packed, term=1)
+    body = {
+            "term": 1,
+            "leader_id": 'localhost:5000',
+            "prev_log_index": -1,
+            "prev_log_term": 0,
+            "entries": [_entry_json(entry)],
+            "leader_commit": 0
+    }
+    res = client.post("/rpc/append", json=body)
+    assert res.json()["success"]
+    assert state.log[0].value == packed
+    assert state.store.read('blob') == packed
+
+
+def test_rpc_append_entries_persists(tmp_path):
+    """entries are on disk before the leader is told they were appended"""
+    state = State(Store(), str(tmp_path))
+    app = build_app(state)
+
+    client = TestClient(app)
+    entry = Entry(op=Op.WRITE, key='this', value='that', term=1)
+    body = {
+            "term": 1,
+            "leader_id": 'localhost:5000',
+            "prev_log_index": -1,
+            "prev_log_term": 0,
+            "entries": [_entry_json(entry)],
+            "leader_commit": -1
+    }
+    res = client.post("/rpc/append", json=body)
+    assert res.json()["success"]
+    assert state.persisted_index == 0
+    assert state.wal.synced_records == 1
+
+
 def test_rpc_request_vote():
     """this corresponds to `test_request_vote_initial` --
     see that file for comprehensive test cases on the vote handler
@@ -54,3 +100,86 @@ def test_rpc_request_vote():
     assert res.status_code == 200
     assert res.json()["vote_granted"]
     assert res.json()["term"] == test_term
+
+
+def test_rpc_install_snapshot():
+    """this corresponds to `test_install_snapshot_in_chunks` --
+    see test_raft_snapshot.py for comprehensive test cases on the snapshot
+    handler"""
+    state = State(Store())
+    app = build_app(state)
+
+    client = TestClient(app)
+
+    snapshot = b''.join(_encode_snapshot(0, 1, [('this', 'that')]))
+    body = {
+        "term": 1,
+        "leader_id": 'localhost:5000',
+        "last_included_index": 0,
+        "last_included_term": 1,
+        "offset": 0,
+        "data": base64.b64encode(snapshot).decode(),
+        "done": True,
+    }
+    res = client.post("/rpc/snapshot", json=body)
+    assert res.status_code == 200
+    assert res.json()["success"]
+    assert state.store.read('this') == 'that'
+
+    res = client.get("/metrics")
+    assert res.status_code == 200
+    assert 'rsb_snapshots_installed 1' in res.text
+
+
+def test_rpc_append_entries_binary():
+    """the binary framing from `codec` is accepted in place of JSON, and the
+    response uses the same framing"""
+    app = build_app()
+
+    client = TestClient(app)
+
+    body = codec.encode_append(
+        term=1,
+        leader_id='localhost:5000',
+        prev_log_index=-1,
+        prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key='this', value='that', term=1)],
+        leader_commit=-1)
+    res = client.post(
+        "/rpc/append", content=body,
+        headers={'content-type': codec.CONTENT_TYPE})
+    assert res.status_code == 200
+    assert res.headers['content-type'] == codec.CONTENT_TYPE
+    assert codec.decode_append_result(res.content).success
+
+    res = client.post(
+        "/rpc/append", content=body[:-3],
+        headers={'content-type': codec.CONTENT_TYPE})
+    assert res.status_code == 400
+
+
+def test_rpc_request_vote_binary():
+    state = State(Store())
+    state.address = 'localhost:1010'
+    app = build_app(state)
+
+    client = TestClient(app)
+
+    body = codec.encode_vote(
+        term=1,
+        candidate_id='localhost:5000',
+        last_log_index=-1,
+        last_log_term=0)
+    res = client.post(
+        "/rpc/vote", content=body,
+        headers={'content-type': codec.CONTENT_TYPE})
+    assert res.status_code == 200
+    assert codec.decode_vote_result(res.content).vote_granted
+
+
+def test_rpc_append_entries_invalid_json():
+    app = build_app()
+
+    client = TestClient(app)
+    res = client.post("/rpc/append", json={"term": 1})
+    assert res.status_code == 422
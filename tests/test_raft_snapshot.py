@@ -0,0 +1,277 @@
+import os
+import sys
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+import raft  # noqa
+from raft import State, Entry, Op, _encode_snapshot, now_ms  # noqa
+from store import Store  # noqa
+
+
+def build_leader(entries: int, snapshot_entries: int = 5) -> State:
+    """builds a state that has committed and applied `entries` writes"""
+    term = 1
+    s = State(Store())
+    s.current_term = term
+    s.snapshot_entries = snapshot_entries
+    s.append_entries(
+        term=term,
+        leader_id='a:1',
+        prev_log_index=-1,
+        prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key=f'k{i}', value=f'v{i}', term=term)
+                 for i in range(entries)],
+        leader_commit=-1)
+    s.append_entries(
+        term=term,
+        leader_id='a:1',
+        prev_log_index=entries - 1,
+        prev_log_term=term,
+        entries=[],
+        leader_commit=entries - 1)
+    return s
+
+
+def test_snapshot_compacts_log():
+    s = build_leader(8)
+    assert s.last_applied == 7
+    assert s.snapshot_index == 7
+    assert s.snapshot_term == 1
+    assert s.log.first_index == 8
+    assert len(s.log) == 8
+
+    # appends after the compaction point still line up
+    le = Entry(op=Op.WRITE, key='this', value='that', term=1)
+    res = s.append_entries(
+        term=1,
+        leader_id='a:1',
+        prev_log_index=7,
+        prev_log_term=1,
+        entries=[le],
+        leader_commit=8)
+    assert res.success
+    assert s.store.read('this') == 'that'
+
+
+def test_install_snapshot_in_chunks():
+    leader = build_leader(8)
+    follower = State(Store())
+    offset = 0
+    done = False
+    while not done:
+        chunk, done = leader.snapshot_chunk(offset, size=16)
+        res = follower.install_snapshot(
+            term=1,
+            leader_id='a:1',
+            last_included_index=leader.snapshot_index,
+            last_included_term=leader.snapshot_term,
+            offset=offset,
+            data=chunk,
+            done=done)
+        assert res.success
+        offset += len(chunk)
+
+    assert follower.snapshot_index == 7
+    assert follower.last_applied == 7
+    assert follower.commit_index == 7
+    assert len(follower.log) == 8
+    assert follower.store.read('k3') == 'v3'
+    assert follower.metrics.counters['snapshots_installed'] == 1
+
+
+def test_restore_off_the_loop():
+    """entries committed while the store is restored from a snapshot, in
+    another thread, are applied once it has been"""
+    leader = build_leader(8)
+    follower = State(Store())
+    chunk, done = leader.snapshot_chunk(0)
+    assert done
+    follower.install_snapshot(
+        term=1,
+        leader_id='a:1',
+        last_included_index=leader.snapshot_index,
+        last_included_term=leader.snapshot_term,
+        offset=0,
+        data=chunk,
+        done=True,
+        sync=False)
+    follower.sync_received()
+    assert follower.install_received(restore=False)
+    assert follower.snapshot_index == 7
+    res = follower.append_entries(
+        term=1,
+        leader_id='a:1',
+        prev_log_index=7,
+        prev_log_term=1,
+        entries=[Entry(op=Op.WRITE, key='this', value='that', term=1)],
+        leader_commit=8)
+    assert res.success
+    # nothing is applied to, or read from, a store being restored
+    assert follower.last_applied == -1
+    assert not follower.is_fresh(max_lag=10)
+    assert follower.begin_snapshot() is None
+
+    follower.finish_restore(follower.restore_store())
+    assert follower.last_applied == 8
+    assert follower.store.read('k3') == 'v3'
+    assert follower.store.read('this') == 'that'
+
+
+def test_install_snapshot_out_of_order_chunk():
+    leader = build_leader(8)
+    follower = State(Store())
+    chunk, _ = leader.snapshot_chunk(16, size=16)
+    res = follower.install_snapshot(
+        term=1,
+        leader_id='a:1',
+        last_included_index=leader.snapshot_index,
+        last_included_term=leader.snapshot_term,
+        offset=16,
+        data=chunk,
+        done=False)
+    assert not res.success
+
+
+def test_recover_from_snapshot(tmp_path):
+    os.environ['RSB_SNAPSHOT_ENTRIES'] = '5'
+    s = State(Store(), str(tmp_path))
+    s.append_entries(
+        term=1,
+        leader_id='a:1',
+        prev_log_index=-1,
+        prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key=f'k{i}', value=f'v{i}', term=1)
+                 for i in range(6)],
+        leader_commit=-1)
+    s.append_entries(
+        term=1,
+        leader_id='a:1',
+        prev_log_index=5,
+        prev_log_term=1,
+        entries=[],
+        leader_commit=5)
+    os.environ.pop('RSB_SNAPSHOT_ENTRIES')
+    assert s.snapshot_index == 5
+    s.wal.close()
+    s.log.close()
+
+    r = State(Store(), str(tmp_path))
+    assert r.snapshot_index == 5
+    assert r.last_applied == 5
+    assert r.store.read('k5') == 'v5'
+
+
+def test_snapshot_keeps_expiry():
+    leader = build_leader(3, snapshot_entries=100)
+    leader.append_entries(
+        term=1, leader_id='a:1', prev_log_index=2, prev_log_term=1,
+        entries=[Entry(op=Op.WRITE, key='session', value='x', term=1,
+                       expires=now_ms() + 60000)],
+        leader_commit=3)
+    leader.take_snapshot()
+
+    follower = State(Store())
+    install(follower, leader)
+    assert follower.store.read('session') == 'x'
+    assert follower.expiry.deadline('session') == (
+        leader.expiry.deadline('session'))
+    assert follower.expiry.deadline('k0') is None
+
+
+def test_snapshot_keeps_compressed_values():
+    leader = build_leader(3, snapshot_entries=100)
+    packed = b'\x01\x00\xff compressed'
+    leader.append_entries(
+        term=1, leader_id='a:1', prev_log_index=2, prev_log_term=1,
+        entries=[Entry(op=Op.WRITE, key='blob', value=packed, term=1)],
+        leader_commit=3)
+    leader.take_snapshot()
+
+    follower = State(Store())
+    install(follower, leader)
+    assert follower.store.read('blob') == packed
+    assert follower.store.read('k0') == leader.store.read('k0')
+
+
+def install(follower: State, leader: State, size: int = 16):
+    offset = 0
+    done = False
+    while not done:
+        chunk, done = leader.snapshot_chunk(offset, size=size)
+        res = follower.install_snapshot(
+            term=1,
+            leader_id='a:1',
+            last_included_index=leader.snapshot_index,
+            last_included_term=leader.snapshot_term,
+            offset=offset,
+            data=chunk,
+            done=done)
+        assert res.success
+        offset += len(chunk)
+
+
+def test_install_older_snapshot_keeps_store():
+    """a follower that has applied past the snapshot keeps its log and store
+    as they are"""
+    leader = build_leader(5)
+    follower = State(Store())
+    follower.snapshot_entries = 100
+    follower.append_entries(
+        term=1, leader_id='a:1', prev_log_index=-1, prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key='k', value=f'v{i}', term=1)
+                 for i in range(10)],
+        leader_commit=9)
+    assert follower.store.read('k') == 'v9'
+    install(follower, leader)
+    assert follower.snapshot_index == 4
+    assert follower.last_applied == 9
+    assert follower.store.read('k') == 'v9'
+    assert follower.log.first_index == 5
+    assert len(follower.log) == 10
+
+
+def test_snapshot_chunks_count_as_contact():
+    leader = build_leader(8)
+    follower = State(Store())
+    chunk, _ = leader.snapshot_chunk(0, size=16)
+    follower.install_snapshot(
+        term=1, leader_id='a:1', last_included_index=leader.snapshot_index,
+        last_included_term=leader.snapshot_term, offset=0, data=chunk,
+        done=False)
+    assert follower.leader_id == 'a:1'
+    assert not follower.pre_vote(
+        term=2, candidate_id='b:1', last_log_index=-1, last_log_term=0,
+        leader_timeout=10).vote_granted
+
+
+def test_snapshot_streams_through_files(tmp_path, monkeypatch):
+    """with a data directory, a snapshot is written, sent and installed a
+    piece at a time, through files, rather than held in memory whole"""
+    monkeypatch.setattr(raft, 'SNAPSHOT_CHUNK_BYTES', 64)
+    pairs = [(f'k{i:02}', f'v{i}') for i in range(50)]
+    assert len(list(_encode_snapshot(0, 1, pairs))) >= 4
+
+    leader = State(Store(), str(tmp_path / 'leader'))
+    leader.snapshot_entries = 100
+    leader.append_entries(
+        term=1, leader_id='a:1', prev_log_index=-1, prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key=k, value=v, term=1)
+                 for k, v in pairs],
+        leader_commit=49)
+    leader.take_snapshot()
+    assert leader._snapshot_data == b''
+    assert leader.snapshot_size == os.path.getsize(
+        tmp_path / 'leader' / 'snapshot')
+
+    follower = State(Store(), str(tmp_path / 'follower'))
+    install(follower, leader, size=64)
+    assert follower._snapshot_data == b''
+    assert follower.store.read('k42') == 'v42'
+    follower.wal.close()
+    follower.log.close()
+
+    restarted = State(Store(), str(tmp_path / 'follower'))
+    assert restarted.snapshot_index == 49
+    assert restarted.store.read('k42') == 'v42'
+    assert restarted.snapshot_chunk(0, size=1 << 20) == (
+        leader.snapshot_chunk(0, size=1 << 20))
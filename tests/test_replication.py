@@ -0,0 +1,380 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import httpx
+import pytest
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from raft import (  # noqa
+    State, Entry, Op, ForeignNode, NotLeaderException, _decode_snapshot,
+    now_ms)
+from replication import Applier, Replicator  # noqa
+from server import build_app  # noqa
+from store import Store  # noqa
+
+
+def build_cluster(followers=('f1:1', 'f2:1'), binary=True):
+    """builds a leader whose followers are served in-process"""
+    states = {a: State(Store()) for a in followers}
+    apps = {a: build_app(s) for a, s in states.items()}
+    leader = State(Store())
+    leader.address = 'l:1'
+    leader.foreign_nodes = {a: ForeignNode() for a in followers}
+    leader.current_term = 1
+    leader.become_leader()
+    replicator = Replicator(
+        leader,
+        heartbeat_interval=0.01,
+        binary=binary,
+        client_factory=lambda a: httpx.AsyncClient(
+            transport=httpx.ASGITransport(app=apps[a]),
+            base_url=f'http://{a}'))
+    return leader, replicator, states
+
+
+def write(key: str, value: str, term: int = 1) -> Entry:
+    return Entry(op=Op.WRITE, key=key, value=value, term=term)
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_propose_replicates_and_commits(binary):
+    leader, replicator, followers = build_cluster(binary=binary)
+
+    async def run():
+        index = await replicator.propose([write('this', 'that')])
+        assert index == 0
+        await asyncio.gather(*[
+            replicator.propose([write(f'k{i}', f'v{i}')]) for i in range(20)])
+        # followers learn the commit index on the next heartbeat
+        await asyncio.sleep(0.05)
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert leader.commit_index == 20
+    assert leader.store.read('this') == 'that'
+    for f in followers.values():
+        assert len(f.log) == 21
+        assert f.commit_index == 20
+        assert f.store.read('k19') == 'v19'
+
+
+def test_follower_catches_up():
+    """a follower that is missing entries is backed up to where the logs
+    agree"""
+    leader, replicator, followers = build_cluster(('f1:1',))
+    leader.log.extend([write(f'k{i}', f'v{i}') for i in range(10)])
+    leader.become_leader()
+
+    async def run():
+        await replicator.propose([write('this', 'that')])
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert len(followers['f1:1'].log) == 11
+    assert leader.foreign_nodes['f1:1'].match_index == 10
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_follower_skips_conflicting_terms(binary):
+    """a follower with a long run of entries from a deposed leader is backed
+    up a term at a time, not an entry at a time"""
+    leader, replicator, followers = build_cluster(('f1:1',), binary=binary)
+    follower = followers['f1:1']
+    follower.log.extend([write(f'k{i}', 'v', term=1) for i in range(100)])
+    follower.log.extend([write(f'k{i}', 'stale', term=2) for i in range(500)])
+    leader.log.extend([write(f'k{i}', 'v', term=1) for i in range(100)])
+    leader.log.extend([write(f'k{i}', 'new', term=3) for i in range(800)])
+    leader.current_term = 3
+    leader.become_leader()
+
+    async def run():
+        await replicator.propose([write('this', 'that', term=3)])
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert len(follower.log) == 901
+    assert follower.log.term(500) == 3
+    assert leader.metrics.counters['append_rejections'] <= 4
+
+
+def test_follower_sent_snapshot():
+    """a follower that is behind the compaction point is sent a snapshot"""
+    leader, replicator, followers = build_cluster(('f1:1',))
+    leader.log.extend([write(f'k{i}', f'v{i}') for i in range(10)])
+    leader.commit_index = 9
+    leader._apply_committed()
+    leader.take_snapshot()
+    leader.become_leader()
+    leader.foreign_nodes['f1:1'].next_index = 0
+
+    async def run():
+        await replicator.propose([write('this', 'that')])
+        await replicator.stop()
+
+    asyncio.run(run())
+    follower = followers['f1:1']
+    assert follower.snapshot_index == 9
+    assert follower.store.read('k3') == 'v3'
+    assert len(follower.log) == 11
+
+
+def test_step_down_on_newer_term():
+    leader, replicator, followers = build_cluster(('f1:1',))
+    followers['f1:1'].current_term = 5
+
+    async def run():
+        with pytest.raises(NotLeaderException):
+            await replicator.propose([write('this', 'that')])
+
+    asyncio.run(run())
+    assert leader.current_term == 5
+    assert leader.role == 'follower'
+
+
+def test_deposed_leader_fails_proposals():
+    """a proposal fails as soon as its leader hears of a newer term, rather
+    than once the replication tasks notice"""
+    leader, replicator, followers = build_cluster()
+    # the replication tasks would not look at the role again for a while
+    replicator.heartbeat_interval = 10
+
+    async def unanswered(request):
+        await asyncio.Event().wait()
+    replicator.client_factory = lambda a: httpx.AsyncClient(
+        transport=httpx.MockTransport(unanswered), base_url=f'http://{a}')
+
+    async def run():
+        proposal = asyncio.create_task(
+            replicator.propose([write('this', 'that')]))
+        await asyncio.sleep(0.05)
+        assert not proposal.done()
+        leader.append_entries(
+            term=2, leader_id='f1:1', prev_log_index=-1, prev_log_term=0,
+            entries=[], leader_commit=-1)
+        with pytest.raises(NotLeaderException):
+            await asyncio.wait_for(proposal, 1)
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert leader.role == 'follower'
+
+
+def test_replaced_proposal_fails():
+    """a proposal whose entry is replaced by a later leader's at the same
+    index is not reported as a success once that index is applied"""
+    state = State(Store())
+    replicator = Replicator(state)
+
+    async def run():
+        lost = replicator._wait_applied(0, 1)
+        kept = replicator._wait_applied(1, 2)
+        state.append_entries(
+            term=2, leader_id='f1:1', prev_log_index=-1, prev_log_term=0,
+            entries=[write('this', 'y', term=2), write('that', 'z', term=2)],
+            leader_commit=1)
+        replicator.notify_applied()
+        with pytest.raises(NotLeaderException):
+            await lost
+        assert await kept == 1
+
+    asyncio.run(run())
+    assert state.store.read('this') == 'y'
+
+
+@pytest.mark.parametrize('mode', ['read_index', 'lease'])
+def test_read_index(mode):
+    leader, replicator, followers = build_cluster()
+    replicator.read_mode = mode
+
+    async def run():
+        # a new leader first commits an entry from its own term
+        assert await replicator.read_index() == 0
+        await replicator.propose([write('this', 'that')])
+        assert await replicator.read_index() == 1
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert len(leader.log) == 2
+    assert leader.store.read('this') == 'that'
+
+
+def test_read_index_lease_skips_heartbeats():
+    leader, replicator, followers = build_cluster()
+    replicator.read_mode = 'lease'
+    replicator.lease = 60
+
+    async def run():
+        await replicator.read_index()
+        acks = dict(replicator._acks)
+        await replicator.read_index()
+        assert replicator._acks == acks
+        await replicator.stop()
+
+    asyncio.run(run())
+
+
+def test_transfer_gives_up_lease_and_proposals():
+    leader, replicator, followers = build_cluster()
+    replicator.read_mode = 'lease'
+    replicator.lease = 60
+
+    async def run():
+        await replicator.read_index()
+        assert replicator.lease_valid()
+        replicator.begin_transfer(60)
+        assert not replicator.lease_valid()
+        with pytest.raises(NotLeaderException):
+            await replicator.propose([write('this', 'that')])
+        # reads confirm leadership with a round of heartbeats instead, which
+        # fails once a majority follows the new leader
+        await replicator.read_index()
+        assert not replicator.lease_valid()
+        replicator.end_transfer()
+        assert replicator.lease_valid()
+        await replicator.propose([write('this', 'that')])
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert leader.store.read('this') == 'that'
+
+
+def test_read_index_without_quorum():
+    leader, replicator, followers = build_cluster()
+    replicator.read_mode = 'read_index'
+
+    async def run():
+        await replicator.read_index()
+        # a partitioned leader cannot confirm that it still leads
+        replicator.client_factory = lambda a: httpx.AsyncClient(
+            transport=httpx.MockTransport(lambda r: httpx.Response(503)))
+        await replicator.stop()
+        with pytest.raises(asyncio.TimeoutError):
+            await replicator.read_index(timeout=0.05)
+        await replicator.stop()
+
+    asyncio.run(run())
+
+
+def test_read_index_follower():
+    leader, replicator, followers = build_cluster()
+    leader.step_down(2)
+
+    async def run():
+        with pytest.raises(NotLeaderException):
+            await replicator.read_index()
+
+    asyncio.run(run())
+
+
+def test_leader_expires_keys(monkeypatch):
+    monkeypatch.setenv('RSB_EXPIRY_TICK_MS', '10')
+    leader, replicator, followers = build_cluster()
+
+    async def run():
+        await replicator.propose([
+            Entry(op=Op.WRITE, key='session', value='x', term=1,
+                  expires=now_ms() + 30),
+            write('this', 'that')])
+        await asyncio.sleep(0.2)
+        await replicator.stop()
+
+    asyncio.run(run())
+    assert leader.store.read('session') is None
+    assert leader.store.read('this') == 'that'
+    assert leader.metrics.counters['expiries_committed'] == 1
+    for f in followers.values():
+        assert f.store.read('session') is None
+        assert len(f.expiry) == 0
+
+
+def test_applier_batches():
+    """committed entries are applied in the background, a batch at a time,
+    with the event loop free in between"""
+    state = State(Store())
+    applier = Applier(state, batch_entries=100)
+    ticks = list()
+
+    async def ticker():
+        while True:
+            ticks.append(state.last_applied)
+            await asyncio.sleep(0)
+
+    async def run():
+        applier.start()
+        task = asyncio.create_task(ticker())
+        res = state.append_entries(
+            term=1, leader_id='l:1', prev_log_index=-1, prev_log_term=0,
+            entries=[write(f'k{i}', f'v{i}') for i in range(1000)],
+            leader_commit=999)
+        assert res.success
+        # nothing is applied in the handler
+        assert state.last_applied == -1
+        assert applier.lag() == 1000
+        while applier.lag():
+            await asyncio.sleep(0)
+        task.cancel()
+        await applier.stop()
+
+    asyncio.run(run())
+    assert state.store.read('k999') == 'v999'
+    assert state.metrics.gauges['apply_lag'] == 0
+    # the ticker ran between batches
+    assert len({t for t in ticks if -1 < t < 999}) >= 5
+
+
+def test_applier_snapshots_in_background(tmp_path):
+    """a snapshot is written in another thread, while later entries go on
+    being applied, and holds the store as of its index"""
+    state = State(Store(), str(tmp_path))
+    state.snapshot_entries = 100
+    applier = Applier(state, batch_entries=100)
+    writers = list()
+    write_snapshot = state.write_snapshot
+
+    def slow_write_snapshot(pending):
+        writers.append(threading.current_thread())
+        time.sleep(0.05)
+        write_snapshot(pending)
+    state.write_snapshot = slow_write_snapshot
+
+    async def run():
+        applier.start()
+        state.append_entries(
+            term=1, leader_id='l:1', prev_log_index=-1, prev_log_term=0,
+            entries=[write(f'k{i}', f'v{i}') for i in range(1000)],
+            leader_commit=999)
+        while applier.lag():
+            await asyncio.sleep(0)
+        # every entry was applied before the snapshot was written
+        assert state.snapshot_index == -1
+        while state.snapshot_index == -1:
+            await asyncio.sleep(0.01)
+        await applier.stop()
+
+    asyncio.run(run())
+    assert writers and threading.main_thread() not in writers
+    assert state.snapshot_index == 99
+    assert sorted(os.listdir(tmp_path)) == ['log', 'snapshot', 'wal']
+    with state.open_snapshot() as f:
+        _, _, pairs = _decode_snapshot(f)
+        assert len(list(pairs)) == 100
+
+
+def test_propose_with_applier():
+    leader, replicator, followers = build_cluster()
+    applier = Applier(leader, on_applied=replicator.notify_applied)
+
+    async def run():
+        applier.start()
+        await asyncio.gather(*[
+            replicator.propose([write(f'k{i}', f'v{i}')]) for i in range(20)])
+        assert leader.store.read('k19') == 'v19'
+        await replicator.stop()
+        await applier.stop()
+
+    asyncio.run(run())
+    assert leader.last_applied == 19
@@ -1,8 +1,13 @@
 import os
+import random
 import sys
+import threading
+
+import pytest
+
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 
-from store import Store  # noqa
+from store import Store, SortedKeys  # noqa
 
 
 def test_read_empty():
@@ -35,3 +40,144 @@ def test_read_after_delete():
     s.upsert(key, value)
     s.delete(key)
     assert(not s.read(key))
+
+
+def test_instances_isolated():
+    s1 = Store()
+    s2 = Store()
+    s1.upsert('isolated', 'that')
+    assert(not s2.read('isolated'))
+
+
+def test_apply():
+    s = Store(shards=4)
+    s.upsert('other', 'value')
+    s.apply([('this', 'that'), ('other', None), ('this', 'again')])
+    assert(s.read('this') == 'again')
+    assert(not s.read('other'))
+
+
+def test_restore():
+    s = Store(shards=4)
+    s.upsert('stale', 'value')
+    items = [(f'k{i}', f'v{i}') for i in range(100)]
+    s.restore(items)
+    assert(not s.read('stale'))
+    assert(sorted(s.items()) == sorted(items))
+
+
+def test_concurrent_writes():
+    s = Store(shards=8)
+    writers = 8
+    per_writer = 1000
+
+    def write(w):
+        for i in range(per_writer):
+            s.upsert(f'{w}-{i}', 'x')
+            s.apply([(f'{w}-{i}-a', 'x'), (f'{w}-{i}-b', 'x')])
+
+    threads = [threading.Thread(target=write, args=(w,))
+               for w in range(writers)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert(len(list(s.items())) == 3 * writers * per_writer)
+
+
+def test_scan():
+    s = Store(shards=4)
+    for i in range(10):
+        s.upsert(f'k{i}', f'v{i}')
+    s.delete('k3')
+    assert(s.scan('k2', 'k5') == [('k2', 'v2'), ('k4', 'v4')])
+    assert(s.scan(limit=2) == [('k0', 'v0'), ('k1', 'v1')])
+    assert(s.scan('k8') == [('k8', 'v8'), ('k9', 'v9')])
+    assert(s.scan('x') == [])
+
+
+def test_sorted_keys():
+    """the chunked index should agree with a plain sorted list through splits
+    and emptied chunks"""
+    rng = random.Random(0)
+    index = SortedKeys(chunk=4)
+    expected = set()
+    for _ in range(2000):
+        key = f'{rng.randrange(200):03}'
+        if rng.random() < 0.6:
+            index.add(key)
+            expected.add(key)
+        else:
+            index.discard(key)
+            expected.discard(key)
+    keys = sorted(expected)
+    assert(len(index) == len(keys))
+    assert(index.range(None, None, 1000) == keys)
+    assert(index.range('050', '150', 1000)
+           == [k for k in keys if '050' <= k < '150'])
+    assert(index.range('050', None, 7) == [k for k in keys if k >= '050'][:7])
+
+
+def test_read_as_of():
+    s = Store(shards=4)
+    s.upsert('this', 'that', index=1)
+    s.upsert('gone', 'soon', index=2)
+    with s.snapshot() as version:
+        assert(version == 2)
+        s.upsert('this', 'other', index=3)
+        s.apply([('gone', None), ('new', 'value')], index=4)
+        s.upsert('this', 'again', index=5)
+        assert(s.read('this', as_of=version) == 'that')
+        assert(s.read('gone', as_of=version) == 'soon')
+        assert(not s.read('new', as_of=version))
+        assert(s.read('this') == 'again')
+        assert(not s.read('gone'))
+        assert(s.scan(as_of=version) == [('gone', 'soon'), ('this', 'that')])
+        assert(sorted(s.items(as_of=version))
+               == [('gone', 'soon'), ('this', 'that')])
+    # with nothing pinned, the replaced values and deleted keys are dropped
+    assert(s._history == [dict() for _ in range(4)])
+    assert(list(s._index) == ['new', 'this'])
+    assert(s.scan() == [('new', 'value'), ('this', 'again')])
+    with pytest.raises(ValueError):
+        s.read('this', as_of=2)
+
+
+def test_collect_keeps_pinned():
+    """releasing the oldest pin drops only what no other pin can read"""
+    s = Store(shards=1)
+    s.upsert('k', 'v0', index=0)
+    old = s.pin()
+    s.upsert('k', 'v1', index=1)
+    newer = s.pin()
+    s.upsert('k', 'v2', index=2)
+    s.release(old)
+    assert(s.read('k', as_of=newer) == 'v1')
+    assert(s._history[0]['k'] == [(2, 'v1')])
+    s.release(newer)
+    assert(not s._history[0])
+
+
+def test_consistent_items_during_writes():
+    """a pinned iteration sees one version, even as batches land"""
+    s = Store(shards=8)
+    s.apply((f'k{i}', '0') for i in range(1000))
+    with s.snapshot() as version:
+        items = s.items(as_of=version)
+        first = next(items)
+        for n in range(1, 5):
+            s.apply(((f'k{i}', str(n)) for i in range(1000)))
+        assert({v for _, v in [first, *items]} == {'0'})
+    assert({v for _, v in s.items()} == {'4'})
+
+
+def test_delete_range():
+    s = Store(shards=4)
+    for key in ['a', 'b/1', 'b/2', 'c']:
+        s.upsert(key, 'v')
+    with s.snapshot() as version:
+        assert(s.delete_range('b/', 'b0') == ['b/1', 'b/2'])
+        assert(s.scan() == [('a', 'v'), ('c', 'v')])
+        assert(s.read('b/1', as_of=version) == 'v')
+        # keys only kept for the pinned version are not deleted again
+        assert(s.delete_range('b/', 'b0') == [])
+    assert(s.delete_range(None, None) == ['a', 'c'])
+    assert(list(s.items()) == [])
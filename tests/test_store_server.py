@@ -1,11 +1,14 @@
+import json
 import os
 import sys
 sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
 
+import codec  # noqa
 from fastapi.testclient import TestClient  # noqa
 from server import build_app  # noqa
-from raft import State, Role  # noqa
-from store import Store  # noqa
+from raft import State, Role, Entry, Op, now_ms  # noqa
+from store import Store, prefix_end  # noqa
+from replication import Replicator  # noqa
 
 
 def test_store_read_empty():
@@ -52,7 +55,9 @@ def test_delete():
 
 
 def test_write_follower():
-    app = build_app()
+    state = State(Store())
+    state.leader_id = 'localhost:8001'
+    app = build_app(state)
     # state defaults to follower, and should reject writes
 
     client = TestClient(app)
@@ -60,3 +65,301 @@ def test_write_follower():
     assert response.status_code == 308
     response = client.delete("/?key=this", follow_redirects=False)
     assert response.status_code == 308
+    assert response.headers['location'] == 'http://localhost:8001/?key=this'
+
+
+def test_write_no_leader():
+    app = build_app()
+    # a follower that has not heard from a leader has nowhere to send writes
+
+    client = TestClient(app)
+    response = client.post("/?key=this&value=that", follow_redirects=False)
+    assert response.status_code == 503
+
+
+def test_batch():
+    state = State(Store())
+    app = build_app(state)
+    # node must be leader to accept writes
+    state.role = Role.LEADER
+
+    client = TestClient(app)
+    client.post("/?key=old&value=value")
+    body = {"operations": [
+        {"op": "write", "key": "this", "value": "that"},
+        {"op": "write", "key": "hem", "value": "haw"},
+        {"op": "delete", "key": "old"},
+    ]}
+    response = client.post("/batch", json=body)
+    assert response.status_code == 201
+    # the whole batch is a single log entry
+    assert len(state.log) == 2
+    assert client.get("/?key=this").json()["value"] == 'that'
+    assert client.get("/?key=hem").json()["value"] == 'haw'
+    assert client.get("/?key=old").status_code == 404
+
+
+def test_batch_invalid():
+    state = State(Store())
+    app = build_app(state)
+    state.role = Role.LEADER
+
+    client = TestClient(app)
+    body = {"operations": [
+        {"op": "write", "key": "here", "value": "there"},
+        {"op": "write", "key": "hem"},
+    ]}
+    response = client.post("/batch", json=body)
+    assert response.status_code == 422
+    assert len(state.log) == 0
+    assert client.get("/?key=here").status_code == 404
+
+
+def test_batch_follower():
+    state = State(Store())
+    state.leader_id = 'localhost:8001'
+    app = build_app(state)
+
+    client = TestClient(app)
+    body = {"operations": [{"op": "delete", "key": "this"}]}
+    response = client.post("/batch", json=body, follow_redirects=False)
+    assert response.status_code == 308
+
+
+def test_read_follower_read_index(monkeypatch):
+    monkeypatch.setenv('RSB_READ_MODE', 'read_index')
+    state = State(Store())
+    state.leader_id = 'localhost:8001'
+    app = build_app(state)
+    # only the leader serves linearizable reads
+
+    client = TestClient(app)
+    response = client.get("/?key=this", follow_redirects=False)
+    assert response.status_code == 308
+
+
+def test_read_leader_read_index(monkeypatch):
+    monkeypatch.setenv('RSB_READ_MODE', 'read_index')
+    state = State(Store())
+    app = build_app(state)
+    state.become_leader()
+
+    client = TestClient(app)
+    response = client.post("/?key=read_index&value=that")
+    assert response.status_code == 201
+    response = client.get("/?key=read_index")
+    assert response.status_code == 200
+    assert response.json() == {'value': 'that'}
+
+
+def test_read_follower_bounded_staleness():
+    state = State(Store())
+    app = build_app(state)
+    state.append_entries(
+        term=1, leader_id='a:1', prev_log_index=-1, prev_log_term=0,
+        entries=[Entry(op=Op.WRITE, key='stale', value='that', term=1)],
+        leader_commit=0)
+
+    client = TestClient(app)
+    response = client.get("/?key=stale&max_lag=0&max_staleness_ms=60000")
+    assert response.status_code == 200
+    assert response.json() == {'value': 'that'}
+
+    # the leader has since committed entries this follower has not applied
+    state.leader_commit = 5
+    response = client.get("/?key=stale&max_lag=2", follow_redirects=False)
+    assert response.status_code == 308
+    assert response.headers['location'] == 'http://a:1/?key=stale&max_lag=2'
+    response = client.get("/?key=stale&max_lag=10")
+    assert response.status_code == 200
+
+
+def test_range():
+    state = State(Store())
+    app = build_app(state)
+    for i in range(5):
+        state.store.upsert(f'r{i}', f'v{i}')
+
+    client = TestClient(app)
+    response = client.get("/range?start=r1&end=r9&limit=2")
+    assert response.status_code == 200
+    assert response.json() == {
+        'items': [{'key': 'r1', 'value': 'v1'}, {'key': 'r2', 'value': 'v2'}],
+        'next': 'r3'}
+    response = client.get("/range?start=r3&end=r9&limit=2")
+    assert response.json() == {
+        'items': [{'key': 'r3', 'value': 'v3'}, {'key': 'r4', 'value': 'v4'}],
+        'next': None}
+    response = client.get("/range?limit=0")
+    assert response.status_code == 422
+
+
+def test_write_ttl():
+    state = State(Store())
+    app = build_app(state)
+    state.become_leader()
+
+    client = TestClient(app)
+    response = client.post("/?key=ttl&value=that&ttl_ms=60000")
+    assert response.status_code == 201
+    assert client.get("/?key=ttl").json() == {'value': 'that'}
+    # expired, though the leader has not committed the delete yet
+    state.expiry.schedule('ttl', now_ms() - 1)
+    assert client.get("/?key=ttl").status_code == 404
+    response = client.post("/?key=ttl&value=that&ttl_ms=0")
+    assert response.status_code == 422
+
+
+def test_import(monkeypatch):
+    monkeypatch.setenv('RSB_IMPORT_BATCH_BYTES', '100')
+    state = State(Store())
+    app = build_app(state)
+    state.become_leader()
+
+    client = TestClient(app)
+    lines = (f'{{"key": "k{i:03}", "value": "v{i}"}}\n'.encode()
+             for i in range(50))
+    response = client.post("/import", content=lines)
+    assert response.status_code == 201
+    assert response.json() == {'imported': 50}
+    assert client.get("/?key=k049").json() == {'value': 'v49'}
+    # several batch entries, not one entry per pair
+    assert 1 < len(state.log) < 50
+
+    pairs = [(f'b{i}', 'x') for i in range(10)]
+    response = client.post(
+        "/import", content=codec.encode_import(pairs),
+        headers={'content-type': codec.IMPORT_CONTENT_TYPE})
+    assert response.json() == {'imported': 10}
+    assert client.get("/?key=b9").json() == {'value': 'x'}
+
+
+def test_import_malformed(monkeypatch):
+    """the batches committed before a malformed line stay written"""
+    monkeypatch.setenv('RSB_IMPORT_BATCH_BYTES', '1')
+    state = State(Store())
+    app = build_app(state)
+    state.become_leader()
+
+    client = TestClient(app)
+    chunks = iter([b'{"key": "good", "value": "pair"}\n', b'not json\n'])
+    response = client.post("/import", content=chunks)
+    assert response.status_code == 400
+    assert 'after importing 1 pairs' in response.json()['detail']
+    assert client.get("/?key=good").json() == {'value': 'pair'}
+
+
+def test_import_follower():
+    state = State(Store())
+    state.leader_id = 'localhost:8001'
+    app = build_app(state)
+
+    client = TestClient(app)
+    response = client.post(
+        "/import", content=b'{"key": "k", "value": "v"}\n',
+        follow_redirects=False)
+    assert response.status_code == 308
+
+
+def test_export():
+    state = State(Store())
+    app = build_app(state)
+    for i in range(2500):
+        state.store.upsert(f'k{i:04}', f'v{i}')
+    state.store.upsert('other', 'value')
+    state.expiry.schedule('k0001', now_ms() - 1)
+
+    client = TestClient(app)
+    response = client.get("/export?prefix=k")
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert len(lines) == 2499
+    assert lines[0] == {'key': 'k0000', 'value': 'v0'}
+    assert lines[1] == {'key': 'k0002', 'value': 'v2'}
+
+    # the binary export can be imported as it is
+    response = client.get(
+        "/export", headers={'accept': codec.IMPORT_CONTENT_TYPE})
+    decoder = codec.ImportDecoder(binary=True)
+    pairs = list(decoder.feed(response.content))
+    assert len(pairs) == 2500
+    assert pairs[-1] == ('other', 'value')
+
+
+def test_prefix_end():
+    assert prefix_end('') is None
+    assert prefix_end('ab') == 'ac'
+    assert prefix_end('a' + chr(0x10ffff)) == 'b'
+
+
+def test_compressed_writes(monkeypatch):
+    monkeypatch.setenv('RSB_COMPRESSION', 'zlib')
+    monkeypatch.setenv('RSB_COMPRESSION_MIN_BYTES', '100')
+    state = State(Store())
+    app = build_app(state)
+    state.become_leader()
+
+    client = TestClient(app)
+    blob = json.dumps([{'field': i} for i in range(100)])
+    client.post("/", params={'key': 'blob', 'value': blob})
+    client.post("/?key=small&value=value")
+    # stored compressed, and decompressed as it is read
+    assert isinstance(state.store.read('blob'), bytes)
+    assert state.store.read('small') == 'value'
+    assert client.get("/?key=blob").json() == {'value': blob}
+    assert client.get("/range").json()['items'][0] == {
+        'key': 'blob', 'value': blob}
+    assert 'rsb_compression_ratio' in client.get("/metrics").text
+
+
+def test_prefix():
+    state = State(Store())
+    app = build_app(state)
+    state.become_leader()
+    for key in ['t1/u1/a', 't1/u1/b', 't1/u1/c', 't1/u10/a', 't1/u2/a', 't2']:
+        state.store.upsert(key, 'v')
+
+    client = TestClient(app)
+    response = client.get("/prefix?p=t1/u1/&limit=2")
+    assert [i['key'] for i in response.json()['items']] == [
+        't1/u1/a', 't1/u1/b']
+    assert response.json()['next'] == 't1/u1/c'
+    response = client.get("/prefix?p=t1/u1/&start=t1/u1/c")
+    assert response.json() == {
+        'items': [{'key': 't1/u1/c', 'value': 'v'}], 'next': None}
+
+    state.expiry.schedule('t1/u1/b', now_ms() + 60000)
+    response = client.delete("/prefix?p=t1/u1")
+    assert response.status_code == 204
+    assert [k for k, _ in state.store.items()] == ['t1/u2/a', 't2']
+    assert state.expiry.deadline('t1/u1/b') is None
+    assert client.delete("/prefix?p=").status_code == 422
+
+
+def test_mget(monkeypatch):
+    monkeypatch.setenv('RSB_READ_MODE', 'read_index')
+    state = State(Store())
+    replicator = Replicator(state)
+    app = build_app(state, replicator)
+    state.become_leader()
+    for i in range(100):
+        state.store.upsert(f'k{i}', f'v{i}')
+    checks = 0
+    read_index = replicator.read_index
+
+    async def counted_read_index(*args, **kwargs):
+        nonlocal checks
+        checks += 1
+        return await read_index(*args, **kwargs)
+    monkeypatch.setattr(replicator, 'read_index', counted_read_index)
+
+    client = TestClient(app)
+    keys = [f'k{i}' for i in range(0, 100, 2)] + ['missing']
+    response = client.post("/mget", json={'keys': keys})
+    assert response.status_code == 200
+    assert response.json() == {
+        'values': {f'k{i}': f'v{i}' for i in range(0, 100, 2)}}
+    # one consistency check for the whole request
+    assert checks == 1
+    response = client.post("/mget", json={'keys': ['k'] * 1001})
+    assert response.status_code == 422
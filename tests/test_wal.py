@@ -0,0 +1,108 @@
+import os
+import sys
+import threading
+
+sys.path.append(os.path.realpath(os.path.dirname(__file__)+"/.."))
+
+from wal import WriteAheadLog  # noqa
+from raft import State, Entry, Op  # noqa
+from store import Store  # noqa
+
+
+def test_records_round_trip(tmp_path):
+    path = str(tmp_path / 'wal')
+    w = WriteAheadLog(path)
+    w.append(b'this')
+    w.append(b'that')
+    w.close()
+
+    w = WriteAheadLog(path)
+    assert [r for _, r in w.records()] == [b'this', b'that']
+
+
+def test_torn_tail_discarded(tmp_path):
+    path = str(tmp_path / 'wal')
+    w = WriteAheadLog(path)
+    w.append(b'this')
+    w.append(b'that')
+    w.close()
+    # simulate a crash part way through writing the last record
+    with open(path, 'r+b') as f:
+        f.truncate(os.path.getsize(path) - 2)
+
+    w = WriteAheadLog(path)
+    assert [r for _, r in w.records()] == [b'this']
+    w.append(b'other')
+    w.close()
+
+    w = WriteAheadLog(path)
+    assert [r for _, r in w.records()] == [b'this', b'other']
+
+
+def test_group_commit(tmp_path):
+    """concurrent writers that sync at the same time should share flushes"""
+    w = WriteAheadLog(str(tmp_path / 'wal'))
+    writers = 8
+    per_writer = 50
+    # each round, every writer appends before any of them syncs
+    appended = threading.Barrier(writers)
+
+    def write():
+        for _ in range(per_writer):
+            seq = w.append(b'x')
+            appended.wait()
+            w.sync(seq)
+
+    threads = [threading.Thread(target=write) for _ in range(writers)]
+    [t.start() for t in threads]
+    [t.join() for t in threads]
+    assert w.synced_records == writers * per_writer
+    # the first flush of each round covers every writer's record
+    assert w.syncs <= per_writer
+
+
+def test_state_recovery(tmp_path):
+    term = 2
+    s = State(Store(), str(tmp_path))
+    le0 = Entry(op=Op.WRITE, key='this', value='that', term=1)
+    le1 = Entry(op=Op.DELETE, key='this', value=None, term=1)
+    le2 = Entry(op=Op.WRITE, key='this', value='other', term=term)
+    s.append_entries(term=1, leader_id='a:1', prev_log_index=-1,
+                     prev_log_term=0, entries=[le0, le1], leader_commit=-1)
+    # new leader replaces the uncommitted delete
+    s.append_entries(term=term, leader_id='b:1', prev_log_index=0,
+                     prev_log_term=1, entries=[le2], leader_commit=-1)
+    s.wal.close()
+    s.log.close()
+
+    r = State(Store(), str(tmp_path))
+    assert r.current_term == term
+    assert r.voted_for == 'b:1'
+    assert len(r.log) == 2
+    assert r.log[1].term == term
+    assert r.log[1].value == 'other'
+    assert r.log[0].op == Op.WRITE
+
+
+def test_persist_after_truncation(tmp_path, monkeypatch):
+    """a persist does not vouch for entries that were truncated, and maybe
+    replaced, while it waited on the disk"""
+    s = State(Store(), str(tmp_path))
+    s.log.extend([Entry(op=Op.WRITE, key=f'k{i}', value='v', term=1)
+                  for i in range(10)])
+    s.persist()
+    assert s.persisted_index == 9
+    s.log.extend([Entry(op=Op.WRITE, key='k10', value='v', term=1)])
+    sync = s.log.sync
+
+    def truncating_sync():
+        s._truncate_log(5)
+        s.log.extend([Entry(op=Op.WRITE, key=f'k{i}', value='w', term=2)
+                      for i in range(5, 8)])
+        sync()
+    monkeypatch.setattr(s.log, 'sync', truncating_sync)
+    s.persist()
+    assert s.persisted_index == 4
+    monkeypatch.undo()
+    s.persist()
+    assert s.persisted_index == 7
@@ -0,0 +1,143 @@
+import os
+import struct
+import threading
+import zlib
+from typing import Iterator
+
+# each record is framed as <payload length, crc32 of payload> followed by the
+# payload itself. The log does not interpret payloads -- record schemas belong
+# to whichever module writes them (see `raft` for the node state records)
+_HEADER = struct.Struct('<II')
+
+
+def read_record(buf, offset: int) -> bytes:
+    """Returns the payload of the record starting at `offset` in `buf`, e.g.:
+    a memory map of a log file that is no longer being written."""
+    length, _ = _HEADER.unpack_from(buf, offset)
+    start = offset + _HEADER.size
+    return bytes(buf[start:start + length])
+
+
+class WriteAheadLog:
+    """
+    An append-only, checksummed record file with group commit
+
+    Records are buffered by `append`, and only become durable once `sync` has
+    returned for their sequence number. Concurrent callers of `sync` share a
+    single flush: whichever caller arrives first performs the fsync on behalf
+    of every record written up to that point, and the others wait for it to
+    finish rather than issuing their own. Durability therefore costs one disk
+    flush per batch rather than one per record.
+    """
+    def __init__(self, path: str, fsync: bool = True):
+        self.path = path
+        self.fsync = fsync
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._flushed = threading.Condition(self._lock)
+        # the size in bytes of the log, including buffered records
+        self.size = 0
+        self._file = open(path, 'ab+')
+        self._truncate_torn_tail()
+        # sequence numbers of the last buffered and last durable records
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+        # -- counters, mainly for benchmarks and metrics --
+        self.syncs = 0
+        self.synced_records = 0
+
+    def _scan(self) -> Iterator[tuple[int, bytes]]:
+        """Yields `(offset, payload)` for each intact record, stopping at the
+        first truncated or corrupt one."""
+        self._file.seek(0)
+        offset = 0
+        while True:
+            header = self._file.read(_HEADER.size)
+            if len(header) < _HEADER.size:
+                return
+            length, crc = _HEADER.unpack(header)
+            payload = self._file.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                return
+            yield offset, payload
+            offset += _HEADER.size + length
+
+    def _truncate_torn_tail(self):
+        """A crash in the middle of a write can leave a partial record at the
+        end of the file. Anything after the last intact record was never
+        acknowledged, so it is safe to discard."""
+        end = 0
+        for offset, payload in self._scan():
+            end = offset + _HEADER.size + len(payload)
+        self._file.truncate(end)
+        self._file.seek(0, os.SEEK_END)
+        self.size = end
+
+    def records(self) -> Iterator[tuple[int, bytes]]:
+        """Yields the file offset and payload of every record in the log,
+        oldest first. This is meant for recovery at startup, before any new
+        records are written."""
+        with self._lock:
+            self._file.flush()
+            yield from self._scan()
+            self._file.seek(0, os.SEEK_END)
+
+    def append(self, payload: bytes) -> int:
+        """Buffers a record and returns its sequence number. The record is not
+        durable until `sync` has been called with this (or a later) number.
+        The record starts at the file offset given by `size` just before the
+        call."""
+        with self._lock:
+            self._file.write(_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._file.write(payload)
+            self.size += _HEADER.size + len(payload)
+            self._written += 1
+            return self._written
+
+    def truncate(self, offset: int):
+        """Discards every record starting at or after `offset`, which must be
+        the start of a record. The truncation is durable on return."""
+        with self._lock:
+            self._file.flush()
+            self._file.truncate(offset)
+            if self.fsync:
+                os.fsync(self._file.fileno())
+            self.size = offset
+
+    def sync(self, seq: int | None = None):
+        """Blocks until the record with sequence number `seq` (by default, the
+        last record appended) is durable."""
+        with self._flushed:
+            target = self._written if seq is None else seq
+            while self._synced < target:
+                if self._syncing:
+                    # another caller is flushing -- our record is either in
+                    # their batch or will be picked up by the next one
+                    self._flushed.wait()
+                    continue
+                self._syncing = True
+                batch_end = self._written
+                self._file.flush()
+                fd = self._file.fileno()
+                # release the lock while waiting on the disk, so that other
+                # writers can keep appending to the next batch
+                self._lock.release()
+                try:
+                    if self.fsync:
+                        os.fsync(fd)
+                finally:
+                    self._lock.acquire()
+                    self._syncing = False
+                self.syncs += 1
+                self.synced_records += batch_end - self._synced
+                self._synced = batch_end
+                self._flushed.notify_all()
+
+    def close(self):
+        self.sync()
+        self._file.close()